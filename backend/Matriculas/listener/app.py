@@ -1,20 +1,35 @@
+import time
+
+_MODULE_T0 = time.perf_counter()
+
 import os
+import re
+import csv
+import hashlib
+import io
 import json
+import mimetypes
 import sqlite3
 import threading
 import logging
-import time
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import itertools
+import queue
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Callable, Dict, Any
 
-import requests
-import paramiko
 import paho.mqtt.client as mqtt
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from dateutil import parser as dtparser
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import configparser
-from fastapi.staticfiles import StaticFiles
+
+import media_pack
+from frigate_decoder import FrigateEvent, decode_event, normalize_plate, peek_type
+
+if TYPE_CHECKING:
+    import requests
 
 DB_DIR = os.path.abspath(os.getenv("DB_DIR", "/app/DB"))
 MEDIA_DIR = os.path.abspath(os.getenv("MEDIA_DIR", "/app/MEDIA"))
@@ -43,14 +58,20 @@ app = FastAPI(title="Matriculas Listener")
 _cfg = configparser.ConfigParser()
 _servers: Dict[str, Dict[str, Any]] = {}
 _clients: Dict[str, mqtt.Client] = {}
-_cache: Dict[str, Dict[str, Any]] = {}  # key: server|event_id
 _http_port = 2221
 _retention_days = 30
+_sftp_list_ttl = 10.0
+_workers = 0
+_download_workers = 4
+_media_pack = False
+_repeat_window = 0.0
+_mqtt_loop_threads = 0
 _server_labels: Dict[str, str] = {}
 
 
 def load_config() -> None:
-    global _servers, _http_port, _retention_days
+    global _servers, _http_port, _retention_days, _sftp_list_ttl, _workers, _download_workers, _media_pack, _repeat_window
+    global _mqtt_loop_threads
     if not os.path.exists(CONF_PATH):
         log.warning("Config file not found: %s", CONF_PATH)
         _servers = {}
@@ -58,6 +79,14 @@ def load_config() -> None:
     _cfg.read(CONF_PATH, encoding="utf-8")
     _http_port = int(_cfg.get("general", "http_port", fallback="2221"))
     _retention_days = int(_cfg.get("general", "retention_days", fallback="30"))
+    _sftp_list_ttl = float(_cfg.get("general", "sftp_list_ttl", fallback="10"))
+    _sftp_listings.ttl = _sftp_list_ttl
+    _workers = int(_cfg.get("general", "workers", fallback="0"))
+    _download_workers = max(1, int(_cfg.get("general", "download_workers", fallback="4")))
+    _media_pack = _cfg.getboolean("general", "media_pack", fallback=False)
+    _repeat_window = float(_cfg.get("general", "repeat_window_seconds", fallback="0"))
+    _recent_reads.window = _repeat_window
+    _mqtt_loop_threads = max(0, int(_cfg.get("general", "mqtt_loop_threads", fallback="0")))
     servers: Dict[str, Dict[str, Any]] = {}
     for section in _cfg.sections():
         if section.startswith("server:"):
@@ -76,6 +105,9 @@ def load_config() -> None:
                 "frigate_header_name": _cfg.get(section, "frigate_header_name", fallback=""),
                 "frigate_header_value": _cfg.get(section, "frigate_header_value", fallback=""),
                 "mqtt_topic": _cfg.get(section, "mqtt_topic", fallback="frigate/events"),
+                # QoS 1: persistent session, PUBACK only after the event is in the durable inbox
+                "mqtt_qos": _cfg.getint(section, "mqtt_qos", fallback=1),
+                "mqtt_client_id": _cfg.get(section, "mqtt_client_id", fallback=f"matriculas-{name}"),
                 "sftp_host": _cfg.get(section, "sftp_host", fallback=""),
                 "sftp_port": _cfg.getint(section, "sftp_port", fallback=22),
                 "sftp_user": _cfg.get(section, "sftp_user", fallback="frigate"),
@@ -90,71 +122,223 @@ def load_config() -> None:
                 "sftp_clip_root": _cfg.get(section, "sftp_clip_root", fallback="/mnt/cctv/clips/lpr"),
                 # If template resolves to a directory (e.g., {root}/{camera}/), we will pick the most recent .mp4
                 "sftp_clip_path_template": _cfg.get(section, "sftp_clip_path_template", fallback="{root}/{camera}/"),
+                # Snapshot profile: options of Frigate's snapshot.jpg (0/false = Frigate default, full image)
+                "snapshot_height": _cfg.getint(section, "snapshot_height", fallback=0),
+                "snapshot_quality": _cfg.getint(section, "snapshot_quality", fallback=0),
+                "snapshot_crop": _cfg.getboolean(section, "snapshot_crop", fallback=False),
+                "snapshot_bbox": _cfg.getboolean(section, "snapshot_bbox", fallback=False),
+                "snapshot_timestamp": _cfg.getboolean(section, "snapshot_timestamp", fallback=False),
+                # Media bytes allowed per window (0 = no limit); over it, clips are deferred
+                "bandwidth_budget_mb": _cfg.getfloat(section, "bandwidth_budget_mb", fallback=0.0),
+                "bandwidth_window_minutes": _cfg.getint(section, "bandwidth_window_minutes", fallback=60),
             }
+    for name, server in servers.items():
+        _meter(name).configure(server["bandwidth_budget_mb"], server["bandwidth_window_minutes"])
     _servers = servers
     log.info("Loaded %d server(s) from config", len(_servers))
 
 
-def init_db() -> None:
-    log.info("🔧 BACKEND LPR: Inicializando base de datos para escritura en %s", DB_PATH)
-    
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
+_EVENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server TEXT NOT NULL,
+        frigate_event_id TEXT NOT NULL,
+        topic TEXT,
+        event_type TEXT,
+        camera TEXT,
+        ts DATETIME,
+        payload_json TEXT NOT NULL,
+        snapshot_path TEXT,
+        clip_path TEXT,
+        plate_crop_path TEXT,
+        plate TEXT,
+        speed REAL,
+        repeat_of TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(server, frigate_event_id)
+    )
+"""
+# Columnas agregadas a events en versiones anteriores a las migraciones numeradas
+_EVENTS_LEGACY_COLUMNS = (("speed", "REAL"), ("plate", "TEXT"), ("score", "REAL"), ("repeat_of", "TEXT"))
+_TABLES_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS plates (
+        plate TEXT PRIMARY KEY,
+        first_seen DATETIME,
+        last_seen DATETIME,
+        visits INTEGER NOT NULL DEFAULT 0,
+        last_camera TEXT,
+        last_server TEXT,
+        best_score REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS plate_days (
+        plate TEXT NOT NULL,
+        day TEXT NOT NULL,
+        camera TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (plate, day, camera)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS plate_transitions (
+        plate TEXT NOT NULL,
+        from_server TEXT,
+        from_camera TEXT NOT NULL,
+        from_ts DATETIME NOT NULL,
+        to_server TEXT,
+        to_camera TEXT NOT NULL,
+        to_ts DATETIME NOT NULL,
+        seconds REAL NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_transitions_plate ON plate_transitions(plate, to_ts)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_transitions_pair ON plate_transitions(from_camera, to_camera, seconds, to_ts)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS lpr_hourly (
+        server TEXT NOT NULL,
+        camera TEXT NOT NULL,
+        hour TEXT NOT NULL,
+        reads INTEGER NOT NULL DEFAULT 0,
+        unique_plates INTEGER NOT NULL DEFAULT 0,
+        score_sum REAL NOT NULL DEFAULT 0,
+        score_n INTEGER NOT NULL DEFAULT 0,
+        speed_sum REAL NOT NULL DEFAULT 0,
+        speed_n INTEGER NOT NULL DEFAULT 0,
+        speed_max REAL,
+        PRIMARY KEY (server, camera, hour)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_lpr_hourly_hour ON lpr_hourly(hour)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server TEXT NOT NULL,
+        topic TEXT,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS lpr_hourly_plates (
+        server TEXT NOT NULL,
+        camera TEXT NOT NULL,
+        hour TEXT NOT NULL,
+        plate TEXT NOT NULL,
+        PRIMARY KEY (server, camera, hour, plate)
+    ) WITHOUT ROWID
+    """,
+)
+
+
+def _columns(cur: sqlite3.Cursor, table: str) -> set[str]:
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})")}
+
+
+def _migrate_1_baseline(cur: sqlite3.Cursor) -> None:
+    """Esquema base; idempotente para bases creadas antes de user_version."""
+    cur.execute(_EVENTS_DDL)
+    existing = _columns(cur, "events")
+    for col, decl in _EVENTS_LEGACY_COLUMNS:
+        if col not in existing:
+            cur.execute(f"ALTER TABLE events ADD COLUMN {col} {decl}")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts)")
+    # Resúmenes (mantenidos por _store_event en la transacción del insert) e inbox
+    for ddl in _TABLES_DDL:
+        cur.execute(ddl)
+    if cur.execute("SELECT 1 FROM events WHERE plate IS NOT NULL LIMIT 1").fetchone() is None:
+        return
+    if cur.execute("SELECT 1 FROM plates LIMIT 1").fetchone() is None:
+        log.info("🔧 BACKEND LPR: Generando resumen de matrículas desde events")
+        _rebuild_plate_summary(cur)
+    elif cur.execute("SELECT 1 FROM plate_transitions LIMIT 1").fetchone() is None:
+        log.info("🔧 BACKEND LPR: Generando trayectorias de matrículas desde events")
+        _rebuild_transitions(cur)
+    if cur.execute("SELECT 1 FROM lpr_hourly LIMIT 1").fetchone() is None:
+        log.info("🔧 BACKEND LPR: Generando agregados horarios desde events")
+        _rebuild_hourly(cur)
+
+
+def _migrate_2_deferred_clips(cur: sqlite3.Cursor) -> None:
+    """Cola de clips diferidos por presupuesto de ancho de banda."""
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE IF NOT EXISTS deferred_clips (
             server TEXT NOT NULL,
             frigate_event_id TEXT NOT NULL,
-            topic TEXT,
-            event_type TEXT,
             camera TEXT,
             ts DATETIME,
-            payload_json TEXT NOT NULL,
-            snapshot_path TEXT,
-            clip_path TEXT,
-            plate_crop_path TEXT,
-            plate TEXT,
-            speed REAL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(server, frigate_event_id)
-        );
+            attempts INTEGER NOT NULL DEFAULT 0,
+            queued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (server, frigate_event_id)
+        ) WITHOUT ROWID
         """
     )
-    # Migración defensiva: agregar columna speed si no existe en instalaciones previas
-    try:
-        cur.execute("ALTER TABLE events ADD COLUMN speed REAL")
-        con.commit()
-    except Exception:
-        # ya existe o no se puede alterar, continuar
-        pass
-    # Migración defensiva: agregar columna plate si no existe en instalaciones previas
-    try:
-        cur.execute("ALTER TABLE events ADD COLUMN plate TEXT")
-        con.commit()
-    except Exception:
-        # ya existe o no se puede alterar, continuar
-        pass
-    # Migración defensiva: agregar columna score si no existe en instalaciones previas
-    try:
-        cur.execute("ALTER TABLE events ADD COLUMN score REAL")
-        con.commit()
-    except Exception:
-        # ya existe o no se puede alterar, continuar
-        pass
-    con.commit()
-    con.close()
-    
-    log.info("✅ BACKEND LPR: Base de datos inicializada correctamente - %s", DB_PATH)
-    log.info("✅ BACKEND LPR: Conexión a la base de datos verificada - Listo para escritura")
 
 
-def _db_execute(query: str, params: tuple = ()) -> None:
-    con = sqlite3.connect(DB_PATH)
+def _migrate_3_seen_fallback(cur: sqlite3.Cursor) -> None:
+    """Resúmenes con la hora local de inserción para lecturas sin ts."""
+    # Antes: hora local con "T" en vivo y created_at UTC con espacio al regenerar
+    if cur.execute("SELECT 1 FROM events WHERE ts IS NULL AND plate IS NOT NULL AND plate <> '' LIMIT 1").fetchone():
+        _rebuild_plate_summary(cur)
+        _rebuild_hourly(cur)
+
+
+def _migrate_4_media_superseded(cur: sqlite3.Cursor) -> None:
+    """Lecturas cuyo reemplazo como dueña de los medios se escribió antes que ellas."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS media_superseded (
+            server TEXT NOT NULL,
+            frigate_event_id TEXT NOT NULL,
+            PRIMARY KEY (server, frigate_event_id)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+# Migraciones en orden; la N deja PRAGMA user_version = N. Solo se agregan al final.
+_MIGRATIONS: list[Callable[[sqlite3.Cursor], None]] = [
+    _migrate_1_baseline,
+    _migrate_2_deferred_clips,
+    _migrate_3_seen_fallback,
+    _migrate_4_media_superseded,
+]
+
+
+def init_db() -> None:
+    log.info("🔧 BACKEND LPR: Inicializando base de datos para escritura en %s", DB_PATH)
+    
+    # Autocommit: each migration runs in its own explicit transaction, DDL included
+    con = sqlite3.connect(DB_PATH, isolation_level=None)
     cur = con.cursor()
-    cur.execute(query, params)
-    con.commit()
+    # WAL: HTTP readers do not block the writer (thread or writer process)
+    cur.execute("PRAGMA journal_mode=WAL")
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    for n, migrate in enumerate(_MIGRATIONS[version:], start=version + 1):
+        started = time.perf_counter()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            migrate(cur)
+            cur.execute(f"PRAGMA user_version = {n}")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        log.info("🔧 BACKEND LPR: Migración %d aplicada (%s) en %.0f ms", n,
+                 (migrate.__doc__ or migrate.__name__).strip().splitlines()[0], (time.perf_counter() - started) * 1000)
     con.close()
+    
+    log.info("✅ BACKEND LPR: Base de datos inicializada correctamente - %s (esquema v%d)", DB_PATH, len(_MIGRATIONS))
+    log.info("✅ BACKEND LPR: Conexión a la base de datos verificada - Listo para escritura")
 
 
 def _db_query(query: str, params: tuple = ()) -> list[dict]:
@@ -177,54 +361,9 @@ def _media_paths(server_label: str, camera: str, event_id: str, ts: datetime | N
         "plate": os.path.join(base, f"{event_id}_plate.jpg"),
     }
 
-def _extract_plate(payload: dict) -> tuple[str | None, float]:
-    """Intenta extraer una matrícula del payload de Frigate y su confianza.
-    Busca en múltiples ubicaciones comunes para integraciones LPR.
-    """
-    after = payload.get("after") or {}
-    best_plate, best_score = None, -1.0
-
-    def consider(plate_val, score_val=0.5):
-        nonlocal best_plate, best_score
-        if not plate_val:
-            return
-        # Caso especial: recognized_license_plate es array [matricula, score]
-        if isinstance(plate_val, list) and len(plate_val) == 2 and isinstance(plate_val[0], str) and isinstance(plate_val[1], (float, int)):
-            p = plate_val[0].strip()
-            score = float(plate_val[1]) * 100  # convertir a porcentaje
-            if p and score > best_score:
-                best_plate, best_score = p.replace(" ", "").replace("-", "").upper(), round(score, 2)
-            return
-        if isinstance(plate_val, str):
-            p = plate_val.strip()
-            if not p:
-                return
-            try:
-                score = float(score_val) if score_val is not None else 0.5
-            except Exception:
-                score = 0.5
-            if score > best_score:
-                best_plate, best_score = p.replace(" ", "").replace("-", "").upper(), score
-        elif isinstance(plate_val, dict):
-            consider(plate_val.get("plate") or plate_val.get("text"), plate_val.get("score") or plate_val.get("confidence"))
-
-    # Fuentes posibles
-    sources = [
-        after.get("recognized_license_plate"),
-        after.get("plate"),
-        after.get("text"),
-        (after.get("snapshot") or {}).get("plate"),
-        (after.get("snapshot") or {}).get("text"),
-        after.get("regions"),
-        after.get("box"),
-    ]
-    for src in sources:
-        consider(src)
-    return best_plate, best_score
-
-
-def _http_get(url: str, server: dict, timeout: int = 10) -> requests.Response:
+def _http_get(url: str, server: dict, timeout: int = 10) -> "requests.Response":
     """HTTP GET to Frigate honoring configured authentication per server."""
+    import requests  # lazy: only needed once events arrive
     headers = {}
     auth = None
     mode = (server.get("frigate_auth") or "bearer").lower()
@@ -283,127 +422,343 @@ def _resolve_server_label(server: dict) -> str:
     return label
 
 
+def _snapshot_query(server: dict) -> str:
+    """Query string for /api/events/{id}/snapshot.jpg from the server's snapshot profile."""
+    params = [f"{k}=1" for k in ("crop", "bbox", "timestamp") if server.get(f"snapshot_{k}")]
+    params += [f"{k}={server[f'snapshot_{k}']}" for k in ("height", "quality") if server.get(f"snapshot_{k}", 0) > 0]
+    return "?" + "&".join(params) if params else ""
+
+
+# ---------------- Bandwidth accounting ----------------
+class _BandwidthMeter:
+    """Media bytes pulled from one server: totals per kind and usage in the current window.
+
+    Windows are aligned to the clock (e.g. whole hours). With a budget, clips
+    are deferred while the window is over it; snapshots and crops still flow.
+    """
+
+    def __init__(self) -> None:
+        self.budget = 0  # bytes per window, 0 = no limit
+        self.window = 3600.0
+        self._lock = threading.Lock()
+        self.totals = {"snapshot": 0, "clip": 0, "crop": 0}
+        self.deferred = 0
+        self._window_start = 0.0
+        self._window_bytes = 0
+
+    def configure(self, budget_mb: float, window_minutes: int) -> None:
+        self.budget = int(max(0.0, budget_mb) * 1048576)
+        self.window = max(1, window_minutes) * 60.0
+
+    def _roll(self, now: float) -> None:
+        start = now - now % self.window
+        if start != self._window_start:
+            self._window_start, self._window_bytes = start, 0
+
+    def add(self, kind: str, n: int) -> None:
+        with self._lock:
+            self._roll(time.time())
+            self.totals[kind] += n
+            self._window_bytes += n
+
+    def defer_clip(self) -> None:
+        with self._lock:
+            self.deferred += 1
+
+    def over_budget(self) -> bool:
+        if self.budget <= 0:
+            return False
+        with self._lock:
+            self._roll(time.time())
+            return self._window_bytes >= self.budget
+
+    def status(self) -> dict:
+        with self._lock:
+            self._roll(time.time())
+            return {
+                "bytes": dict(self.totals),
+                "window_bytes": self._window_bytes,
+                "budget_bytes": self.budget or None,
+                "over_budget": bool(self.budget) and self._window_bytes >= self.budget,
+                "clips_deferred": self.deferred,
+            }
+
+
+_meters: Dict[str, _BandwidthMeter] = {}
+
+
+def _meter(server_name: str) -> _BandwidthMeter:
+    meter = _meters.get(server_name)
+    if meter is None:
+        meter = _meters.setdefault(server_name, _BandwidthMeter())
+    return meter
+
+
 def _save_bytes(path: str, data: bytes) -> None:
     os.makedirs(os.path.dirname(path), exist_ok=True)
     with open(path, "wb") as f:
         f.write(data)
 
 
+# ---------------- SFTP listing cache ----------------
+# Frigate event ids look like "1718900000.123456-abc123"; clip names embed them.
+_EVENT_ID_RE = re.compile(r"\d{9,11}\.\d+-[0-9a-z]+")
+# A miss never re-lists a directory listed less than this many seconds ago.
+_SFTP_MISS_REFRESH_FLOOR = 1.0
+
+
+class _RemoteListing:
+    """Snapshot of a remote directory, indexed by name, by event id and by mtime."""
+
+    __slots__ = ("path", "listed_at", "by_name", "by_event", "by_mtime")
+
+    def __init__(self, path: str, attrs: list) -> None:
+        self.path = path
+        self.listed_at = time.monotonic()
+        self.by_name = {a.filename: a for a in attrs}
+        self.by_mtime = sorted(attrs, key=lambda a: a.st_mtime or 0)
+        self.by_event: Dict[str, Any] = {}
+        for a in attrs:
+            for ev in _EVENT_ID_RE.findall(a.filename):
+                self.by_event.setdefault(ev, a)
+
+    def find_event(self, event_id: str, suffixes: tuple):
+        hit = self.by_event.get(event_id)
+        if hit is not None and hit.filename.lower().endswith(suffixes):
+            return hit
+        if event_id and not _EVENT_ID_RE.fullmatch(event_id):
+            # Ids that do not follow Frigate's format are not indexed
+            for a in self.by_mtime:
+                if event_id in a.filename and a.filename.lower().endswith(suffixes):
+                    return a
+        return None
+
+    def newest(self, suffixes: tuple):
+        for a in reversed(self.by_mtime):
+            if a.filename.lower().endswith(suffixes):
+                return a
+        return None
+
+    def middle(self, suffixes: tuple):
+        files = [a for a in self.by_mtime if a.filename.lower().endswith(suffixes)]
+        return files[len(files) // 2] if files else None
+
+
+class _SftpListingCache:
+    """Short-TTL cache of remote directory listings shared across events.
+
+    Key is (host, directory). A directory that does not exist is cached as None
+    so repeated misses on the same path do not hit the server either.
+    """
+
+    def __init__(self, ttl: float = 10.0, max_dirs: int = 4096) -> None:
+        self.ttl = ttl
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, tuple] = {}  # key -> (listed_at, _RemoteListing | None)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sftp, host_key: str, path: str, max_age: float | None = None) -> _RemoteListing | None:
+        path = path.rstrip("/") or "/"
+        key = (host_key, path)
+        ttl = self.ttl if max_age is None else min(self.ttl, max_age)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and now - cached[0] < ttl:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        try:
+            listing: _RemoteListing | None = _RemoteListing(path, sftp.listdir_attr(path))
+        except OSError:
+            # Missing path, or a file (SFTP servers report that as a generic failure)
+            listing = None
+        with self._lock:
+            if len(self._entries) >= self.max_dirs:
+                # Drop the oldest half; listings are cheap to rebuild
+                for k, _ in sorted(self._entries.items(), key=lambda kv: kv[1][0])[: self.max_dirs // 2]:
+                    self._entries.pop(k, None)
+            self._entries[key] = (time.monotonic(), listing)
+        return listing
+
+    def refresh_on_miss(self, sftp, host_key: str, listing: _RemoteListing | None, path: str) -> _RemoteListing | None:
+        """Re-list after a lookup miss unless the listing is brand new."""
+        if listing is not None and time.monotonic() - listing.listed_at < _SFTP_MISS_REFRESH_FLOOR:
+            return listing
+        return self.get(sftp, host_key, path, max_age=0)
+
+    def invalidate(self, host_key: str, path: str) -> None:
+        with self._lock:
+            self._entries.pop((host_key, path.rstrip("/") or "/"), None)
+
+
+_sftp_listings = _SftpListingCache(_sftp_list_ttl)
+_CLIP_SUFFIXES = (".mp4",)
+_CROP_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+
+def _sftp_host_key(server: dict) -> str:
+    return f"{server.get('sftp_user')}@{server.get('sftp_host')}:{server.get('sftp_port', 22)}"
+
+
+class _LocalAttr:
+    __slots__ = ("filename", "st_mtime", "st_size")
+
+    def __init__(self, entry: os.DirEntry) -> None:
+        st = entry.stat()
+        self.filename, self.st_mtime, self.st_size = entry.name, st.st_mtime, st.st_size
+
+
+class _LocalSftp:
+    """Same calls as paramiko.SFTPClient over the local filesystem (sftp_host = local).
+
+    Useful for NVRs whose clips are mounted locally and for the simulator.
+    """
+
+    def listdir_attr(self, path: str) -> list:
+        with os.scandir(path) as it:
+            return [_LocalAttr(e) for e in it]
+
+    def get(self, remote: str, local: str) -> None:
+        import shutil
+        shutil.copyfile(remote, local)
+
+    def close(self) -> None:
+        pass
+
+
+def _open_sftp(server: dict):
+    if server.get("sftp_host") == "local":
+        return _LocalSftp(), _LocalSftp()
+    import paramiko  # lazy: only servers with sftp_host use it
+    transport = paramiko.Transport((server["sftp_host"], int(server.get("sftp_port", 22))))
+    transport.connect(username=server.get("sftp_user"), password=server.get("sftp_pass"))
+    return transport, paramiko.SFTPClient.from_transport(transport)
+
+
+def _sftp_pick_clip(sftp, host_key: str, remote_resolved: str, event_id: str) -> str:
+    """Resolve the clip template to a file: the .mp4 matching event_id, else the newest one."""
+    listing = _sftp_listings.get(sftp, host_key, remote_resolved)
+    if listing is None:
+        # Not a directory: treat as file path, will raise on get if not exists
+        return remote_resolved
+    selected = listing.find_event(event_id, _CLIP_SUFFIXES) if event_id else None
+    if selected is None:
+        listing = _sftp_listings.refresh_on_miss(sftp, host_key, listing, remote_resolved)
+        if listing is None:
+            return remote_resolved
+        selected = (listing.find_event(event_id, _CLIP_SUFFIXES) if event_id else None) or listing.newest(_CLIP_SUFFIXES)
+    if selected is None:
+        raise FileNotFoundError(f"No mp4 files in {remote_resolved}")
+    return listing.path.rstrip("/") + "/" + selected.filename
+
+
+def _sftp_pick_crop(sftp, host_key: str, remote_resolved: str) -> str | None:
+    """Resolve the crop template: middle image by mtime of the event folder, else the path itself."""
+    candidates = [remote_resolved.rstrip("/")]
+    if "." in remote_resolved.rsplit("/", 1)[-1]:
+        # Template pointing at "<event_id>.jpg": also try "<event_id>/" as folder
+        candidates.append(remote_resolved.rsplit(".", 1)[0])
+    for cand in candidates:
+        listing = _sftp_listings.get(sftp, host_key, cand)
+        if listing is None:
+            continue
+        chosen = listing.middle(_CROP_SUFFIXES)
+        if chosen is None:
+            # Folder exists but crops may still be landing; look once more
+            listing = _sftp_listings.refresh_on_miss(sftp, host_key, listing, cand)
+            chosen = listing.middle(_CROP_SUFFIXES) if listing is not None else None
+        return listing.path.rstrip("/") + "/" + chosen.filename if chosen else None
+    return remote_resolved
+
+
+def _fetch_clip(server: dict, camera: str, event_id: str, dest: str, sftp, host_key: str) -> str:
+    """Copy the event clip to `dest`: via SFTP if configured, else Frigate's API. Returns the source."""
+    if (server.get("sftp_clip_mode") or "api").lower() == "sftp" and server.get("sftp_host"):
+        if sftp is None:
+            raise ConnectionError("no SFTP session")
+        clip_root = (server.get("sftp_clip_root") or "/mnt/cctv/clips/lpr").rstrip("/")
+        clip_tpl = (server.get("sftp_clip_path_template") or "{root}/{camera}/")
+        remote_resolved = clip_tpl.format(root=clip_root, camera=camera, event_id=event_id)
+        remote_path = _sftp_pick_clip(sftp, host_key, remote_resolved, event_id)
+        try:
+            sftp.get(remote_path, dest)
+        except FileNotFoundError:
+            # File vanished since the listing (remote cleanup); forget it
+            _sftp_listings.invalidate(host_key, remote_resolved)
+            raise
+        _meter(server["name"]).add("clip", os.path.getsize(dest))
+        return remote_path
+    url = f"{server.get('frigate_url', '').rstrip('/')}/api/events/{event_id}/clip.mp4"
+    resp = _http_get(url, server)
+    _save_bytes(dest, resp.content)
+    _meter(server["name"]).add("clip", len(resp.content))
+    return url
+
+
 def _download_artifacts(server: dict, camera: str, event_id: str, ts: datetime | None) -> dict:
-    saved = {"snapshot": None, "clip": None, "plate": None}
+    saved = {"snapshot": None, "clip": None, "plate": None, "clip_deferred": False}
     server_label = server.get("name") or "server"
     paths = _media_paths(server_label, camera, event_id, ts)
+    meter = _meter(server["name"])
 
     base = server.get("frigate_url", "").rstrip("/")
     if base:
         try:
-            resp = _http_get(f"{base}/api/events/{event_id}/snapshot.jpg", server)
+            resp = _http_get(f"{base}/api/events/{event_id}/snapshot.jpg{_snapshot_query(server)}", server)
             _save_bytes(paths["snapshot"], resp.content)
+            meter.add("snapshot", len(resp.content))
             saved["snapshot"] = os.path.relpath(paths["snapshot"], MEDIA_DIR)
             log.info("[%s] Snapshot saved: %s", server_label, paths["snapshot"])
         except Exception as e:
             log.warning("[%s] Snapshot download failed: %s", server["name"], e)
 
-    # Clip: prefer SFTP if configured
     clip_mode = (server.get("sftp_clip_mode") or "api").lower()
-    if clip_mode == "sftp" and server.get("sftp_host"):
+    remote_tpl = server.get("sftp_plate_path_template") or ""
+    want_sftp_clip = clip_mode == "sftp" and bool(server.get("sftp_host"))
+    want_sftp_crop = bool(server.get("sftp_host")) and bool(remote_tpl)
+    want_clip = want_sftp_clip or bool(base)
+    if want_clip and meter.over_budget():
+        # Over the bandwidth budget: queue the clip for _deferred_clip_loop
+        want_clip = want_sftp_clip = False
+        saved["clip_deferred"] = True
+        meter.defer_clip()
+        log.info("[%s] Clip deferred (bandwidth budget exceeded): %s", server_label, event_id)
+
+    # One SFTP session per event, shared by clip and crop retrieval
+    transport = sftp = None
+    host_key = _sftp_host_key(server)
+    if want_sftp_clip or want_sftp_crop:
         try:
-            clip_root = (server.get("sftp_clip_root") or "/mnt/cctv/clips/lpr").rstrip("/")
-            clip_tpl = (server.get("sftp_clip_path_template") or "{root}/{camera}/")
-            remote_resolved = clip_tpl.format(root=clip_root, camera=camera, event_id=event_id)
-            transport = paramiko.Transport((server["sftp_host"], int(server.get("sftp_port", 22))))
-            transport.connect(username=server.get("sftp_user"), password=server.get("sftp_pass"))
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            remote_path = remote_resolved
-            try:
-                # If remote_path is a directory, choose a file
-                from stat import S_ISDIR
-                st = sftp.stat(remote_resolved)
-                if S_ISDIR(st.st_mode):
-                    # list .mp4 and prefer name containing event_id else newest by mtime
-                    candidates = [f for f in sftp.listdir_attr(remote_resolved) if f.filename.lower().endswith('.mp4')]
-                    if not candidates:
-                        raise FileNotFoundError(f"No mp4 files in {remote_resolved}")
-                    selected = None
-                    for f in candidates:
-                        if event_id and event_id in f.filename:
-                            selected = f
-                            break
-                    if selected is None:
-                        selected = sorted(candidates, key=lambda x: x.st_mtime)[-1]
-                    remote_path = remote_resolved.rstrip('/') + '/' + selected.filename
-            except FileNotFoundError:
-                # treat as file path, will raise on get if not exists
-                pass
-            sftp.get(remote_path, paths["clip"])
-            sftp.close(); transport.close()
+            transport, sftp = _open_sftp(server)
+        except Exception as e:
+            log.warning("[%s] SFTP connect failed: %s", server_label, e)
+
+    # Clip: prefer SFTP if configured
+    if want_clip:
+        try:
+            source = _fetch_clip(server, camera, event_id, paths["clip"], sftp, host_key)
             saved["clip"] = os.path.relpath(paths["clip"], MEDIA_DIR)
-            log.info("[%s] Clip copied via SFTP: %s <- %s", server_label, paths["clip"], remote_path)
+            log.info("[%s] Clip saved: %s <- %s", server_label, paths["clip"], source)
         except Exception as e:
-            log.warning("[%s] SFTP clip copy failed: %s", server["name"], e)
-    else:
-        if base:
-            try:
-                resp = _http_get(f"{base}/api/events/{event_id}/clip.mp4", server)
-                _save_bytes(paths["clip"], resp.content)
-                saved["clip"] = os.path.relpath(paths["clip"], MEDIA_DIR)
-                log.info("[%s] Clip saved: %s", server_label, paths["clip"])
-            except Exception as e:
-                log.warning("[%s] Clip download failed: %s", server["name"], e)
+            log.warning("[%s] Clip download failed (%s): %s", server["name"], clip_mode, e)
 
     # SFTP plate crops (directory with multiple crops). Pick the middle image by time.
-    remote_tpl = server.get("sftp_plate_path_template") or ""
-    sftp_root = (server.get("sftp_plate_root") or "/mnt/cctv/clips/lpr").rstrip("/")
-    if server.get("sftp_host") and remote_tpl:
+    if want_sftp_crop and sftp is not None:
+        sftp_root = (server.get("sftp_plate_root") or "/mnt/cctv/clips/lpr").rstrip("/")
         # Fill placeholders; provide {root} default
         remote_resolved = remote_tpl.format(event_id=event_id, camera=camera, root=sftp_root)
         try:
-            transport = paramiko.Transport((server["sftp_host"], int(server.get("sftp_port", 22))))
-            transport.connect(username=server.get("sftp_user"), password=server.get("sftp_pass"))
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            from stat import S_ISDIR
-            dir_path = None
-            try:
-                st = sftp.stat(remote_resolved)
-                if S_ISDIR(st.st_mode):
-                    dir_path = remote_resolved
-            except FileNotFoundError:
-                pass
-            # Fallbacks: try path with trailing slash, and path without extension + '/'
-            if dir_path is None:
-                for alt in (
-                    remote_resolved.rstrip("/") + "/",
-                    (remote_resolved.rsplit(".", 1)[0] + "/") if "." in remote_resolved.rsplit("/", 1)[-1] else None,
-                ):
-                    if not alt:
-                        continue
-                    try:
-                        st = sftp.stat(alt)
-                        if S_ISDIR(st.st_mode):
-                            dir_path = alt
-                            break
-                    except FileNotFoundError:
-                        continue
-
-            chosen_remote = None
-            if dir_path is not None:
-                # Choose the middle image by modification time
-                entries = [e for e in sftp.listdir_attr(dir_path) if e.filename.lower().endswith((".jpg", ".jpeg", ".png"))]
-                if entries:
-                    entries.sort(key=lambda x: x.st_mtime)
-                    chosen = entries[len(entries)//2]
-                    chosen_remote = dir_path.rstrip("/") + "/" + chosen.filename
-            else:
-                chosen_remote = remote_resolved
-
+            chosen_remote = _sftp_pick_crop(sftp, host_key, remote_resolved)
             if chosen_remote:
                 try:
                     sftp.get(chosen_remote, paths["plate"])
+                    meter.add("crop", os.path.getsize(paths["plate"]))
                 except Exception as ie:
                     log.warning("[%s] Plate crop fetch failed (%s): %s", server_label, chosen_remote, ie)
 
-            sftp.close(); transport.close()
-
             if os.path.exists(paths["plate"]):
                 saved["plate"] = os.path.relpath(paths["plate"], MEDIA_DIR)
                 log.info("[%s] Plate crop saved (middle): %s <- %s", server_label, paths["plate"], chosen_remote or "-")
@@ -412,143 +767,840 @@ def _download_artifacts(server: dict, camera: str, event_id: str, ts: datetime |
         except Exception as e:
             log.warning("[%s] Plate crop SFTP error: %s", server_label, e)
 
+    if sftp is not None:
+        sftp.close(); transport.close()
+
     return saved
 
 
-def _persist_event(server_name: str, event_id: str, topic: str, payload: dict):
-    camera = (payload.get("after", {}) or {}).get("camera") or payload.get("camera") or ""
-    plate, score = _extract_plate(payload)
+_EVENT_COLUMNS = (
+    "server", "frigate_event_id", "topic", "event_type", "camera", "ts", "payload_json",
+    "snapshot_path", "clip_path", "plate_crop_path", "plate", "speed", "score", "repeat_of",
+)
+_INSERT_EVENT_SQL = (
+    f"INSERT OR IGNORE INTO events({', '.join(_EVENT_COLUMNS)}) "
+    f"VALUES({','.join('?' * len(_EVENT_COLUMNS))})"
+)
+
+
+_UPSERT_PLATE_SQL = """
+    INSERT INTO plates(plate, first_seen, last_seen, visits, last_camera, last_server, best_score)
+    VALUES(?,?,?,?,?,?,?)
+    ON CONFLICT(plate) DO UPDATE SET
+        visits = visits + excluded.visits,
+        first_seen = MIN(first_seen, excluded.first_seen),
+        last_camera = CASE WHEN excluded.last_seen >= last_seen THEN excluded.last_camera ELSE last_camera END,
+        last_server = CASE WHEN excluded.last_seen >= last_seen THEN excluded.last_server ELSE last_server END,
+        last_seen = MAX(last_seen, excluded.last_seen),
+        best_score = MAX(COALESCE(best_score, -1), COALESCE(excluded.best_score, -1))
+"""
+_UPSERT_PLATE_DAY_SQL = """
+    INSERT INTO plate_days(plate, day, camera, count) VALUES(?,?,?,1)
+    ON CONFLICT(plate, day, camera) DO UPDATE SET count = count + 1
+"""
+
+
+_CLEAR_MEDIA_SQL = (
+    "UPDATE events SET snapshot_path = NULL, clip_path = NULL, plate_crop_path = NULL "
+    "WHERE server = ? AND frigate_event_id = ?"
+)
+
+
+_MARK_SUPERSEDED_SQL = "INSERT OR IGNORE INTO media_superseded(server, frigate_event_id) VALUES(?,?)"
+_TAKE_SUPERSEDED_SQL = "DELETE FROM media_superseded WHERE server = ? AND frigate_event_id = ?"
+_MEDIA_COLUMNS = ("snapshot_path", "clip_path", "plate_crop_path")
+
+
+_DEFER_CLIP_SQL = "INSERT OR IGNORE INTO deferred_clips(server, frigate_event_id, camera, ts) VALUES(?,?,?,?)"
+_DROP_DEFERRED_CLIP_SQL = "DELETE FROM deferred_clips WHERE server = ? AND frigate_event_id = ?"
+
+
+# When a read was seen: its frame time, or for reads without one the insert time,
+# as local ISO text like ts. Live updates and rebuilds must both use it.
+_SEEN_SQL = "COALESCE(ts, strftime('%Y-%m-%dT%H:%M:%S', created_at, 'localtime'))"
+
+
+def _seen_between(lo: str | None, hi: str | None) -> tuple[str, list]:
+    """WHERE condition for reads seen in [lo, hi) (either bound may be None).
+
+    Matches ts, or _SEEN_SQL for reads without ts; both branches use idx_events_ts.
+    """
+    bounds = [(op, v) for op, v in ((">=", lo), ("<", hi)) if v is not None]
+    vals = [v for _, v in bounds]
+    by_ts = " AND ".join(f"ts {op} ?" for op, _ in bounds)
+    by_seen = " AND ".join(f"{_SEEN_SQL} {op} ?" for op, _ in bounds)
+    return f"(({by_ts}) OR (ts IS NULL AND {by_seen}))", vals + vals
+
+
+def _store_event(cur: sqlite3.Cursor, row: dict) -> bool:
+    """Insert one event row inside the caller's transaction. True if it was new.
+
+    Repeat reads (repeat_of set) update the plate's last sighting but do not
+    count as a new visit.
+    """
+    if row.get("inbox_id"):
+        # The message is done once its event row is written (or was already there)
+        cur.execute("DELETE FROM inbox WHERE id = ?", (row["inbox_id"],))
+    cur.execute(_INSERT_EVENT_SQL, tuple(row.get(c) for c in _EVENT_COLUMNS))
+    if cur.rowcount != 1:
+        return False
+    event_rowid = cur.lastrowid
+    if row.get("clear_media_of"):
+        # This read replaced an earlier one of the same group as media holder
+        cur.execute(_CLEAR_MEDIA_SQL, (row["server"], row["clear_media_of"]))
+        if cur.rowcount == 0:
+            # Rows of different downloads arrive in any order: the earlier holder's
+            # insert finds this mark and drops its media instead
+            cur.execute(_MARK_SUPERSEDED_SQL, (row["server"], row["clear_media_of"]))
+        cur.execute(_DROP_DEFERRED_CLIP_SQL, (row["server"], row["clear_media_of"]))
+    if any(row.get(c) for c in _MEDIA_COLUMNS) or row.get("clip_deferred"):
+        if cur.execute(_TAKE_SUPERSEDED_SQL, (row["server"], row["frigate_event_id"])).rowcount:
+            cur.execute(_CLEAR_MEDIA_SQL, (row["server"], row["frigate_event_id"]))
+            row = {**row, "clip_deferred": False}
+    if row.get("clip_deferred"):
+        cur.execute(_DEFER_CLIP_SQL, (row["server"], row["frigate_event_id"], row["camera"], row["ts"]))
+    plate = row["plate"]
+    if plate:
+        seen = row["ts"] or cur.execute(f"SELECT {_SEEN_SQL} FROM events WHERE rowid = ?", (event_rowid,)).fetchone()[0]
+        camera = row["camera"] or ""
+        repeat = bool(row.get("repeat_of"))
+        if not repeat:
+            prev = cur.execute(
+                "SELECT last_server, last_camera, last_seen FROM plates WHERE plate = ?", (plate,)
+            ).fetchone()
+            if prev is not None:
+                _link_sighting(cur, plate, prev, (row["server"], camera, seen))
+        cur.execute(_UPSERT_PLATE_SQL, (plate, seen, seen, 0 if repeat else 1, camera, row["server"], row["score"]))
+        if not repeat:
+            cur.execute(_UPSERT_PLATE_DAY_SQL, (plate, seen[:10], camera))
+        _add_hourly(cur, row["server"], camera, seen[:13], plate, row["score"], row["speed"])
+    return True
+
+
+_INSERT_TRANSITION_SQL = """
+    INSERT INTO plate_transitions(plate, from_server, from_camera, from_ts, to_server, to_camera, to_ts, seconds)
+    VALUES(?,?,?,?,?,?,?,?)
+"""
+
+
+def _seconds_between(a: str, b: str) -> float:
+    try:
+        return (datetime.fromisoformat(b) - datetime.fromisoformat(a)).total_seconds()
+    except ValueError:
+        return 0.0
+
+
+def _add_transition(cur: sqlite3.Cursor, plate: str, frm: tuple, to: tuple) -> None:
+    cur.execute(_INSERT_TRANSITION_SQL, (plate, *frm, *to, _seconds_between(frm[2], to[2])))
+
+
+def _link_sighting(cur: sqlite3.Cursor, plate: str, last: tuple, new: tuple) -> None:
+    """Link a new sighting (server, camera, seen) into the plate's trajectory.
+
+    Times are compared as text, so every one must come from _SEEN_SQL's form.
+
+    `last` is the plate's latest sighting before this one, from the plates
+    summary. Reads usually arrive in order and append last -> new; a late read
+    splits the transition that spans it (or precedes the first sighting).
+    """
+    if new[2] >= (last[2] or ""):
+        _add_transition(cur, plate, last, new)
+        return
+    nxt = cur.execute(
+        "SELECT rowid, from_server, from_camera, from_ts, to_server, to_camera, to_ts FROM plate_transitions "
+        "WHERE plate = ? AND to_ts > ? ORDER BY to_ts LIMIT 1",
+        (plate, new[2]),
+    ).fetchone()
+    if nxt is None:
+        # Only one earlier-recorded sighting: it comes after this one
+        _add_transition(cur, plate, new, last)
+        return
+    rowid, frm, to = nxt[0], tuple(nxt[1:4]), tuple(nxt[4:7])
+    if frm[2] <= new[2]:
+        cur.execute("DELETE FROM plate_transitions WHERE rowid = ?", (rowid,))
+        _add_transition(cur, plate, frm, new)
+        _add_transition(cur, plate, new, to)
+    else:
+        # Earlier than the first known sighting
+        _add_transition(cur, plate, new, frm)
+
+
+def _rebuild_transitions(cur: sqlite3.Cursor) -> None:
+    """Regenerate plate_transitions from events: each non-repeat read linked to the read before it."""
+    cur.execute("DELETE FROM plate_transitions")
+    # Read through a second cursor so inserts stream instead of loading every event
+    src = cur.connection.execute(
+        f"""
+        SELECT plate, prev_server, prev_camera, prev_t, server, camera, t FROM (
+            SELECT plate, server, COALESCE(camera, '') AS camera, {_SEEN_SQL} AS t, repeat_of,
+                   LAG(server) OVER w AS prev_server,
+                   LAG(COALESCE(camera, '')) OVER w AS prev_camera,
+                   LAG({_SEEN_SQL}) OVER w AS prev_t
+            FROM events WHERE plate IS NOT NULL AND plate <> ''
+            WINDOW w AS (PARTITION BY plate ORDER BY {_SEEN_SQL}, id)
+        ) WHERE prev_t IS NOT NULL AND repeat_of IS NULL
+        """
+    )
+    cur.executemany(
+        _INSERT_TRANSITION_SQL,
+        ((r[0], r[1], r[2], r[3], r[4], r[5], r[6], _seconds_between(r[3], r[6])) for r in src),
+    )
+
+
+_UPSERT_HOURLY_SQL = """
+    INSERT INTO lpr_hourly(server, camera, hour, reads, unique_plates, score_sum, score_n, speed_sum, speed_n, speed_max)
+    VALUES(?,?,?,1,?,?,?,?,?,?)
+    ON CONFLICT(server, camera, hour) DO UPDATE SET
+        reads = reads + 1,
+        unique_plates = unique_plates + excluded.unique_plates,
+        score_sum = score_sum + excluded.score_sum,
+        score_n = score_n + excluded.score_n,
+        speed_sum = speed_sum + excluded.speed_sum,
+        speed_n = speed_n + excluded.speed_n,
+        speed_max = MAX(COALESCE(speed_max, excluded.speed_max), COALESCE(excluded.speed_max, speed_max))
+"""
+# Plates already counted per hour are only needed while late reads can still arrive
+_HOURLY_PLATES_KEEP_DAYS = 2
+
+
+def _add_hourly(cur: sqlite3.Cursor, server: str, camera: str, hour: str, plate: str,
+                score: float | None, speed: float | None) -> None:
+    """Add one read to the (server, camera, hour) rollup. hour is "YYYY-MM-DDTHH"."""
+    cur.execute("INSERT OR IGNORE INTO lpr_hourly_plates(server, camera, hour, plate) VALUES(?,?,?,?)",
+                (server, camera, hour, plate))
+    has_score = score is not None and score >= 0
+    cur.execute(_UPSERT_HOURLY_SQL, (
+        server, camera, hour, cur.rowcount,
+        score if has_score else 0, 1 if has_score else 0,
+        speed or 0, 0 if speed is None else 1, speed,
+    ))
+
+
+def _rebuild_hourly(cur: sqlite3.Cursor) -> None:
+    """Regenerate lpr_hourly (and the recent part of lpr_hourly_plates) from events."""
+    hour = f"substr({_SEEN_SQL}, 1, 13)"
+    cur.execute("DELETE FROM lpr_hourly")
+    cur.execute("DELETE FROM lpr_hourly_plates")
+    cur.execute(
+        f"""
+        INSERT INTO lpr_hourly(server, camera, hour, reads, unique_plates, score_sum, score_n, speed_sum, speed_n, speed_max)
+        SELECT server, COALESCE(camera, ''), {hour}, COUNT(*), COUNT(DISTINCT plate),
+               COALESCE(SUM(CASE WHEN score >= 0 THEN score END), 0), COUNT(CASE WHEN score >= 0 THEN 1 END),
+               COALESCE(SUM(speed), 0), COUNT(speed), MAX(speed)
+        FROM events WHERE plate IS NOT NULL AND plate <> ''
+        GROUP BY 1, 2, 3
+        """
+    )
+    since = (date.today() - timedelta(days=_HOURLY_PLATES_KEEP_DAYS)).isoformat()
+    cur.execute(
+        f"""
+        INSERT OR IGNORE INTO lpr_hourly_plates(server, camera, hour, plate)
+        SELECT server, COALESCE(camera, ''), {hour}, plate
+        FROM events WHERE plate IS NOT NULL AND plate <> '' AND {_SEEN_SQL} >= ?
+        """,
+        (since,),
+    )
+
+
+def _rebuild_plate_summary(cur: sqlite3.Cursor) -> None:
+    """Regenerate plates/plate_days from the raw events table."""
+    cur.execute("DELETE FROM plates")
+    cur.execute("DELETE FROM plate_days")
+    cur.execute(
+        f"""
+        INSERT INTO plate_days(plate, day, camera, count)
+        SELECT plate, substr({_SEEN_SQL}, 1, 10), COALESCE(camera, ''), COUNT(*)
+        FROM events WHERE plate IS NOT NULL AND plate <> '' AND repeat_of IS NULL
+        GROUP BY 1, 2, 3
+        """
+    )
+    cur.execute(
+        f"""
+        WITH s AS (
+            SELECT plate, {_SEEN_SQL} AS t, COALESCE(camera, '') AS camera, server, score, repeat_of,
+                   ROW_NUMBER() OVER (PARTITION BY plate ORDER BY {_SEEN_SQL} DESC, id DESC) AS rn
+            FROM events WHERE plate IS NOT NULL AND plate <> ''
+        )
+        INSERT INTO plates(plate, first_seen, last_seen, visits, last_camera, last_server, best_score)
+        SELECT plate, MIN(t), MAX(t), SUM(repeat_of IS NULL),
+               MAX(CASE WHEN rn = 1 THEN camera END), MAX(CASE WHEN rn = 1 THEN server END),
+               MAX(COALESCE(score, -1))
+        FROM s GROUP BY plate
+        """
+    )
+    _rebuild_transitions(cur)
+
+
+def _log_stored(row: dict) -> None:
+    log.info(
+        "✅ [LPR] DB OK | 🆔 %s | 📷 %s | 🚗 %s | 🏁 %.2f | 💯 %.2f | 🖼️ %s | 🎬 %s | # %s",
+        row["frigate_event_id"],
+        row["camera"],
+        row["plate"],
+        row["speed"] if row["speed"] is not None else -1,
+        row["score"] if row["score"] is not None else -1,
+        row["snapshot_path"],
+        row["clip_path"],
+        row["plate_crop_path"],
+    )
+
+
+_WRITE_ATTEMPTS = 3
+# Called by the writer with every committed batch (used by bench_listener.py)
+_after_commit: Callable[[list[dict]], None] | None = None
+
+
+def _write_rows(con: sqlite3.Connection, rows: list[dict]) -> list[tuple]:
+    """Write a batch of event rows and inbox records in a single transaction.
+
+    Returns (worker, token, inbox_id) for each inbox record, only once committed.
+    """
+    for attempt in range(_WRITE_ATTEMPTS):
+        inboxed: list[tuple] = []
+        stale_files: list[str] = []
+        try:
+            with con:
+                cur = con.cursor()
+                for row in rows:
+                    if "inbox" in row:
+                        cur.execute("INSERT INTO inbox(server, topic, payload) VALUES(?,?,?)",
+                                    (row["server"], row["topic"], row["payload"]))
+                        inboxed.append((row.get("worker"), row["inbox"], cur.lastrowid))
+                    elif _store_event(cur, row):
+                        stale_files.extend(row.get("stale_files") or ())
+            break
+        except sqlite3.OperationalError as e:
+            # Typically "database is locked"; the batch may hold unacknowledged messages, so retry
+            if attempt + 1 < _WRITE_ATTEMPTS:
+                log.warning("DB batch write failed (%s), retrying", e)
+                time.sleep(0.5 * (attempt + 1))
+                continue
+            _log_write_error(rows, e)
+            return []
+        except Exception as e:
+            _log_write_error(rows, e)
+            return []
+    # The previous holders' rows no longer point at these files (or never will)
+    _remove_files(stale_files)
+    for row in rows:
+        if "inbox" not in row:
+            _log_stored(row)
+    if _after_commit is not None:
+        _after_commit(rows)
+    return inboxed
+
+
+def _log_write_error(rows: list[dict], e: Exception) -> None:
+    for row in rows:
+        if "inbox" in row:
+            log.error("❌ [LPR] Error al escribir inbox | server=%s | error=%s", row["server"], e)
+        else:
+            log.error("❌ [LPR] Error al escribir en DB | id=%s | cam=%s | plate=%s | error=%s",
+                      row["frigate_event_id"], row["camera"], row["plate"], e)
+
+
+def _write_rows_direct(row: dict) -> None:
+    con = sqlite3.connect(DB_PATH)
+    try:
+        _write_rows(con, [row])
+    finally:
+        con.close()
+
+
+def _next_batch(q, limit: int) -> list[dict] | None:
+    """Block for one item, then take whatever else is already queued (group commit). None on sentinel."""
+    row = q.get()
+    if row is None:
+        return None
+    batch = [row]
+    while len(batch) < limit:
+        try:
+            nxt = q.get_nowait()
+        except queue.Empty:
+            break
+        if nxt is None:
+            q.put(None)
+            break
+        batch.append(nxt)
+    return batch
+
+
+class _DbWriter:
+    """Writer thread for single-process mode: group-commits event rows and inbox records."""
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.q: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, row: dict) -> None:
+        self.q.put(row)
+
+    def _run(self) -> None:
+        con = sqlite3.connect(DB_PATH)
+        while True:
+            batch = _next_batch(self.q, _WRITER_BATCH)
+            if batch is None:
+                break
+            done = _write_rows(con, batch)
+            if done:
+                _inbox_committed(done)
+        con.close()
+
+
+_db_writer: _DbWriter | None = None
+
+
+def _start_db_writer() -> None:
+    global _db_writer, _event_sink
+    _db_writer = _DbWriter()
+    _db_writer.start()
+    _event_sink = _db_writer.put
+
+
+# Where finished event rows and inbox records go: direct SQLite write, the writer
+# thread, or the writer process queue in sharded mode
+_event_sink: Callable[[dict], None] = _write_rows_direct
+_download_pool: ThreadPoolExecutor | None = None
+_ingest_stats = {"received": 0, "persisted": 0, "ignored": 0, "repeats": 0, "media_replaced": 0, "last_event_ts": None}
+# Updated from the MQTT loop and every _download_pool thread
+_ingest_lock = threading.Lock()
+
+
+def _ingest_add(key: str, n: int = 1) -> None:
+    with _ingest_lock:
+        _ingest_stats[key] += n
+
+
+def _ingest_snapshot() -> dict:
+    with _ingest_lock:
+        return dict(_ingest_stats)
+
+
+# ---------------- Repeat-read suppression ----------------
+class _RecentReads:
+    """Recent reads per (server, camera, plate) for collapsing repeat reads.
+
+    A read opens a group unless the same plate was read on the same camera less
+    than `window` seconds before; later reads join the group as repeats. Only
+    the best-scoring read of a group keeps media. window <= 0 disables it.
+    """
+
+    def __init__(self, window: float = 0.0) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        # key -> {"first", "last", "best", "best_score", "holder": (event_id, files) | None}
+        self._groups: "OrderedDict[tuple, dict]" = OrderedDict()
+
+    def claim(self, key: tuple, event_id: str, score: float, now: float) -> tuple[str | None, bool]:
+        """(repeat_of, download) for a read about to be persisted."""
+        if self.window <= 0:
+            return None, True
+        with self._lock:
+            # Groups are kept in last-read order; drop the ones that went quiet
+            while self._groups:
+                oldest = next(iter(self._groups.values()))
+                if now - oldest["last"] <= self.window:
+                    break
+                self._groups.popitem(last=False)
+            g = self._groups.get(key)
+            if g is None:
+                self._groups[key] = {"first": event_id, "last": now, "best": event_id,
+                                     "best_score": score, "holder": None}
+                return None, True
+            g["last"] = now
+            self._groups.move_to_end(key)
+            if score > g["best_score"]:
+                g["best"], g["best_score"] = event_id, score
+                return g["first"], True
+            return g["first"], False
+
+    def settle(self, key: tuple, event_id: str, files: list[str]) -> tuple[bool, str | None, list[str]]:
+        """After downloading: (keep, previous holder id, previous holder files).
+
+        Downloads run concurrently, so a read may finish after a better one
+        claimed the group; it then drops its own media instead.
+        """
+        with self._lock:
+            g = self._groups.get(key)
+            if g is None:
+                return True, None, []
+            if g["best"] != event_id:
+                return False, None, []
+            prev, g["holder"] = g["holder"], (event_id, files)
+        return (True, prev[0], prev[1]) if prev else (True, None, [])
+
+
+_recent_reads = _RecentReads()
+
+
+def _remove_files(paths: list[str]) -> None:
+    for p in paths:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def _persist_event(server_name: str, ev: FrigateEvent, topic: str, inbox_id: int | None = None):
+    event_id, camera, plate, score = ev.id, ev.camera, ev.plate, ev.score
     if not plate:
+        _ingest_add("ignored")
         log.info("⏭️  Evento ignorado (sin matrícula detectada) | id=%s | cam=%s", event_id, camera)
         return
-    ts_raw = (payload.get("after", {}) or {}).get("frame_time") or payload.get("time") or payload.get("timestamp")
-    ts: datetime | None = None
+    ts = ev.ts
+
+    key = (server_name, camera or "", plate)
+    repeat_of, download = _recent_reads.claim(key, event_id, score, time.monotonic())
+    art = {"snapshot": None, "clip": None, "plate": None, "clip_deferred": False}
+    clear_media_of, stale_files = None, []
+    if download:
+        art = _download_artifacts(_servers[server_name], camera or "", event_id, ts)
+        files = [os.path.join(MEDIA_DIR, art[k]) for k in ("snapshot", "clip", "plate") if art[k]]
+        keep, clear_media_of, stale_files = _recent_reads.settle(key, event_id, files)
+        if not keep:
+            _remove_files(files)
+            art = dict.fromkeys(art)
+    if repeat_of:
+        _ingest_add("repeats")
+        log.info("🔁 Lectura repetida | id=%s | cam=%s | plate=%s | primera=%s | medios=%s",
+                 event_id, camera, plate, repeat_of, "sí" if any(art.values()) else "no")
+    row = {
+        "server": server_name,
+        "frigate_event_id": event_id,
+        "topic": topic,
+        "event_type": ev.type,
+        "camera": camera,
+        "ts": ts.isoformat() if ts else None,
+        "payload_json": ev.raw_text,
+        "snapshot_path": art["snapshot"],
+        "clip_path": art["clip"],
+        "plate_crop_path": art["plate"],
+        "plate": plate,
+        "speed": ev.speed,
+        "score": score,
+        "repeat_of": repeat_of,
+        "inbox_id": inbox_id,
+    }
+    if art["clip_deferred"]:
+        row["clip_deferred"] = True
+    if clear_media_of:
+        # The writer clears the previous holder's media and deletes these files once committed
+        row["clear_media_of"] = clear_media_of
+        row["stale_files"] = stale_files
+    _event_sink(row)
+    if clear_media_of:
+        _ingest_add("media_replaced")
+    with _ingest_lock:
+        _ingest_stats["persisted"] += 1
+        _ingest_stats["last_event_ts"] = time.time()
+
+
+def _persist_event_safe(server_name: str, ev: FrigateEvent, topic: str, inbox_id: int | None = None) -> None:
     try:
-        if isinstance(ts_raw, (int, float)):
-            ts = datetime.fromtimestamp(float(ts_raw))
-        elif isinstance(ts_raw, str):
-            ts = dtparser.parse(ts_raw)
-    except Exception:
-        ts = None
+        _persist_event(server_name, ev, topic, inbox_id)
+    except Exception as e:
+        log.error("❌ [LPR] Error procesando evento | id=%s | cam=%s | error=%s", ev.id, ev.camera, e)
+
+
+def _dispatch(server_name: str, ev: FrigateEvent, topic: str, inbox_id: int | None = None) -> None:
+    # Downloads run on the pool so the MQTT loop keeps reading
+    if _download_pool is not None:
+        _download_pool.submit(_persist_event_safe, server_name, ev, topic, inbox_id)
+    else:
+        _persist_event_safe(server_name, ev, topic, inbox_id)
+
+
+# ---------------- Deferred clips ----------------
+# Clips skipped while a server was over its bandwidth budget wait in
+# deferred_clips (written with the event row) and are fetched, oldest first,
+# once the budget has room again.
+_DEFERRED_CLIP_INTERVAL = 60.0
+_DEFERRED_CLIP_BATCH = 20
+_DEFERRED_CLIP_MAX_ATTEMPTS = 3
+
+
+def _fetch_deferred_clips(server_name: str) -> int:
+    """Fetch queued clips for one server while it stays under budget. Returns clips saved."""
+    server = _servers.get(server_name)
+    meter = _meter(server_name)
+    if server is None or meter.over_budget():
+        return 0
+    saved = 0
+    transport = sftp = None
+    con = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        with con:
+            dropped = con.execute("DELETE FROM deferred_clips WHERE server = ? AND attempts >= ?",
+                                  (server_name, _DEFERRED_CLIP_MAX_ATTEMPTS)).rowcount
+        if dropped:
+            log.error("[%s] %d clip(s) diferidos descartados tras %d intentos", server_name, dropped,
+                      _DEFERRED_CLIP_MAX_ATTEMPTS)
+        pending = con.execute(
+            "SELECT frigate_event_id, camera, ts FROM deferred_clips WHERE server = ? ORDER BY ts LIMIT ?",
+            (server_name, _DEFERRED_CLIP_BATCH),
+        ).fetchall()
+        if pending and (server.get("sftp_clip_mode") or "api").lower() == "sftp" and server.get("sftp_host"):
+            try:
+                transport, sftp = _open_sftp(server)
+            except Exception as e:
+                log.warning("[%s] SFTP connect failed: %s", server_name, e)
+                return 0
+        for event_id, camera, ts in pending:
+            if meter.over_budget():
+                break
+            with con:
+                con.execute("UPDATE deferred_clips SET attempts = attempts + 1 WHERE server = ? AND frigate_event_id = ?",
+                            (server_name, event_id))
+            try:
+                when = datetime.fromisoformat(ts) if ts else None
+            except ValueError:
+                when = None
+            dest = _media_paths(server_name, camera or "", event_id, when)["clip"]
+            try:
+                _fetch_clip(server, camera or "", event_id, dest, sftp, _sftp_host_key(server))
+            except Exception as e:
+                log.warning("[%s] Deferred clip download failed (%s): %s", server_name, event_id, e)
+                continue
+            with con:
+                con.execute("UPDATE events SET clip_path = ? WHERE server = ? AND frigate_event_id = ?",
+                            (os.path.relpath(dest, MEDIA_DIR), server_name, event_id))
+                con.execute(_DROP_DEFERRED_CLIP_SQL, (server_name, event_id))
+            saved += 1
+    finally:
+        if sftp is not None:
+            sftp.close(); transport.close()
+        con.close()
+    if saved:
+        log.info("[%s] 🎬 %d clip(s) diferidos descargados", server_name, saved)
+    return saved
+
+
+def _deferred_clip_loop(server_names: list[str]) -> None:
+    while True:
+        time.sleep(_DEFERRED_CLIP_INTERVAL)
+        for name in server_names:
+            try:
+                _fetch_deferred_clips(name)
+            except Exception as e:
+                log.error("[%s] Deferred clip loop error: %s", name, e)
+
+
+def _deferred_clip_counts() -> Dict[str, int]:
+    try:
+        return {r["server"]: r["n"] for r in _db_query("SELECT server, COUNT(*) AS n FROM deferred_clips GROUP BY server")}
+    except sqlite3.Error:
+        return {}
+
+
+# ---------------- At-least-once delivery (QoS 1) ----------------
+# With mqtt_qos >= 1 the client keeps a persistent session and acknowledges by
+# hand: a message is acked once it is done, which for plate reads means its
+# payload is committed to the inbox table. The event row later deletes the
+# inbox row in its own transaction; leftovers are replayed on startup.
+_ACK_STALL_SECONDS = 120.0
+_INBOX_MAX_ATTEMPTS = 3
+_ack_trackers: Dict[str, "_AckTracker"] = {}
+_inbox_pending: Dict[tuple, tuple] = {}  # token -> (server_name, ev, topic)
+_worker_idx: int | None = None
+
+
+class _AckTracker:
+    """Sends PUBACKs in arrival order (MQTT 3.1.1 requires it) as messages complete."""
+
+    _generations = itertools.count(1)
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self._lock = threading.Lock()
+        self._pending: deque = deque()  # [seq, mid, qos, done, received_at]
+        self._by_seq: Dict[int, list] = {}
+        self._seq = 0
+        self.gen = (os.getpid(), next(self._generations))
+        self.acked = 0
+
+    def reset(self) -> None:
+        """New connection: packet ids of the previous one must not be acked on it."""
+        with self._lock:
+            self._pending.clear()
+            self._by_seq.clear()
+            self.gen = (os.getpid(), next(self._generations))
+
+    def add(self, mid: int, qos: int) -> tuple:
+        with self._lock:
+            self._seq += 1
+            entry = [self._seq, mid, qos, False, time.monotonic()]
+            self._pending.append(entry)
+            self._by_seq[self._seq] = entry
+            return self.gen, self._seq
+
+    def complete(self, gen: tuple, seq: int) -> None:
+        with self._lock:
+            if gen != self.gen:
+                return
+            entry = self._by_seq.pop(seq, None)
+            if entry is None:
+                return
+            entry[3] = True
+            # Acks go out under the lock so concurrent completions keep the order
+            while self._pending and self._pending[0][3]:
+                head = self._pending.popleft()
+                self.client.ack(head[1], head[2])
+                self.acked += 1
 
-    art = _download_artifacts(_servers[server_name], camera or "", event_id, ts)
+    def status(self) -> dict:
+        with self._lock:
+            oldest = time.monotonic() - self._pending[0][4] if self._pending else 0.0
+            return {"pending": len(self._pending), "acked": self.acked, "oldest_pending_s": round(oldest, 1)}
 
-    def _extract_speed(p: dict) -> float | None:
+
+def _drop_stale_pending(server_name: str, gen: tuple | None) -> None:
+    """Forget inbox payloads of earlier connections: the broker redelivers them under new tokens.
+
+    If one of them still commits, its inbox row is replayed on the next start.
+    """
+    for token in [t for t in list(_inbox_pending) if t[0] == server_name and t[1] != gen]:
+        _inbox_pending.pop(token, None)
+
+
+def _ack_done(token: tuple | None) -> None:
+    if token is None:
+        return
+    tracker = _ack_trackers.get(token[0])
+    if tracker is not None:
+        tracker.complete(token[1], token[2])
+
+
+def _inbox_committed(done: list[tuple]) -> None:
+    """Inbox records are durable: ack them and start their downloads."""
+    for _, token, inbox_id in done:
+        pending = _inbox_pending.pop(token, None)
+        _ack_done(token)
+        if pending is not None:
+            _dispatch(*pending, inbox_id)
+
+
+def _replay_inbox(server_names: list[str]) -> None:
+    """Process messages that were acked but whose event was never written."""
+    if not server_names:
+        return
+    marks = ",".join("?" * len(server_names))
+    con = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        with con:
+            dropped = con.execute(
+                f"DELETE FROM inbox WHERE attempts >= ? AND server IN ({marks})", (_INBOX_MAX_ATTEMPTS, *server_names)
+            ).rowcount
+            con.execute(f"UPDATE inbox SET attempts = attempts + 1 WHERE server IN ({marks})", tuple(server_names))
+        rows = con.execute(
+            f"SELECT id, server, topic, payload FROM inbox WHERE server IN ({marks}) ORDER BY id", tuple(server_names)
+        ).fetchall()
+    finally:
+        con.close()
+    if dropped:
+        log.error("❌ [LPR] %d mensaje(s) del inbox descartados tras %d intentos", dropped, _INBOX_MAX_ATTEMPTS)
+    for inbox_id, server_name, topic, payload in rows:
         try:
-            after = p.get("after") or {}
-            val = after.get("current_estimated_speed")
-            if isinstance(val, (int, float)):
-                return float(val)
-            if isinstance(val, str):
-                try:
-                    return float(val)
-                except Exception:
-                    pass
-            for key_path in (
-                ("speed",),
-                ("current_estimated_speed",),
-                ("vehicle", "speed"),
-                ("attributes", "speed"),
-            ):
-                obj = after
-                for k in key_path:
-                    if isinstance(obj, dict) and k in obj:
-                        obj = obj.get(k)
-                    else:
-                        obj = None
-                        break
-                if isinstance(obj, (int, float)):
-                    return float(obj)
-                if isinstance(obj, str):
-                    try:
-                        return float(obj)
-                    except Exception:
-                        pass
-            val = p.get("speed") or p.get("current_estimated_speed")
-            if isinstance(val, (int, float)):
-                return float(val)
-            if isinstance(val, str):
-                try:
-                    return float(val)
-                except Exception:
-                    pass
+            ev = decode_event(payload)
         except Exception:
-            return None
-        return None
+            ev = None
+        if ev is None or not ev.id or server_name not in _servers:
+            continue
+        _dispatch(server_name, ev, topic, inbox_id)
+    if rows:
+        log.info("🔁 Reprocesando %d mensaje(s) pendientes del inbox", len(rows))
 
-    spd = _extract_speed(payload)
 
-    try:
-        _db_execute(
-            """
-            INSERT OR IGNORE INTO events(server, frigate_event_id, topic, event_type, camera, ts, payload_json, snapshot_path, clip_path, plate_crop_path, plate, speed, score)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                server_name,
-                event_id,
-                topic,
-                payload.get("type"),
-                camera,
-                ts.isoformat() if ts else None,
-                json.dumps(payload, ensure_ascii=False),
-                art["snapshot"],
-                art["clip"],
-                art["plate"],
-                plate,
-                spd,
-                score,
-            ),
-        )
-        log.info(
-            "✅ [LPR] DB OK | 🆔 %s | 📷 %s | 🚗 %s | 🏁 %.2f | 💯 %.2f | 🖼️ %s | 🎬 %s | # %s",
-            event_id,
-            camera,
-            plate,
-            spd if spd is not None else -1,
-            score if score is not None else -1,
-            art["snapshot"],
-            art["clip"],
-            art["plate"],
-        )
-    except Exception as e:
-        log.error("❌ [LPR] Error al escribir en DB | id=%s | cam=%s | plate=%s | error=%s", event_id, camera, plate, e)
+def _check_ack_stalls() -> None:
+    """Reconnect clients whose oldest unacked message is stuck (e.g. a lost inbox batch).
+
+    The broker redelivers everything unacked on the persistent session.
+    """
+    for name, tracker in list(_ack_trackers.items()):
+        st = tracker.status()
+        if st["oldest_pending_s"] > _ACK_STALL_SECONDS and name in _servers:
+            log.warning("[%s] %d message(s) unacked for %.0fs, reconnecting", name, st["pending"], st["oldest_pending_s"])
+            _connect_server(_servers[name])
 
 
 def _on_message(server_name: str):
     def handler(client, userdata, msg):
+        tracker = _ack_trackers.get(server_name) if msg.qos > 0 else None
+        token = (server_name, *tracker.add(msg.mid, msg.qos)) if tracker is not None else None
+        # Only "end" messages are persisted; skip new/update without parsing them
+        ev_type = peek_type(msg.payload)
+        if ev_type is not None and ev_type != "end":
+            _ack_done(token)
+            return
         try:
-            payload = json.loads(msg.payload.decode("utf-8", errors="replace"))
+            ev = decode_event(msg.payload)
         except Exception as e:
             log.warning("[%s] Bad JSON on topic %s: %s", server_name, msg.topic, e)
+            _ack_done(token)
             return
-        ev_id = (payload.get("after", {}) or {}).get("id") or payload.get("id")
-        if not ev_id:
+        if ev is None or not ev.id or ev.type != "end":
+            _ack_done(token)
             return
-        key = f"{server_name}|{ev_id}"
-        _cache.setdefault(key, {"topic": msg.topic, "payload": payload})
-        _cache[key].update({"topic": msg.topic, "payload": payload})
-
-        if payload.get("type") == "end":
-            try:
-                _persist_event(server_name, ev_id, msg.topic, payload)
-            finally:
-                _cache.pop(key, None)
+        _ingest_add("received")
+        if token is not None and ev.plate:
+            # Ack once the payload is committed to the inbox (see _inbox_committed)
+            _inbox_pending[token] = (server_name, ev, msg.topic)
+            _event_sink({"inbox": token, "worker": _worker_idx, "server": server_name,
+                         "topic": msg.topic, "payload": ev.raw_text})
+            return
+        _ack_done(token)
+        _dispatch(server_name, ev, msg.topic)
     return handler
 
 
+# mqtt_loop_threads > 0: all clients of this process run on these event loops (see mqtt_mux.py)
+_mqtt_muxes: list = []
+
+
+def _mux_for(name: str):
+    return _mqtt_muxes[zlib.crc32(name.encode("utf-8")) % len(_mqtt_muxes)]
+
+
 def _connect_server(server: Dict[str, Any]) -> None:
     name = server["name"]
-    if name in _clients:
+    if name in _clients and not _mqtt_muxes:
         try:
             _clients[name].disconnect()
         except Exception:
             pass
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"matriculas-{name}-{int(time.time())}")
+    qos = int(server.get("mqtt_qos", 1))
+    client_id = server.get("mqtt_client_id") or f"matriculas-{name}"
+    tracker = None
+    if qos > 0:
+        # Stable id + persistent session: the broker keeps queuing while we are away
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=False, manual_ack=True)
+        tracker = _AckTracker(client)
+        _ack_trackers[name] = tracker
+    else:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        _ack_trackers.pop(name, None)
+        _drop_stale_pending(name, None)
     if server.get("mqtt_user"):
         client.username_pw_set(server.get("mqtt_user"), server.get("mqtt_pass"))
-    client.on_connect = lambda c, u, f, rc, p: (log.info("[%s] MQTT connected to %s:%s", name, server.get("mqtt_broker"), server.get("mqtt_port")), c.subscribe(server.get("mqtt_topic", "frigate/events")))
+
+    def on_connect(c, u, flags, rc, props):
+        log.info("[%s] MQTT connected to %s:%s (qos=%d, session_present=%s)", name, server.get("mqtt_broker"),
+                 server.get("mqtt_port"), qos, getattr(flags, "session_present", None))
+        if tracker is not None:
+            tracker.reset()
+            _drop_stale_pending(name, tracker.gen)
+        c.subscribe(server.get("mqtt_topic", "frigate/events"), qos=qos)
+
+    client.on_connect = on_connect
     client.on_message = _on_message(name)
+    if _mqtt_muxes:
+        # The mux replaces the previous client of this server and handles (re)connects
+        _mux_for(name).add(name, client, server.get("mqtt_broker"), int(server.get("mqtt_port", 1883)), 60)
+        _clients[name] = client
+        return
     try:
         client.connect(server.get("mqtt_broker"), int(server.get("mqtt_port", 1883)), 60)
         threading.Thread(target=client.loop_forever, daemon=True).start()
@@ -557,23 +1609,181 @@ def _connect_server(server: Dict[str, Any]) -> None:
         log.error("[%s] MQTT connect failed: %s", name, e)
 
 
+def _mqtt_stats() -> dict:
+    """Per-broker state and message rate (msg/s); only tracked by the event loops."""
+    stats: dict = {}
+    for mux in _mqtt_muxes:
+        stats.update(mux.stats())
+    return stats
+
+
+def _start_ingest(server_names: list[str]) -> None:
+    """Start download workers and MQTT clients for the given servers in this process."""
+    global _download_pool
+    _download_pool = ThreadPoolExecutor(max_workers=_download_workers, thread_name_prefix="download")
+    if _mqtt_loop_threads > 0 and server_names and not _mqtt_muxes:
+        from mqtt_mux import MqttMux
+        for i in range(min(_mqtt_loop_threads, len(server_names))):
+            mux = MqttMux(name=f"mqtt-loop-{i}")
+            mux.start()
+            _mqtt_muxes.append(mux)
+        log.info("MQTT: %d client(s) on %d event loop thread(s)", len(server_names), len(_mqtt_muxes))
+    _replay_inbox(server_names)
+    for name in server_names:
+        _connect_server(_servers[name])
+    if server_names:
+        threading.Thread(target=_deferred_clip_loop, args=(server_names,), name="deferred-clips", daemon=True).start()
+
+
+# ---------------- Multi-process sharding ----------------
+# With [general] workers = N (N > 1) the [server:*] sections are split across N
+# worker processes. Each one runs its own MQTT clients and download pool and
+# sends finished rows to a single writer process; this process keeps serving HTTP.
+_WRITER_BATCH = 200
+_HEALTH_INTERVAL = 5.0
+_shard_procs: Dict[str, Any] = {}  # name -> multiprocessing.Process
+_worker_health: Dict[int, dict] = {}
+
+
+def _partition_servers(names: list[str], n: int) -> list[list[str]]:
+    shards: list[list[str]] = [[] for _ in range(n)]
+    for i, name in enumerate(sorted(names)):
+        shards[i % n].append(name)
+    return [s for s in shards if s]
+
+
+def _writer_main(rows_q, reply_qs) -> None:
+    """Single writer process: drains rows from all workers and commits them in batches.
+
+    Committed inbox records go back to their worker, which then acks them.
+    """
+    con = sqlite3.connect(DB_PATH)
+    while True:
+        batch = _next_batch(rows_q, _WRITER_BATCH)
+        if batch is None:
+            break
+        done = _write_rows(con, batch)
+        by_worker: Dict[int, list] = {}
+        for item in done:
+            by_worker.setdefault(item[0], []).append(item)
+        for idx, items in by_worker.items():
+            if idx is not None and idx < len(reply_qs):
+                reply_qs[idx].put(items)
+    con.close()
+
+
+def _inbox_reply_loop(reply_q) -> None:
+    while True:
+        try:
+            _inbox_committed(reply_q.get())
+        except Exception as e:
+            log.error("Inbox reply handling failed: %s", e)
+
+
+def _worker_main(idx: int, server_names: list[str], rows_q, health_q, reply_q) -> None:
+    global _event_sink, _worker_idx
+    load_config()
+    _event_sink = rows_q.put
+    _worker_idx = idx
+    threading.Thread(target=_inbox_reply_loop, args=(reply_q,), name="inbox-replies", daemon=True).start()
+    _start_ingest([n for n in server_names if n in _servers])
+    log.info("[WORKER %d] pid=%s servers=%s", idx, os.getpid(), ",".join(server_names))
+    while True:
+        try:
+            _check_ack_stalls()
+            health_q.put({
+                "worker": idx,
+                "pid": os.getpid(),
+                "ts": time.time(),
+                "servers": {n: bool(c.is_connected()) for n, c in _clients.items()},
+                "pending_downloads": _download_pool._work_queue.qsize() if _download_pool else 0,
+                "acks": {n: t.status() for n, t in _ack_trackers.items()},
+                "mqtt": _mqtt_stats(),
+                "bandwidth": {n: _meter(n).status() for n in server_names if n in _servers},
+                **_ingest_snapshot(),
+            })
+        except Exception as e:
+            log.warning("[WORKER %d] health report failed: %s", idx, e)
+        time.sleep(_HEALTH_INTERVAL)
+
+
+def _start_shards(n: int) -> None:
+    import multiprocessing  # lazy: single-process deployments never need it
+    ctx = multiprocessing.get_context("spawn")
+    rows_q = ctx.Queue(maxsize=10000)
+    health_q = ctx.Queue()
+    shards = _partition_servers(list(_servers.keys()), n)
+    reply_qs = [ctx.Queue() for _ in shards]
+    writer = ctx.Process(target=_writer_main, args=(rows_q, reply_qs), name="lpr-writer", daemon=True)
+    writer.start()
+    _shard_procs["writer"] = writer
+    specs = {}
+    for idx, names in enumerate(shards):
+        specs[idx] = names
+        _spawn_worker(ctx, idx, names, rows_q, health_q, reply_qs[idx])
+    log.info("Sharded ingestion: %d worker(s) + writer (pid=%s)", len(shards), writer.pid)
+    threading.Thread(target=_supervise_shards, args=(ctx, specs, rows_q, health_q, reply_qs), daemon=True).start()
+
+
+def _spawn_worker(ctx, idx: int, names: list[str], rows_q, health_q, reply_q) -> None:
+    proc = ctx.Process(target=_worker_main, args=(idx, names, rows_q, health_q, reply_q),
+                       name=f"lpr-worker-{idx}", daemon=True)
+    proc.start()
+    _shard_procs[f"worker-{idx}"] = proc
+
+
+def _supervise_shards(ctx, specs: Dict[int, list[str]], rows_q, health_q, reply_qs) -> None:
+    """Collect worker health reports and respawn workers that died."""
+    while True:
+        try:
+            report = health_q.get(timeout=_HEALTH_INTERVAL)
+            _worker_health[report["worker"]] = report
+        except queue.Empty:
+            pass
+        except Exception as e:
+            log.warning("Worker health read failed: %s", e)
+        for idx, names in specs.items():
+            proc = _shard_procs.get(f"worker-{idx}")
+            if proc is not None and not proc.is_alive():
+                log.error("[WORKER %d] died (exitcode=%s), restarting", idx, proc.exitcode)
+                _spawn_worker(ctx, idx, names, rows_q, health_q, reply_qs[idx])
+        writer = _shard_procs.get("writer")
+        if writer is not None and not writer.is_alive():
+            log.error("LPR writer process died (exitcode=%s), restarting", writer.exitcode)
+            writer = ctx.Process(target=_writer_main, args=(rows_q, reply_qs), name="lpr-writer", daemon=True)
+            writer.start()
+            _shard_procs["writer"] = writer
+
+
 @app.on_event("startup")
 def startup():
+    t_start = time.perf_counter()
     load_config()
     init_db()
-    for s in _servers.values():
-        _connect_server(s)
+    t_db = time.perf_counter()
+    if _workers > 1 and len(_servers) > 1:
+        _start_shards(min(_workers, len(_servers)))
+    else:
+        _start_db_writer()
+        _start_ingest(list(_servers.keys()))
     log.info("Service started. HTTP port configured: %s", _http_port)
     # Run initial cleanup and schedule daily at midnight
     threading.Thread(target=_cleanup_loop, daemon=True).start()
+    if _media_pack:
+        threading.Thread(target=_media_pack_loop, daemon=True).start()
     # Start stats writer
     threading.Thread(target=_stats_loop, daemon=True).start()
     # Start connectivity health check
     threading.Thread(target=_check_connectivity_loop, daemon=True).start()
+    t_end = time.perf_counter()
+    log.info("🚀 Arranque: imports %.0f ms | config+DB %.0f ms | ingesta+tareas %.0f ms | total %.0f ms",
+             (t_start - _MODULE_T0) * 1000, (t_db - t_start) * 1000, (t_end - t_db) * 1000,
+             (t_end - _MODULE_T0) * 1000)
 
 def _check_connectivity_loop():
     while True:
         try:
+            _check_ack_stalls()
             # MQTT: verificar que cada cliente esté conectado
             for name, client in _clients.items():
                 try:
@@ -588,6 +1798,7 @@ def _check_connectivity_loop():
                 url = server.get("frigate_url")
                 if url:
                     try:
+                        import requests
                         resp = requests.get(url.rstrip("/") + "/api/health", timeout=5)
                         if resp.status_code == 200:
                             log.info(f"[HEALTH] FRIGATE OK | server={name} | url={url}")
@@ -602,21 +1813,356 @@ def _check_connectivity_loop():
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "servers": list(_servers.keys())}
+    data = {"status": "ok", "servers": list(_servers.keys())}
+    if _shard_procs:
+        now = time.time()
+        data["workers"] = [
+            {**h, "alive": bool(_shard_procs.get(f"worker-{i}") and _shard_procs[f"worker-{i}"].is_alive()),
+             "stale": now - h.get("ts", 0) > 3 * _HEALTH_INTERVAL}
+            for i, h in sorted(_worker_health.items())
+        ]
+        writer = _shard_procs.get("writer")
+        data["writer_alive"] = bool(writer and writer.is_alive())
+    else:
+        data["ingest"] = _ingest_snapshot()
+        data["acks"] = {n: t.status() for n, t in _ack_trackers.items()}
+        data["mqtt"] = _mqtt_stats()
+        data["bandwidth"] = {n: _meter(n).status() for n in _servers}
+    data["deferred_clips"] = _deferred_clip_counts()
+    return data
+
+
+_MEDIA_FIELDS = ("snapshot_path", "clip_path", "plate_crop_path")
+_EXPORT_FIELDS = ("id", "server", "frigate_event_id", "camera", "event_type", "ts", "plate", "score", "speed", "repeat_of",
+                  "created_at")
+_EXPORT_FETCH = 500
+
+
+def _event_filters(server: str | None, camera: str | None, plate: str | None,
+                   start: str | None, end: str | None) -> tuple[list[str], list]:
+    """WHERE conditions shared by /events and /events/export. start/end are YYYY-MM-DD (end inclusive)."""
+    conds: list[str] = []
+    params: list = []
+    if server:
+        conds.append("server = ?")
+        params.append(server)
+    if camera:
+        conds.append("camera = ?")
+        params.append(camera)
+    if plate:
+        conds.append("plate = ?")
+        params.append(normalize_plate(plate))
+    if start or end:
+        cond, vals = _seen_between(date.fromisoformat(start).isoformat() if start else None,
+                                   (date.fromisoformat(end) + timedelta(days=1)).isoformat() if end else None)
+        conds.append(cond)
+        params.extend(vals)
+    return conds, params
+
+
+def _media_urls(r: dict) -> dict:
+    # Convert media relative paths to URLs under /media
+    for k in _MEDIA_FIELDS:
+        if r.get(k):
+            r[k] = f"/media/{r[k]}"
+    return r
 
 
 @app.get("/events")
-def list_events(limit: int = 50):
+def list_events(limit: int = 50, server: str | None = None, camera: str | None = None,
+                plate: str | None = None, start: str | None = None, end: str | None = None):
+    try:
+        conds, params = _event_filters(server, camera, plate, start, end)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"invalid date: {e}"})
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
     rows = _db_query(
-        "SELECT id, server, frigate_event_id, camera, event_type, ts, snapshot_path, clip_path, plate_crop_path, plate, speed, score, created_at FROM events ORDER BY id DESC LIMIT ?",
-        (limit,),
+        f"SELECT id, server, frigate_event_id, camera, event_type, ts, snapshot_path, clip_path, plate_crop_path, plate, speed, score, repeat_of, created_at FROM events {where} ORDER BY id DESC LIMIT ?",
+        (*params, limit),
     )
-    # Convert media relative paths to URLs under /media
-    for r in rows:
-        for k in ("snapshot_path", "clip_path", "plate_crop_path"):
-            if r.get(k):
-                r[k] = f"/media/{r[k]}"
-    return rows
+    return [_media_urls(r) for r in rows]
+
+
+def _export_rows(conds: list[str], params: list, first: date, last: date, chunk_days: int, include_media: bool):
+    """Yield event dicts day-chunk by day-chunk, stepping the SQLite cursor in small batches.
+
+    Reads without ts fall in the chunk of their _SEEN_SQL time, like in the plate summaries.
+    """
+    cols = _EXPORT_FIELDS + (_MEDIA_FIELDS if include_media else ())
+    # StreamingResponse advances this generator from threadpool workers, a different
+    # thread per step; the connection is still used by this one request only.
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    try:
+        lo = first
+        while lo <= last:
+            hi = min(lo + timedelta(days=chunk_days), last + timedelta(days=1))
+            in_chunk, bounds = _seen_between(lo.isoformat(), hi.isoformat())
+            cur = con.execute(
+                f"SELECT {', '.join(cols)} FROM events WHERE {' AND '.join(conds + [in_chunk])} "
+                f"ORDER BY {_SEEN_SQL}, id",
+                (*params, *bounds),
+            )
+            while True:
+                batch = cur.fetchmany(_EXPORT_FETCH)
+                if not batch:
+                    break
+                for r in batch:
+                    yield _media_urls(dict(r)) if include_media else dict(r)
+            lo = hi
+    finally:
+        con.close()
+
+
+@app.get("/events/export")
+def export_events(format: str = "csv", start: str | None = None, end: str | None = None,
+                  server: str | None = None, camera: str | None = None, plate: str | None = None,
+                  include_media: bool = False, chunk_days: int = 1):
+    """Exportación en streaming (CSV o NDJSON) con los mismos filtros que /events.
+
+    Recorre el rango por bloques de `chunk_days` días usando el índice de ts;
+    la memoria usada no depende del tamaño del rango.
+    """
+    fmt = format.lower()
+    if fmt not in ("csv", "ndjson"):
+        return JSONResponse(status_code=400, content={"error": "format must be csv or ndjson"})
+    try:
+        conds, params = _event_filters(server, camera, plate, None, None)
+        last = date.fromisoformat(end) if end else date.today()
+        if start:
+            first = date.fromisoformat(start)
+        else:
+            oldest = _db_query(
+                f"SELECT MIN(t) AS t FROM (SELECT MIN(ts) AS t FROM events "
+                f"UNION ALL SELECT MIN({_SEEN_SQL}) FROM events WHERE ts IS NULL)"
+            )[0]["t"]
+            first = date.fromisoformat(oldest[:10]) if oldest else last
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"invalid date: {e}"})
+    rows = _export_rows(conds, params, first, last, max(1, chunk_days), include_media)
+    fields = _EXPORT_FIELDS + (_MEDIA_FIELDS if include_media else ())
+
+    def csv_stream():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(fields)
+        n = 0
+        for r in rows:
+            writer.writerow([r[f] for f in fields])
+            n += 1
+            if n % _EXPORT_FETCH == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    def ndjson_stream():
+        lines = []
+        for r in rows:
+            lines.append(json.dumps(r, ensure_ascii=False))
+            if len(lines) >= _EXPORT_FETCH:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    filename = f"lpr_events_{first.isoformat()}_{last.isoformat()}.{fmt}"
+    return StreamingResponse(
+        csv_stream() if fmt == "csv" else ndjson_stream(),
+        media_type="text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/plates/{plate}")
+def plate_summary(plate: str, days: int = 31):
+    """Resumen de una matrícula: primera/última vez, visitas, cámaras y conteo por día.
+
+    Se responde desde las tablas de resumen, sin recorrer events.
+    """
+    key = normalize_plate(plate)
+    rows = _db_query("SELECT * FROM plates WHERE plate = ?", (key,))
+    if not rows:
+        return JSONResponse(status_code=404, content={"error": "plate not found", "plate": key})
+    summary = rows[0]
+    today = date.today()
+    month_start = today.replace(day=1).isoformat()
+    since = min((today - timedelta(days=max(1, days) - 1)).isoformat(), month_start)
+    day_rows = _db_query(
+        "SELECT day, camera, count FROM plate_days WHERE plate = ? AND day >= ? ORDER BY day DESC, camera",
+        (key, since),
+    )
+    window_start = (today - timedelta(days=max(1, days) - 1)).isoformat()
+    per_day: Dict[str, int] = {}
+    cameras: Dict[str, int] = {}
+    for r in day_rows:
+        if r["day"] >= window_start:
+            per_day[r["day"]] = per_day.get(r["day"], 0) + r["count"]
+            cameras[r["camera"]] = cameras.get(r["camera"], 0) + r["count"]
+    summary["this_month"] = sum(r["count"] for r in day_rows if r["day"] >= month_start)
+    summary["cameras"] = [{"camera": c, "count": n} for c, n in sorted(cameras.items(), key=lambda kv: -kv[1])]
+    summary["days"] = [{"day": d, "count": n} for d, n in per_day.items()]
+    return summary
+
+
+_TRANSITION_FIELDS = ("from_server", "from_camera", "from_ts", "to_server", "to_camera", "to_ts", "seconds")
+
+
+def _transition_filters(start: str | None, end: str | None) -> tuple[list[str], list]:
+    """to_ts range for transition queries. start/end are YYYY-MM-DD (end inclusive)."""
+    conds: list[str] = []
+    params: list = []
+    if start:
+        conds.append("to_ts >= ?")
+        params.append(date.fromisoformat(start).isoformat())
+    if end:
+        conds.append("to_ts < ?")
+        params.append((date.fromisoformat(end) + timedelta(days=1)).isoformat())
+    return conds, params
+
+
+@app.get("/plates/{plate}/trajectory")
+def plate_trajectory(plate: str, start: str | None = None, end: str | None = None, limit: int = 500):
+    """Recorrido de una matrícula: cada paso de una cámara a la siguiente, en orden."""
+    key = normalize_plate(plate)
+    try:
+        conds, params = _transition_filters(start, end)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"invalid date: {e}"})
+    if not _db_query("SELECT 1 FROM plates WHERE plate = ?", (key,)):
+        return JSONResponse(status_code=404, content={"error": "plate not found", "plate": key})
+    where = " AND ".join(["plate = ?"] + conds)
+    rows = _db_query(
+        f"SELECT {', '.join(_TRANSITION_FIELDS)} FROM plate_transitions WHERE {where} ORDER BY to_ts LIMIT ?",
+        (key, *params, max(1, limit)),
+    )
+    return {"plate": key, "transitions": rows}
+
+
+def _percentile(sorted_values: list[float], p: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))]
+
+
+@app.get("/transitions/travel-times")
+def travel_times(from_camera: str | None = None, to_camera: str | None = None,
+                 from_server: str | None = None, to_server: str | None = None,
+                 start: str | None = None, end: str | None = None,
+                 max_seconds: float | None = None, bucket_seconds: float = 60):
+    """Tiempos de viaje entre cámaras, leídos de plate_transitions.
+
+    Con from_camera y to_camera: distribución del par (percentiles e histograma).
+    Sin ellos: resumen por par de cámaras.
+    """
+    try:
+        conds, params = _transition_filters(start, end)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"invalid date: {e}"})
+    for col, val in (("from_server", from_server), ("to_server", to_server)):
+        if val:
+            conds.append(f"{col} = ?")
+            params.append(val)
+    if max_seconds is not None:
+        conds.append("seconds <= ?")
+        params.append(max_seconds)
+
+    if not (from_camera and to_camera):
+        if from_camera:
+            conds.append("from_camera = ?")
+            params.append(from_camera)
+        if to_camera:
+            conds.append("to_camera = ?")
+            params.append(to_camera)
+        where = f"WHERE {' AND '.join(conds)}" if conds else ""
+        return _db_query(
+            "SELECT from_camera, to_camera, COUNT(*) AS count, MIN(seconds) AS min_seconds, "
+            f"AVG(seconds) AS avg_seconds, MAX(seconds) AS max_seconds FROM plate_transitions {where} "
+            "GROUP BY from_camera, to_camera ORDER BY count DESC",
+            tuple(params),
+        )
+
+    where = " AND ".join(["from_camera = ?", "to_camera = ?"] + conds)
+    # idx_transitions_pair returns the pair already ordered by seconds
+    values = [r["seconds"] for r in _db_query(
+        f"SELECT seconds FROM plate_transitions WHERE {where} ORDER BY seconds",
+        (from_camera, to_camera, *params),
+    )]
+    bucket = bucket_seconds if bucket_seconds > 0 else 60
+    histogram: Dict[float, int] = {}
+    for v in values:
+        b = (v // bucket) * bucket
+        histogram[b] = histogram.get(b, 0) + 1
+    return {
+        "from_camera": from_camera,
+        "to_camera": to_camera,
+        "count": len(values),
+        "min_seconds": values[0] if values else None,
+        "max_seconds": values[-1] if values else None,
+        "avg_seconds": sum(values) / len(values) if values else None,
+        "p50": _percentile(values, 50),
+        "p90": _percentile(values, 90),
+        "p95": _percentile(values, 95),
+        "p99": _percentile(values, 99),
+        "bucket_seconds": bucket,
+        "histogram": [{"from": b, "count": n} for b, n in histogram.items()],
+    }
+
+
+@app.get("/stats/hourly")
+def stats_hourly(start: str | None = None, end: str | None = None,
+                 server: str | None = None, camera: str | None = None):
+    """Lecturas por servidor/cámara/hora y matrículas únicas por día, desde los agregados.
+
+    start/end son YYYY-MM-DD (end inclusive); por defecto, hoy.
+    """
+    try:
+        first = date.fromisoformat(start) if start else date.today()
+        last = date.fromisoformat(end) if end else max(first, date.today())
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"invalid date: {e}"})
+    conds = ["hour >= ?", "hour < ?"]
+    params: list = [first.isoformat(), (last + timedelta(days=1)).isoformat()]
+    if server:
+        conds.append("server = ?")
+        params.append(server)
+    if camera:
+        conds.append("camera = ?")
+        params.append(camera)
+    hours = _db_query(
+        "SELECT server, camera, hour, reads, unique_plates, "
+        "CASE WHEN score_n > 0 THEN score_sum / score_n END AS avg_score, "
+        "CASE WHEN speed_n > 0 THEN speed_sum / speed_n END AS avg_speed, speed_max AS max_speed "
+        f"FROM lpr_hourly WHERE {' AND '.join(conds)} ORDER BY hour, server, camera",
+        tuple(params),
+    )
+    # Únicas por día: plate_days no distingue servidor
+    day_conds = ["day >= ?", "day <= ?"]
+    day_params: list = [first.isoformat(), last.isoformat()]
+    if camera:
+        day_conds.append("camera = ?")
+        day_params.append(camera)
+    days = _db_query(
+        f"SELECT day, COUNT(DISTINCT plate) AS unique_plates, SUM(count) AS visits FROM plate_days "
+        f"WHERE {' AND '.join(day_conds)} GROUP BY day ORDER BY day",
+        tuple(day_params),
+    )
+    return {"start": first.isoformat(), "end": last.isoformat(), "hours": hours, "days": days}
+
+
+@app.post("/stats/hourly/rebuild")
+def stats_hourly_rebuild():
+    """Regenera lpr_hourly desde events (p.ej. tras borrar o importar eventos)."""
+    started = time.time()
+    con = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        with con:
+            _rebuild_hourly(con.cursor())
+        rows = con.execute("SELECT COUNT(*) FROM lpr_hourly").fetchone()[0]
+    finally:
+        con.close()
+    log.info("🔧 Agregados horarios regenerados: %d fila(s) en %.1fs", rows, time.time() - started)
+    return {"rows": rows, "seconds": round(time.time() - started, 3)}
 
 
 @app.get("/logs")
@@ -628,8 +2174,81 @@ def get_logs(limit: int = 1000):
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-# Serve saved media files
-app.mount("/media", StaticFiles(directory=MEDIA_DIR), name="media")
+# Serve saved media files: loose file first, then the camera-day pack
+# Media files are written once under a per-event name and never rewritten
+_MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _media_etag(rel_path: str, size: int) -> str:
+    """Strong ETag from path and size (the same for the loose file and its packed copy)."""
+    return '"' + hashlib.blake2b(f"{rel_path}\0{size}".encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+
+def _etag_matches(header: str | None, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(t.strip().removeprefix("W/") == etag for t in header.split(","))
+
+
+def _parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Single "bytes=" range as (start, end inclusive). None if absent or not understood (serve it all)."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return None
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else max(start, size - 1)
+    except ValueError:
+        return None
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+@app.api_route("/media/{path:path}", methods=["GET", "HEAD"])
+def media(path: str, request: Request):
+    full = os.path.normpath(os.path.join(MEDIA_DIR, path))
+    if not full.startswith(MEDIA_DIR + os.sep):
+        return JSONResponse(status_code=404, content={"error": "not found"})
+    media_type = mimetypes.guess_type(full)[0] or "application/octet-stream"
+    if os.path.isfile(full):
+        source, offset, size = full, 0, os.path.getsize(full)
+    else:
+        hit = media_pack.locate(full)
+        if hit is None:
+            return JSONResponse(status_code=404, content={"error": "not found"})
+        source, offset, size = hit
+    etag = _media_etag(os.path.relpath(full, MEDIA_DIR).replace(os.sep, "/"), size)
+    headers = {"ETag": etag, "Cache-Control": _MEDIA_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    status, start, length = 200, 0, size
+    rng = _parse_range(request.headers.get("range"), size)
+    if_range = request.headers.get("if-range")
+    if rng is not None and (if_range is None or if_range.strip() == etag):
+        if rng[0] >= size:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        status, start, length = 206, rng[0], rng[1] - rng[0] + 1
+        headers["Content-Range"] = f"bytes {rng[0]}-{rng[1]}/{size}"
+    headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        media_pack.iter_range(source, offset + start, length),
+        status_code=status,
+        media_type=media_type,
+        headers=headers,
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -676,6 +2295,20 @@ def _cleanup_media(retention_days: int) -> None:
     except Exception as e:
         log.error("Cleanup error: %s", e)
 
+def _prune_hourly_plates() -> None:
+    try:
+        cutoff = (date.today() - timedelta(days=_HOURLY_PLATES_KEEP_DAYS)).isoformat()
+        con = sqlite3.connect(DB_PATH, timeout=30)
+        try:
+            with con:
+                n = con.execute("DELETE FROM lpr_hourly_plates WHERE hour < ?", (cutoff,)).rowcount
+        finally:
+            con.close()
+        if n:
+            log.info("🧹 Pruned %d hourly plate marker(s) before %s", n, cutoff)
+    except Exception as e:
+        log.warning("Hourly plates prune failed: %s", e)
+
 def _seconds_until_midnight() -> float:
     now = datetime.now()
     tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -684,6 +2317,7 @@ def _seconds_until_midnight() -> float:
 def _cleanup_loop():
     # Initial cleanup on start
     _cleanup_media(_retention_days)
+    _prune_hourly_plates()
     while True:
         try:
             sleep_secs = max(1, int(_seconds_until_midnight()))
@@ -694,9 +2328,23 @@ def _cleanup_loop():
             except Exception:
                 pass
             _cleanup_media(_retention_days)
+            _prune_hourly_plates()
         except Exception as e:
             log.error("Cleanup loop error: %s", e)
 
+# ---------------- Media packing ----------------
+_MEDIA_PACK_INTERVAL = 3600
+
+
+def _media_pack_loop():
+    # Closed days only; folders still being written are retried on the next pass
+    while True:
+        try:
+            media_pack.pack_closed_days(MEDIA_DIR, log=log)
+        except Exception as e:
+            log.error("Media pack loop error: %s", e)
+        time.sleep(_MEDIA_PACK_INTERVAL)
+
 # ---------------- Stats Writer ----------------
 def _stats_loop():
     try:
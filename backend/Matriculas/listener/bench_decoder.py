@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Micro-benchmark del decodificador de payloads de Frigate.
+
+Compara el camino anterior del handler MQTT (json.loads completo de cada
+mensaje + extracción genérica + dateutil) con frigate_decoder sobre payloads
+de `frigate/events` (un JSON por línea).
+
+La fixture de bench/ es sintética: mensajes armados a mano con la forma de los
+de Frigate (new/update/end, con y sin matrícula), no una captura real. Para
+medir con tráfico real conviene grabar una captura y pasarla con --input.
+
+Uso:
+    python bench_decoder.py                       # fixture sintética incluida en bench/
+    python bench_decoder.py --input captura.jsonl --seconds 5
+
+Para grabar payloads reales de un broker:
+    mosquitto_sub -h <broker> -t frigate/events > captura.jsonl
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+from frigate_decoder import decode_event, extract_plate, peek_type
+
+try:
+    from dateutil import parser as dtparser
+    _parse_str = dtparser.parse
+except ImportError:  # el benchmark no debería depender de dateutil
+    _parse_str = datetime.fromisoformat
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "frigate_events.jsonl")
+
+
+# --- Camino anterior (copia congelada del handler previo al decodificador) ---
+def _legacy_extract_speed(p: dict) -> float | None:
+    try:
+        after = p.get("after") or {}
+        val = after.get("current_estimated_speed")
+        if isinstance(val, (int, float)):
+            return float(val)
+        if isinstance(val, str):
+            try:
+                return float(val)
+            except Exception:
+                pass
+        for key_path in (
+            ("speed",),
+            ("current_estimated_speed",),
+            ("vehicle", "speed"),
+            ("attributes", "speed"),
+        ):
+            obj = after
+            for k in key_path:
+                if isinstance(obj, dict) and k in obj:
+                    obj = obj.get(k)
+                else:
+                    obj = None
+                    break
+            if isinstance(obj, (int, float)):
+                return float(obj)
+            if isinstance(obj, str):
+                try:
+                    return float(obj)
+                except Exception:
+                    pass
+        val = p.get("speed") or p.get("current_estimated_speed")
+        if isinstance(val, (int, float)):
+            return float(val)
+        if isinstance(val, str):
+            try:
+                return float(val)
+            except Exception:
+                pass
+    except Exception:
+        return None
+    return None
+
+
+def legacy_handle(raw: bytes, cache: dict):
+    payload = json.loads(raw.decode("utf-8", errors="replace"))
+    ev_id = (payload.get("after", {}) or {}).get("id") or payload.get("id")
+    if not ev_id:
+        return None
+    cache.setdefault(ev_id, {"payload": payload})
+    cache[ev_id].update({"payload": payload})
+    if payload.get("type") != "end":
+        return None
+    cache.pop(ev_id, None)
+    plate, score = extract_plate(payload)
+    if not plate:
+        return None
+    ts_raw = (payload.get("after", {}) or {}).get("frame_time") or payload.get("time") or payload.get("timestamp")
+    ts = None
+    try:
+        if isinstance(ts_raw, (int, float)):
+            ts = datetime.fromtimestamp(float(ts_raw))
+        elif isinstance(ts_raw, str):
+            ts = _parse_str(ts_raw)
+    except Exception:
+        ts = None
+    spd = _legacy_extract_speed(payload)
+    json.dumps(payload, ensure_ascii=False)
+    return ev_id, plate, score, spd, ts
+
+
+# --- Camino nuevo (mismo flujo que app._on_message) ---
+def fast_handle(raw: bytes, cache: dict):
+    ev_type = peek_type(raw)
+    if ev_type is not None and ev_type != "end":
+        return None
+    ev = decode_event(raw)
+    if ev is None or not ev.id or ev.type != "end" or not ev.plate:
+        return None
+    return ev.id, ev.plate, ev.score, ev.speed, ev.ts
+
+
+def _run(fn, payloads: list[bytes], seconds: float) -> float:
+    cache: dict = {}
+    n = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while True:
+        for raw in payloads:
+            fn(raw, cache)
+        n += len(payloads)
+        if time.perf_counter() >= deadline:
+            break
+    return n / (time.perf_counter() - start)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--input", default=DEFAULT_INPUT, help="JSONL con un payload MQTT por línea")
+    ap.add_argument("--seconds", type=float, default=3.0, help="duración de cada medición")
+    args = ap.parse_args()
+
+    with open(args.input, "rb") as f:
+        payloads = [line.rstrip(b"\r\n") for line in f if line.strip()]
+    ends = sum(1 for p in payloads if json.loads(p).get("type") == "end")
+    print(f"payloads: {len(payloads)} ({ends} end) from {args.input}")
+
+    # Ambos caminos deben producir lo mismo antes de medir
+    mismatches = 0
+    for raw in payloads:
+        a, b = legacy_handle(raw, {}), fast_handle(raw, {})
+        if a != b:
+            mismatches += 1
+            print(f"MISMATCH legacy={a} fast={b}")
+    if mismatches:
+        raise SystemExit(f"{mismatches} payload(s) decoded differently")
+
+    before = _run(legacy_handle, payloads, args.seconds)
+    after = _run(fast_handle, payloads, args.seconds)
+    print(f"before: {before:12,.0f} msg/s")
+    print(f"after:  {after:12,.0f} msg/s")
+    print(f"speedup: x{after / before:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Benchmark de extremo a extremo del listener LPR contra el simulador de Frigate.
+
+Levanta el HTTP simulado (simulator.py), genera una configuración con N
+servidores apuntando a él (crops y, opcionalmente, clips por `sftp_host = local`)
+y entrega las secuencias new/update/end directamente al handler MQTT del
+listener. Mide desde la entrega del mensaje "end" hasta que la fila queda
+confirmada en la DB. Con `--qos 1` los mensajes pasan por el inbox durable y
+se cuentan los PUBACK enviados.
+
+Uso:
+    python bench_listener.py --servers 20 --rate 50 --duration 30 --latency-ms 40
+
+Reporta eventos/s sostenidos, latencia p50/p99 y RSS del proceso.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Msg:
+    __slots__ = ("topic", "payload", "mid", "qos")
+
+    def __init__(self, topic: str, payload: bytes, mid: int = 0, qos: int = 0) -> None:
+        self.topic, self.payload, self.mid, self.qos = topic, payload, mid, qos
+
+
+class _AckCounter:
+    """Stands in for the paho client on the ack path: counts PUBACKs."""
+
+    def __init__(self) -> None:
+        self.acks = 0
+
+    def ack(self, mid: int, qos: int) -> None:
+        self.acks += 1
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _write_conf(path: str, servers: int, http_url: str, root: str, clip_mode: str, download_workers: int) -> None:
+    lines = ["[general]", "retention_days = 0", f"download_workers = {download_workers}", ""]
+    for i in range(servers):
+        lines += [
+            f"[server:sim{i}]",
+            "mqtt_broker = 127.0.0.1",
+            f"mqtt_topic = frigate/sim{i}/events",
+            f"frigate_url = {http_url}",
+            "sftp_host = local",
+            f"sftp_plate_root = {root}",
+            "sftp_plate_path_template = {root}/{camera}/{event_id}/",
+            f"sftp_clip_mode = {clip_mode}",
+            f"sftp_clip_root = {root}",
+            "sftp_clip_path_template = {root}/{camera}/",
+            "",
+        ]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--servers", type=int, default=4)
+    ap.add_argument("--cameras", default="Portones,Ingreso,Salida")
+    ap.add_argument("--rate", type=float, default=20.0, help="eventos por segundo (total)")
+    ap.add_argument("--duration", type=float, default=20.0)
+    ap.add_argument("--updates", type=int, default=5, help="mensajes update por evento (informativo)")
+    ap.add_argument("--latency-ms", type=float, default=20.0, help="latencia media del HTTP simulado")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--clip-mode", choices=("api", "sftp"), default="api")
+    ap.add_argument("--download-workers", type=int, default=4)
+    ap.add_argument("--snapshot-kb", type=int, default=120)
+    ap.add_argument("--clip-kb", type=int, default=900)
+    ap.add_argument("--drain-timeout", type=float, default=60.0)
+    ap.add_argument("--qos", type=int, choices=(0, 1), default=0, help="1 = inbox durable + ack tras commit")
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="lpr-bench-")
+    root = os.path.join(work, "remote")
+    os.environ.update({
+        "DB_DIR": os.path.join(work, "DB"),
+        "MEDIA_DIR": os.path.join(work, "MEDIA"),
+        "LOG_DIR": os.path.join(work, "LOG"),
+        "CONF_PATH": os.path.join(work, "matriculas.conf"),
+    })
+
+    from simulator import FrigateSim, make_http_server
+
+    cameras = [c.strip() for c in args.cameras.split(",") if c.strip()]
+    sim = FrigateSim(cameras, sftp_root=root, snapshot_kb=args.snapshot_kb, clip_kb=args.clip_kb,
+                     latency_ms=args.latency_ms, error_rate=args.error_rate)
+    http = make_http_server(sim)
+    http_url = f"http://127.0.0.1:{http.server_address[1]}"
+    _write_conf(os.environ["CONF_PATH"], args.servers, http_url, root, args.clip_mode, args.download_workers)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import app as listener
+
+    logging.getLogger("listener").setLevel(logging.WARNING)
+    listener.load_config()
+    listener.init_db()
+    listener._start_db_writer()
+    listener._download_pool = ThreadPoolExecutor(max_workers=listener._download_workers, thread_name_prefix="download")
+
+    published: dict[str, float] = {}
+    latencies: list[float] = []
+    done_lock = threading.Lock()
+    committed = {"n": 0, "last": 0.0}
+
+    def timed_commit(rows: list[dict]) -> None:
+        t = time.perf_counter()
+        with done_lock:
+            for row in rows:
+                if "inbox" in row:
+                    continue
+                t0 = published.pop(row["frigate_event_id"], None)
+                if t0 is not None:
+                    latencies.append(t - t0)
+                committed["n"] += 1
+                committed["last"] = t
+
+    listener._after_commit = timed_commit
+    handlers = {f"sim{i}": listener._on_message(f"sim{i}") for i in range(args.servers)}
+    names = list(handlers)
+    ack_clients = {}
+    if args.qos:
+        for name in names:
+            ack_clients[name] = _AckCounter()
+            listener._ack_trackers[name] = listener._AckTracker(ack_clients[name])
+    mids = dict.fromkeys(names, 0)
+
+    def deliver(srv: str, topic: str, raw: bytes) -> None:
+        mids[srv] += 1
+        handlers[srv](None, None, _Msg(topic, raw, mids[srv], args.qos))
+
+    rss_start = _rss_mb()
+    interval = 1.0 / args.rate
+    t_start = time.perf_counter()
+    next_at = t_start
+    sent = with_plate = 0
+    while time.perf_counter() - t_start < args.duration:
+        srv = names[sent % len(names)]
+        event_id, _, msgs = sim.next_event()
+        topic = f"frigate/{srv}/events"
+        for raw in msgs[:-1]:
+            deliver(srv, topic, raw)
+        if b'"recognized_license_plate": null' not in msgs[-1]:
+            with_plate += 1
+            with done_lock:
+                published[event_id] = time.perf_counter()
+        deliver(srv, topic, msgs[-1])
+        sent += 1
+        next_at += interval
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    t_pub_end = time.perf_counter()
+
+    deadline = t_pub_end + args.drain_timeout
+    while time.perf_counter() < deadline:
+        with done_lock:
+            if committed["n"] >= with_plate:
+                break
+        time.sleep(0.05)
+    rss_end = _rss_mb()
+    http.shutdown()
+
+    elapsed = (committed["last"] or time.perf_counter()) - t_start
+    print(f"servers={args.servers} rate={args.rate}/s duration={args.duration}s http_latency={args.latency_ms}ms "
+          f"clip_mode={args.clip_mode} download_workers={listener._download_workers} qos={args.qos}")
+    print(f"events published: {sent} ({with_plate} with plate) | committed: {committed['n']} | "
+          f"pending: {with_plate - committed['n']}")
+    print(f"sustained: {committed['n'] / elapsed:,.1f} events/s")
+    print(f"latency end->commit: p50={_pct(latencies, 50) * 1000:.1f} ms  p99={_pct(latencies, 99) * 1000:.1f} ms")
+    print(f"RSS: start={rss_start:.1f} MB end={rss_end:.1f} MB "
+          f"peak={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if args.qos:
+        print(f"acks: {sum(c.acks for c in ack_clients.values())} / {sum(mids.values())} messages")
+    print(f"simulator requests: {sim.requests}")
+    print(f"work dir: {work}")
+
+
+if __name__ == "__main__":
+    main()
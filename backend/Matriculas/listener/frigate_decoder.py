@@ -0,0 +1,212 @@
+"""Decodificador de mensajes `frigate/events` para el listener LPR.
+
+Extrae solo los campos que usa el listener (id, type, camera, frame_time,
+matrícula y velocidad). Las formas habituales de Frigate se resuelven por
+caminos rápidos; cualquier otra forma cae en la extracción genérica.
+"""
+import json
+import re
+from datetime import datetime
+from typing import Any
+
+# Frigate serializa "type" como última clave del objeto raíz:
+#   {"before": {...}, "after": {...}, "type": "update"}
+_TAIL_TYPE_RE = re.compile(rb'"type"\s*:\s*"(\w+)"\s*}\s*$')
+_TAIL_WINDOW = 48
+
+# Claves de "after" que la extracción genérica considera además de recognized_license_plate
+_OTHER_PLATE_KEYS = ("plate", "text", "regions")
+
+
+class FrigateEvent:
+    """Campos de un mensaje de Frigate que necesita el listener."""
+
+    __slots__ = ("id", "type", "camera", "ts", "plate", "score", "speed", "raw_text")
+
+    def __init__(self, id: str | None, type: str | None, camera: str, ts: datetime | None,
+                 plate: str | None, score: float, speed: float | None, raw_text: str) -> None:
+        self.id = id
+        self.type = type
+        self.camera = camera
+        self.ts = ts
+        self.plate = plate
+        self.score = score
+        self.speed = speed
+        self.raw_text = raw_text
+
+
+def peek_type(raw: bytes) -> str | None:
+    """Tipo del mensaje ("new"/"update"/"end") leyendo solo el final del payload.
+
+    Devuelve None si el payload no tiene la forma esperada; en ese caso hay que decodificarlo.
+    """
+    m = _TAIL_TYPE_RE.search(raw, max(0, len(raw) - _TAIL_WINDOW))
+    return m.group(1).decode("ascii") if m else None
+
+
+def normalize_plate(plate: str) -> str:
+    return plate.strip().replace(" ", "").replace("-", "").upper()
+
+
+def extract_plate(payload: dict) -> tuple[str | None, float]:
+    """Intenta extraer una matrícula del payload de Frigate y su confianza.
+    Busca en múltiples ubicaciones comunes para integraciones LPR.
+    """
+    after = payload.get("after") or {}
+    best_plate, best_score = None, -1.0
+
+    def consider(plate_val, score_val=0.5):
+        nonlocal best_plate, best_score
+        if not plate_val:
+            return
+        # Caso especial: recognized_license_plate es array [matricula, score]
+        if isinstance(plate_val, list) and len(plate_val) == 2 and isinstance(plate_val[0], str) and isinstance(plate_val[1], (float, int)):
+            p = plate_val[0].strip()
+            score = float(plate_val[1]) * 100  # convertir a porcentaje
+            if p and score > best_score:
+                best_plate, best_score = normalize_plate(p), round(score, 2)
+            return
+        if isinstance(plate_val, str):
+            p = plate_val.strip()
+            if not p:
+                return
+            try:
+                score = float(score_val) if score_val is not None else 0.5
+            except Exception:
+                score = 0.5
+            if score > best_score:
+                best_plate, best_score = normalize_plate(p), score
+        elif isinstance(plate_val, dict):
+            consider(plate_val.get("plate") or plate_val.get("text"), plate_val.get("score") or plate_val.get("confidence"))
+
+    # Fuentes posibles
+    sources = [
+        after.get("recognized_license_plate"),
+        after.get("plate"),
+        after.get("text"),
+        (after.get("snapshot") or {}).get("plate"),
+        (after.get("snapshot") or {}).get("text"),
+        after.get("regions"),
+        after.get("box"),
+    ]
+    for src in sources:
+        consider(src)
+    return best_plate, best_score
+
+
+def _to_float(val: Any) -> float | None:
+    if isinstance(val, (int, float)):
+        return float(val)
+    if isinstance(val, str):
+        try:
+            return float(val)
+        except ValueError:
+            return None
+    return None
+
+
+def extract_speed(payload: dict) -> float | None:
+    after = payload.get("after") or {}
+    if not isinstance(after, dict):
+        after = {}
+    val = _to_float(after.get("current_estimated_speed"))
+    if val is not None:
+        return val
+    for key_path in (
+        ("speed",),
+        ("vehicle", "speed"),
+        ("attributes", "speed"),
+    ):
+        obj: Any = after
+        for k in key_path:
+            obj = obj.get(k) if isinstance(obj, dict) else None
+        val = _to_float(obj)
+        if val is not None:
+            return val
+    return _to_float(payload.get("speed") or payload.get("current_estimated_speed"))
+
+
+def parse_ts(ts_raw: Any) -> datetime | None:
+    """Epoch (número o texto) o fecha ISO; dateutil solo para formatos raros."""
+    try:
+        if isinstance(ts_raw, (int, float)):
+            return datetime.fromtimestamp(float(ts_raw))
+        if isinstance(ts_raw, str):
+            try:
+                return datetime.fromtimestamp(float(ts_raw))
+            except ValueError:
+                pass
+            try:
+                return datetime.fromisoformat(ts_raw)
+            except ValueError:
+                from dateutil import parser as dtparser
+                return dtparser.parse(ts_raw)
+    except Exception:
+        return None
+    return None
+
+
+def _fast_plate(after: dict) -> tuple[str | None, float] | None:
+    """Forma habitual: recognized_license_plate = [texto, score] y ninguna otra fuente."""
+    for k in _OTHER_PLATE_KEYS:
+        if k in after:
+            return None
+    snap = after.get("snapshot")
+    if snap and ("plate" in snap or "text" in snap):
+        return None
+    rlp = after.get("recognized_license_plate")
+    if rlp is None:
+        return None, -1.0
+    if type(rlp) is list and len(rlp) == 2 and type(rlp[0]) is str and type(rlp[1]) in (float, int):
+        p = rlp[0].strip()
+        if p:
+            return normalize_plate(p), round(float(rlp[1]) * 100, 2)
+    return None
+
+
+def decode_event(raw: bytes | str, full: bool | None = None) -> FrigateEvent | None:
+    """Decodifica un mensaje. Devuelve None si no es JSON válido o no es un objeto.
+
+    Matrícula, velocidad y timestamp solo se extraen para mensajes "end"
+    (o siempre con full=True), que son los únicos que se persisten.
+    """
+    try:
+        payload = json.loads(raw)
+        raw_text = None
+    except UnicodeDecodeError:
+        # UTF-8 inválido: como antes, se decodifica reemplazando los bytes malos
+        raw_text = raw.decode("utf-8", errors="replace")
+        payload = json.loads(raw_text)
+    if not isinstance(payload, dict):
+        return None
+    after = payload.get("after") or {}
+    if not isinstance(after, dict):
+        after = {}
+    ev_type = payload.get("type")
+    if raw_text is None:
+        raw_text = raw if isinstance(raw, str) else raw.decode("utf-8", errors="replace")
+    ev = FrigateEvent(
+        id=after.get("id") or payload.get("id"),
+        type=ev_type,
+        camera=after.get("camera") or payload.get("camera") or "",
+        ts=None, plate=None, score=-1.0, speed=None,
+        raw_text=raw_text,
+    )
+    if not (full or (full is None and ev_type == "end")):
+        return ev
+
+    fast = _fast_plate(after)
+    ev.plate, ev.score = fast if fast is not None else extract_plate(payload)
+
+    spd = after.get("current_estimated_speed")
+    ev.speed = float(spd) if type(spd) in (float, int) else extract_speed(payload)
+
+    ts_raw = after.get("frame_time") or payload.get("time") or payload.get("timestamp")
+    if type(ts_raw) is float:
+        try:
+            ev.ts = datetime.fromtimestamp(ts_raw)
+        except (OverflowError, OSError, ValueError):
+            ev.ts = None
+    else:
+        ev.ts = parse_ts(ts_raw)
+    return ev
@@ -0,0 +1,178 @@
+"""Empaquetado diario de medios del listener.
+
+Cada carpeta `MEDIA/<server>/<YYYY-MM-DD>/<camera>/` de un día cerrado se
+reemplaza por un único `MEDIA/<server>/<YYYY-MM-DD>/<camera>.zip` sin
+compresión (ZIP_STORED). Las rutas guardadas en la DB no cambian: `/media`
+busca primero el archivo suelto y, si no existe, el miembro dentro del ZIP,
+leyendo directamente por offset.
+"""
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+PACK_SUFFIX = ".zip"
+# No empaquetar carpetas con escrituras recientes (descargas en curso)
+MIN_AGE_SECONDS = 600
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")  # 30 bytes
+_CHUNK = 256 * 1024
+
+
+def _member_offsets(path: str) -> dict[str, tuple[int, int]]:
+    """name -> (offset de los datos, tamaño) para cada miembro sin compresión."""
+    import zipfile  # diferido: solo lo usan /media de días empaquetados y el job de empaquetado
+    out: dict[str, tuple[int, int]] = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED or info.is_dir():
+                continue
+            f.seek(info.header_offset)
+            hdr = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+            name_len, extra_len = hdr[-2], hdr[-1]
+            out[info.filename] = (info.header_offset + _LOCAL_HEADER.size + name_len + extra_len, info.file_size)
+    return out
+
+
+class PackIndex:
+    """Índices de ZIPs abiertos recientemente (LRU), invalidados por mtime."""
+
+    def __init__(self, max_packs: int = 256) -> None:
+        self.max_packs = max_packs
+        self._lock = threading.Lock()
+        self._packs: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def lookup(self, pack_path: str, name: str) -> tuple[int, int] | None:
+        try:
+            mtime = os.stat(pack_path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._packs.get(pack_path)
+            if cached is not None and cached[0] == mtime:
+                self._packs.move_to_end(pack_path)
+                return cached[1].get(name)
+        offsets = _member_offsets(pack_path)
+        with self._lock:
+            self._packs[pack_path] = (mtime, offsets)
+            self._packs.move_to_end(pack_path)
+            while len(self._packs) > self.max_packs:
+                self._packs.popitem(last=False)
+        return offsets.get(name)
+
+    def invalidate(self, pack_path: str) -> None:
+        with self._lock:
+            self._packs.pop(pack_path, None)
+
+
+index = PackIndex()
+
+
+def locate(full_path: str) -> tuple[str, int, int] | None:
+    """Para MEDIA/<...>/<camera>/<file>: (zip, offset, tamaño) si el archivo está empaquetado."""
+    pack_path = os.path.dirname(full_path) + PACK_SUFFIX
+    hit = index.lookup(pack_path, os.path.basename(full_path))
+    return (pack_path, hit[0], hit[1]) if hit else None
+
+
+def iter_range(pack_path: str, offset: int, size: int, chunk: int = _CHUNK):
+    """Lee `size` bytes desde `offset` por bloques."""
+    fd = os.open(pack_path, os.O_RDONLY)
+    try:
+        end = offset + size
+        pos = offset
+        while pos < end:
+            data = os.pread(fd, min(chunk, end - pos), pos)
+            if not data:
+                break
+            pos += len(data)
+            yield data
+    finally:
+        os.close(fd)
+
+
+def pack_camera_dir(cam_dir: str) -> int:
+    """Empaqueta los archivos de una carpeta de cámara en <cam_dir>.zip y la elimina.
+
+    Si el ZIP ya existe (llegadas tardías), se reescribe con los miembros previos
+    más los nuevos. Devuelve la cantidad de archivos agregados.
+    """
+    pack_path = cam_dir.rstrip(os.sep) + PACK_SUFFIX
+    files = sorted(e.name for e in os.scandir(cam_dir) if e.is_file())
+    if not files:
+        try:
+            os.rmdir(cam_dir)
+        except OSError:
+            pass
+        return 0
+    import zipfile
+    tmp = pack_path + ".tmp"
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as zout:
+        if os.path.exists(pack_path):
+            with zipfile.ZipFile(pack_path) as zin:
+                for info in zin.infolist():
+                    if info.filename in files:
+                        continue  # la versión suelta es más reciente
+                    zout.writestr(info, zin.read(info.filename))
+        for name in files:
+            zout.write(os.path.join(cam_dir, name), arcname=name)
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, pack_path)
+    index.invalidate(pack_path)
+    for name in files:
+        try:
+            os.remove(os.path.join(cam_dir, name))
+        except OSError:
+            pass
+    try:
+        os.rmdir(cam_dir)
+    except OSError:
+        pass
+    return len(files)
+
+
+def _recently_written(cam_dir: str, now: float) -> bool:
+    for e in os.scandir(cam_dir):
+        try:
+            if now - e.stat().st_mtime < MIN_AGE_SECONDS:
+                return True
+        except OSError:
+            continue
+    return False
+
+
+def pack_closed_days(media_dir: str, today: date | None = None, log=None) -> int:
+    """Empaqueta todas las carpetas de cámara de días anteriores a `today`."""
+    today = today or date.today()
+    now = time.time()
+    total = 0
+    if not os.path.isdir(media_dir):
+        return 0
+    for server_name in os.listdir(media_dir):
+        server_path = os.path.join(media_dir, server_name)
+        if not os.path.isdir(server_path):
+            continue
+        for date_dir in os.listdir(server_path):
+            date_path = os.path.join(server_path, date_dir)
+            try:
+                if datetime.strptime(date_dir, "%Y-%m-%d").date() >= today:
+                    continue
+            except ValueError:
+                continue
+            if not os.path.isdir(date_path):
+                continue
+            for cam in os.listdir(date_path):
+                cam_dir = os.path.join(date_path, cam)
+                if not os.path.isdir(cam_dir) or _recently_written(cam_dir, now):
+                    continue
+                try:
+                    n = pack_camera_dir(cam_dir)
+                    total += n
+                    if n and log:
+                        log.info("📦 Packed %d media file(s): %s%s", n, cam_dir, PACK_SUFFIX)
+                except Exception as e:
+                    if log:
+                        log.warning("Media pack failed for %s: %s", cam_dir, e)
+    return total
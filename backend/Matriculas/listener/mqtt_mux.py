@@ -0,0 +1,266 @@
+"""Gestor multiplexado de conexiones MQTT del listener.
+
+Con `mqtt_loop_threads = N` (N > 0) los clientes paho de todos los
+`[server:*]` se atienden desde N hilos con `selectors`, usando la API de bajo
+nivel de paho (`loop_read` / `loop_write` / `loop_misc` y los callbacks
+`on_socket_*`) en lugar de un hilo `loop_forever` por servidor.
+
+Las conexiones y reconexiones (bloqueantes: DNS, TCP, TLS) corren fuera del
+loop, en un pool chico, con backoff exponencial por cliente. Cada conexión
+lleva su estado, reconexiones y tasa de mensajes.
+"""
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("listener")
+
+MISC_INTERVAL = 1.0  # keepalive/timeouts de paho y reintentos de conexión
+RATE_INTERVAL = 5.0
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 60.0
+
+
+class _Conn:
+    """Estado de un cliente dentro del gestor."""
+
+    __slots__ = ("name", "client", "host", "port", "keepalive", "sock", "state", "configured", "removed",
+                 "next_attempt", "backoff", "messages", "rate", "rate_mark", "reconnects", "last_error")
+
+    def __init__(self, name: str, client, host: str, port: int, keepalive: int) -> None:
+        self.name = name
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.sock = None
+        self.state = "down"  # down | connecting | up
+        self.configured = False  # connect() ya guardó host/puerto; los siguientes intentos usan reconnect()
+        self.removed = False
+        self.next_attempt = 0.0
+        self.backoff = BACKOFF_MIN
+        self.messages = 0
+        self.rate = 0.0
+        self.rate_mark = 0
+        self.reconnects = 0
+        self.last_error: str | None = None
+
+
+class MqttMux:
+    """Atiende muchos clientes paho desde un único hilo."""
+
+    def __init__(self, name: str = "mqtt-mux", connect_workers: int = 4) -> None:
+        self.name = name
+        self._sel = selectors.DefaultSelector()
+        # socketpair: despierta el select() cuando otro hilo encola trabajo (acks, altas, bajas)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self._ops: deque = deque()
+        self._conns: dict[str, _Conn] = {}
+        self._connect_pool = ThreadPoolExecutor(max_workers=connect_workers, thread_name_prefix=f"{name}-connect")
+        self._thread: threading.Thread | None = None
+
+    # ---- API (cualquier hilo) ----
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def add(self, name: str, client, host: str, port: int, keepalive: int = 60) -> None:
+        """Registra un cliente (reemplaza otro con el mismo nombre) y lo conecta."""
+        conn = _Conn(name, client, host, port, keepalive)
+        self._wire(conn)
+        self._call(lambda: self._add(conn))
+
+    def remove(self, name: str) -> None:
+        self._call(lambda: self._remove(name))
+
+    def stats(self) -> dict:
+        return {
+            c.name: {
+                "state": c.state,
+                "connected": bool(c.client.is_connected()),
+                "messages": c.messages,
+                "rate": round(c.rate, 2),
+                "reconnects": c.reconnects,
+                "last_error": c.last_error,
+            }
+            for c in list(self._conns.values())
+        }
+
+    # ---- plumbing ----
+    def _call(self, fn) -> None:
+        """Ejecuta fn en el hilo del loop (el selector no es thread-safe)."""
+        if threading.current_thread() is self._thread:
+            fn()
+            return
+        self._ops.append(fn)
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # ya hay un despertar pendiente
+
+    def _wire(self, conn: _Conn) -> None:
+        c = conn.client
+        c.on_socket_open = lambda client, userdata, sock: self._call(lambda: self._register(conn, sock))
+        c.on_socket_close = lambda client, userdata, sock: self._call(lambda: self._unregister(conn, sock))
+        c.on_socket_register_write = lambda client, userdata, sock: self._call(lambda: self._set_write(sock, True))
+        c.on_socket_unregister_write = lambda client, userdata, sock: self._call(lambda: self._set_write(sock, False))
+        on_message, on_connect = c.on_message, c.on_connect
+
+        def counting_on_message(client, userdata, msg):
+            conn.messages += 1
+            if on_message is not None:
+                on_message(client, userdata, msg)
+
+        def tracking_on_connect(client, userdata, flags, reason_code, properties):
+            if not getattr(reason_code, "is_failure", reason_code != 0):
+                conn.backoff = BACKOFF_MIN
+                conn.last_error = None
+            else:
+                conn.last_error = f"CONNACK {reason_code}"
+            if on_connect is not None:
+                on_connect(client, userdata, flags, reason_code, properties)
+
+        c.on_message = counting_on_message
+        c.on_connect = tracking_on_connect
+
+    # ---- hilo del loop ----
+    def _add(self, conn: _Conn) -> None:
+        if conn.name in self._conns:
+            self._remove(conn.name)
+        self._conns[conn.name] = conn
+        self._start_connect(conn)
+
+    def _remove(self, name: str) -> None:
+        conn = self._conns.pop(name, None)
+        if conn is None:
+            return
+        conn.removed = True
+        if conn.state == "up":
+            try:
+                conn.client.disconnect()  # el DISCONNECT sale por loop_write y paho cierra el socket
+            except Exception:
+                pass
+
+    def _register(self, conn: _Conn, sock) -> None:
+        conn.sock = sock
+        try:
+            self._sel.register(sock, selectors.EVENT_READ, conn)
+        except KeyError:
+            self._sel.modify(sock, selectors.EVENT_READ, conn)
+
+    def _unregister(self, conn: _Conn, sock) -> None:
+        try:
+            self._sel.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        if conn.sock is not sock:
+            return
+        conn.sock = None
+        if conn.state == "up":
+            conn.reconnects += 1
+            self._schedule_retry(conn, "connection lost")
+
+    def _set_write(self, sock, on: bool) -> None:
+        try:
+            key = self._sel.get_key(sock)
+        except (KeyError, ValueError):
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if on else 0)
+        if key.events != events:
+            self._sel.modify(sock, events, key.data)
+
+    def _schedule_retry(self, conn: _Conn, reason: str) -> None:
+        conn.state = "down"
+        conn.next_attempt = time.monotonic() + conn.backoff
+        if not conn.removed:
+            log.warning("[%s] MQTT %s, retry in %.0fs", conn.name, reason, conn.backoff)
+        conn.backoff = min(conn.backoff * 2, BACKOFF_MAX)
+
+    def _start_connect(self, conn: _Conn) -> None:
+        conn.state = "connecting"
+        self._connect_pool.submit(self._connect, conn)
+
+    def _connect(self, conn: _Conn) -> None:
+        """Pool de conexión: TCP + CONNECT fuera del loop."""
+        try:
+            if conn.configured:
+                conn.client.reconnect()
+            else:
+                conn.configured = True
+                conn.client.connect(conn.host, conn.port, conn.keepalive)
+        except Exception as e:
+            conn.last_error = str(e)
+            self._call(lambda: self._connect_failed(conn))
+            return
+        self._call(lambda: self._connected(conn))
+
+    def _connected(self, conn: _Conn) -> None:
+        if conn.sock is None:
+            self._schedule_retry(conn, "closed while connecting")
+            return
+        conn.state = "up"
+        if conn.removed:
+            # Dado de baja mientras conectaba
+            try:
+                conn.client.disconnect()
+            except Exception:
+                pass
+
+    def _connect_failed(self, conn: _Conn) -> None:
+        if conn.removed:
+            conn.state = "down"
+            return
+        self._schedule_retry(conn, f"connect failed ({conn.last_error})")
+
+    def _run(self) -> None:
+        next_misc = time.monotonic()
+        next_rate = next_misc + RATE_INTERVAL
+        last_rate = next_misc
+        while True:
+            timeout = max(0.0, next_misc - time.monotonic())
+            for key, mask in self._sel.select(timeout):
+                conn = key.data
+                if conn is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        conn.client.loop_read()
+                    # loop_read may have closed (and unregistered) the socket
+                    if mask & selectors.EVENT_WRITE and conn.sock is key.fileobj:
+                        conn.client.loop_write()
+                except Exception as e:
+                    log.error("[%s] MQTT loop error: %s", conn.name, e)
+            while self._ops:
+                try:
+                    self._ops.popleft()()
+                except Exception as e:
+                    log.error("MQTT mux op failed: %s", e)
+            now = time.monotonic()
+            if now >= next_misc:
+                for conn in list(self._conns.values()):
+                    try:
+                        if conn.state == "up":
+                            conn.client.loop_misc()
+                        elif conn.state == "down" and now >= conn.next_attempt:
+                            self._start_connect(conn)
+                    except Exception as e:
+                        log.error("[%s] MQTT misc error: %s", conn.name, e)
+                next_misc = now + MISC_INTERVAL
+            if now >= next_rate:
+                elapsed = now - last_rate
+                for conn in list(self._conns.values()):
+                    conn.rate = (conn.messages - conn.rate_mark) / elapsed
+                    conn.rate_mark = conn.messages
+                last_rate, next_rate = now, now + RATE_INTERVAL
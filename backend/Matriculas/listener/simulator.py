@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Simulador de Frigate para pruebas de carga del listener LPR.
+
+- Genera secuencias realistas new/update/end de `frigate/events` con matrículas.
+- Sirve `/api/events/{id}/snapshot.jpg`, `/api/events/{id}/clip.mp4`, `/api/health`
+  y `/api/config` con latencia y tasa de error configurables.
+- Mantiene un árbol local tipo SFTP (`<root>/<camera>/<event_id>/*.jpg` para crops y
+  `<clip_root>/<camera>/<camera>-<event_id>.mp4` para clips), legible por el listener
+  con `sftp_host = local`.
+- Publica los mensajes en un broker MQTT externo (p.ej. mosquitto) a una tasa dada.
+
+Uso (broker externo):
+    python simulator.py --broker 127.0.0.1:1883 --servers 4 --rate 20 --http-port 5055
+
+El benchmark de extremo a extremo (bench_listener.py) usa este módulo llamando
+directamente al handler del listener, sin broker.
+"""
+import argparse
+import json
+import os
+import random
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_PLATE_LETTERS = string.ascii_uppercase
+_SNAPSHOT_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+_CLIP_HEADER = b"\x00\x00\x00\x18ftypmp42"
+
+
+def random_plate(rng: random.Random) -> str:
+    # Formato Mercosur AB123CD
+    return "".join(rng.choice(_PLATE_LETTERS) for _ in range(2)) + f"{rng.randint(0, 999):03d}" + \
+        "".join(rng.choice(_PLATE_LETTERS) for _ in range(2))
+
+
+def _object(event_id: str, camera: str, t0: float, t: float, step: int, plate: tuple | None,
+            speed: float, end: bool) -> dict:
+    box = [400 + step * 12, 300 + step * 5, 720 + step * 12, 560 + step * 5]
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    plate_box = [box[0] + 110, box[1] + 170, box[0] + 210, box[1] + 200]
+    path = [[[round(0.3 + i * 0.02, 4), round(0.6 - i * 0.01, 4)], round(t0 + i * 0.4, 6)] for i in range(step + 1)]
+    return {
+        "id": event_id, "camera": camera, "frame_time": round(t, 6),
+        "snapshot": {"frame_time": round(t - 0.2, 6), "box": box, "area": area, "region": [240, 120, 880, 760],
+                     "score": 0.84, "attributes": [{"label": "license_plate", "box": plate_box, "score": 0.88}]},
+        "label": "car", "sub_label": None, "top_score": 0.86, "false_positive": False,
+        "start_time": round(t0, 6), "end_time": round(t, 6) if end else None,
+        "score": 0.85, "box": box, "area": area, "ratio": 1.23, "region": [240, 120, 880, 760],
+        "active": not end, "stationary": False, "motionless_count": 0, "position_changes": step,
+        "current_zones": ["entrada"] if step > 1 else [], "entered_zones": ["entrada"] if step > 1 else [],
+        "has_clip": True, "has_snapshot": True,
+        "attributes": {"license_plate": 0.88} if plate else {},
+        "current_attributes": [{"label": "license_plate", "box": plate_box, "score": 0.88}] if plate else [],
+        "pending_loitering": False, "max_severity": "alert",
+        "current_estimated_speed": speed, "average_estimated_speed": speed, "velocity_angle": 87.5,
+        "path_data": path,
+        "recognized_license_plate": [plate[0], plate[1]] if plate else None,
+    }
+
+
+def event_sequence(event_id: str, camera: str, plate: str | None, score: float, speed: float,
+                   updates: int = 5, t0: float | None = None) -> list[bytes]:
+    """Mensajes new, `updates` x update y end de un objeto, como los publica Frigate."""
+    t0 = time.time() if t0 is None else t0
+    msgs, prev = [], None
+    kinds = ["new"] + ["update"] * updates + ["end"]
+    for step, kind in enumerate(kinds):
+        p = (plate, score) if plate and step >= 2 else None
+        cur = _object(event_id, camera, t0, t0 + step * 0.4, step, p, speed if step >= 2 else 0, kind == "end")
+        msgs.append(json.dumps({"before": prev or cur, "after": cur, "type": kind}).encode())
+        prev = cur
+    return msgs
+
+
+class FrigateSim:
+    """Estado compartido del simulador: eventos, medios y árbol tipo SFTP."""
+
+    def __init__(self, cameras: list[str], plate_pool: int = 500, no_plate_ratio: float = 0.1,
+                 sftp_root: str | None = None, clip_root: str | None = None, crops_per_event: int = 5,
+                 snapshot_kb: int = 120, clip_kb: int = 900, latency_ms: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 1) -> None:
+        self.cameras = cameras
+        self.rng = random.Random(seed)
+        self.plates = [random_plate(self.rng) for _ in range(max(1, plate_pool))]
+        self.no_plate_ratio = no_plate_ratio
+        self.sftp_root = sftp_root
+        self.clip_root = clip_root or sftp_root
+        self.crops_per_event = crops_per_event
+        self.snapshot = _SNAPSHOT_HEADER + os.urandom(max(0, snapshot_kb * 1024 - len(_SNAPSHOT_HEADER)))
+        self.clip = _CLIP_HEADER + os.urandom(max(0, clip_kb * 1024 - len(_CLIP_HEADER)))
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.requests = {"snapshot": 0, "clip": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def next_event(self, camera: str | None = None) -> tuple[str, str, list[bytes]]:
+        """Nuevo evento: (event_id, camera, mensajes). Crea los crops/clip en el árbol local."""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            camera = camera or self.rng.choice(self.cameras)
+            plate = None if self.rng.random() < self.no_plate_ratio else self.rng.choice(self.plates)
+            score = round(self.rng.uniform(0.7, 0.99), 3)
+            speed = round(self.rng.uniform(0, 60), 1)
+        t0 = time.time()
+        suffix = f"{seq:06x}"[-6:]
+        event_id = f"{t0:.6f}-{suffix}"
+        self._write_tree(camera, event_id)
+        return event_id, camera, event_sequence(event_id, camera, plate, score, speed, t0=t0)
+
+    def _write_tree(self, camera: str, event_id: str) -> None:
+        if self.sftp_root:
+            d = os.path.join(self.sftp_root, camera, event_id)
+            os.makedirs(d, exist_ok=True)
+            for i in range(self.crops_per_event):
+                with open(os.path.join(d, f"{i:02d}.jpg"), "wb") as f:
+                    f.write(self.snapshot[:4096])
+        if self.clip_root:
+            d = os.path.join(self.clip_root, camera)
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"{camera}-{event_id}.mp4"), "wb") as f:
+                f.write(self.clip[:65536])
+
+    def media(self, kind: str) -> bytes | None:
+        """Contenido para snapshot/clip aplicando latencia y errores configurados."""
+        if self.latency_ms > 0:
+            time.sleep(self.rng.expovariate(1.0 / self.latency_ms) / 1000.0)
+        with self._lock:
+            self.requests[kind] += 1
+            if self.error_rate > 0 and self.rng.random() < self.error_rate:
+                self.requests["errors"] += 1
+                return None
+        return self.snapshot if kind == "snapshot" else self.clip
+
+
+def make_http_server(sim: FrigateSim, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):  # silencioso
+            pass
+
+        def _send(self, code: int, body: bytes, ctype: str) -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/api/health":
+                return self._send(200, b'{"status":"ok"}', "application/json")
+            if path == "/api/config":
+                return self._send(200, json.dumps({"name": "frigate-sim"}).encode(), "application/json")
+            if path.startswith("/api/events/"):
+                kind = "snapshot" if path.endswith("/snapshot.jpg") else "clip" if path.endswith("/clip.mp4") else None
+                if kind:
+                    body = sim.media(kind)
+                    if body is None:
+                        return self._send(500, b"simulated error", "text/plain")
+                    return self._send(200, body, "image/jpeg" if kind == "snapshot" else "video/mp4")
+            self._send(404, b"not found", "text/plain")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--broker", default="127.0.0.1:1883", help="host:port del broker MQTT")
+    ap.add_argument("--topic", default="frigate/{server}/events", help="topic; {server} se reemplaza por sim<N>")
+    ap.add_argument("--servers", type=int, default=1)
+    ap.add_argument("--cameras", default="Portones,Ingreso,Salida")
+    ap.add_argument("--rate", type=float, default=10.0, help="eventos por segundo (total)")
+    ap.add_argument("--duration", type=float, default=60.0, help="segundos; 0 = sin límite")
+    ap.add_argument("--http-host", default="127.0.0.1")
+    ap.add_argument("--http-port", type=int, default=5055)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--sftp-root", default=None, help="carpeta local para crops/clips (sftp_host = local)")
+    args = ap.parse_args()
+
+    import paho.mqtt.client as mqtt
+
+    sim = FrigateSim([c.strip() for c in args.cameras.split(",") if c.strip()], sftp_root=args.sftp_root,
+                     latency_ms=args.latency_ms, error_rate=args.error_rate)
+    http = make_http_server(sim, args.http_host, args.http_port)
+    print(f"HTTP Frigate simulado en http://{args.http_host}:{http.server_address[1]}")
+
+    host, _, port = args.broker.partition(":")
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"frigate-sim-{os.getpid()}")
+    client.connect(host, int(port or 1883), 60)
+    client.loop_start()
+
+    servers = [f"sim{i}" for i in range(args.servers)]
+    interval = 1.0 / args.rate if args.rate > 0 else 1.0
+    start = next_at = time.monotonic()
+    sent = 0
+    try:
+        while not args.duration or time.monotonic() - start < args.duration:
+            srv = servers[sent % len(servers)]
+            _, _, msgs = sim.next_event()
+            for m in msgs:
+                client.publish(args.topic.format(server=srv), m, qos=1)
+            sent += 1
+            if sent % max(1, int(args.rate)) == 0:
+                print(f"{sent} eventos publicados | {sim.requests}")
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    http.shutdown()
+    print(f"Total: {sent} eventos en {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
 from fastapi import FastAPI, Body, Query
 from fastapi.responses import JSONResponse
-import os, json, threading, time, configparser, psutil, logging
+import os, json, threading, time, configparser, psutil, logging, queue, heapq
 import paho.mqtt.client as mqtt
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.engine import Engine
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
 
 # --- Config ---
 # Resolve configuration path with the following precedence:
@@ -25,7 +27,9 @@ if not CONF_PATH:
             break
     if not CONF_PATH:
         CONF_PATH = "/app/conteo.conf"
-cfg = configparser.ConfigParser()
+# conteo.conf documents values inline ("zone_in=IN   # ..."); strip those comments.
+# Only "#" preceded by whitespace: ";" stays part of the value (e.g. mqtt_pass).
+cfg = configparser.ConfigParser(inline_comment_prefixes=("#",))
 cfg.read(CONF_PATH)
 
 def cfg_get(section, key, default=""):
@@ -64,7 +68,7 @@ RETENTION_DAYS=int(os.getenv("RETENTION_DAYS", str(cfg_getint("app","retention_d
 # Ensure sqlite target directory exists if using absolute sqlite path and touch file
 try:
     if DB_URL.startswith("sqlite:////"):
-        _db_path = DB_URL[len("sqlite:////"):]
+        _db_path = DB_URL[len("sqlite:///"):]  # keep the leading "/"
         _db_dir = os.path.dirname(_db_path)
         os.makedirs(_db_dir, exist_ok=True)
         # touch file to ensure it can be created
@@ -197,6 +201,13 @@ stats_logger.addHandler(sfh)
 stats_logger.propagate = False
 
 START_TIME = time.time()
+
+# Local time for the API's day/hour buckets ([app] timezone, IANA name); stored times are UTC
+try:
+    LOCAL_TZ = ZoneInfo(cfg_get("app", "timezone", "UTC") or "UTC")
+except Exception as e:
+    app_log.warning(f"invalid [app] timezone ({e}), using UTC")
+    LOCAL_TZ = timezone.utc
 EVENTS_PROCESSED = 0
 LAST_EVENT_TS: float | None = None
 SERVERS_STATE: dict[str, dict] = {}
@@ -204,9 +215,74 @@ PROCESSED_EVENT_IDS: set = set()  # Dedup: track processed event IDs
 LABEL_COUNTS: dict[str, int] = {}  # Track count per label (auto, moto, personas, etc.)
 CAMERA_ZONE_COUNTS: dict[str, dict[str, int]] = {}  # Track IN/OUT per camera
 
+class CrossingCache:
+    """Last crossing time per key; keys expire `window` seconds (+ grace) after arrival.
+
+    The repeat check compares event times, as before. Expiry runs on arrival
+    time (monotonic), so NVR clock skew or late messages cannot expire a key
+    early: keys are filed in arrival-time buckets of window/slots seconds and a
+    min-heap keeps the bucket ids in order, so expiry drops whole buckets and
+    each insert is expired at most once (O(1) amortized, no sweeps).
+    """
+
+    def __init__(self, window: float, slots: int = 8, grace: float | None = None):
+        self.window = max(window, 0.001)
+        self.ttl = self.window + (self.window if grace is None else grace)
+        self.slot = self.window / slots
+        self._lock = threading.Lock()
+        self._last: dict[tuple, tuple] = {}  # key -> (event ts, arrival bucket)
+        self._buckets: dict[int, list] = {}
+        self._heap: list[int] = []
+        self.inserted = self.suppressed = self.expired = 0
+        self._rate_mark = (time.monotonic(), 0, 0)
+        self._rates = {"inserted_per_s": 0.0, "expired_per_s": 0.0}
+
+    def seen_recently(self, key: tuple, ts: float, now: float | None = None) -> bool:
+        """True if `key` crossed less than `window` seconds before `ts`; otherwise record it."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            last = self._last.get(key)
+            if last is not None and ts - last[0] < self.window:
+                self.suppressed += 1
+                return True
+            b = int(now // self.slot)
+            self._last[key] = (ts, b)
+            keys = self._buckets.get(b)
+            if keys is None:
+                self._buckets[b] = keys = []
+                heapq.heappush(self._heap, b)
+            keys.append(key)
+            self.inserted += 1
+            return False
+
+    def _expire(self, now: float):
+        # Buckets that ended more than ttl ago
+        limit = int((now - self.ttl) // self.slot)
+        while self._heap and self._heap[0] < limit:
+            b = heapq.heappop(self._heap)
+            for key in self._buckets.pop(b):
+                last = self._last.get(key)
+                if last is not None and last[1] == b:  # not refreshed since
+                    del self._last[key]
+                    self.expired += 1
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            at, inserted, expired = self._rate_mark
+            if now - at >= 5:
+                self._rates = {"inserted_per_s": round((self.inserted - inserted) / (now - at), 2),
+                               "expired_per_s": round((self.expired - expired) / (now - at), 2)}
+                self._rate_mark = (now, self.inserted, self.expired)
+            return {"size": len(self._last), "buckets": len(self._heap), "window_s": self.window,
+                    "inserted": self.inserted, "suppressed": self.suppressed, "expired": self.expired,
+                    **self._rates}
+
 # Zone crossing tracking: prevents counting same object in same zone within time window
-ZONE_CROSSINGS: dict[str, float] = {}  # key: "object_id_camera_zone_direction", value: timestamp
 ANTI_REPEAT_SECONDS = cfg_getint("anti_noise", "max_recount_ms", 1500) / 1000.0  # Convert ms to seconds
+ZONE_CROSSINGS = CrossingCache(ANTI_REPEAT_SECONDS)  # key: (object_id, camera, zone, direction)
 
 # Counter state tracking
 COUNTER_TOTALS: dict[str, dict] = {}  # counter_id -> {in, out, occupancy}
@@ -230,8 +306,137 @@ if not EN_TO_ES:
     EN_TO_ES={"car":"auto","motorcycle":"moto","bicycle":"bicicleta","bus":"autobús","person":"personas"}
 ES_VALID=set(EN_TO_ES.get(x, x) for x in OBJECTS)
 
+def _compile_routes():
+    """Routing tables built once from the config, so a message needs only dict lookups.
+
+    routes: (frigate_camera, label) -> counter ids (type=zones counters on that camera)
+    zones:  (frigate_camera, zone)  -> "IN" | "OUT", from each camera's zone_in/zone_out
+            (exact names; several can be given separated by commas)
+    """
+    routes: dict[tuple, list] = {}
+    all_labels = set(EN_TO_ES.values()) | ES_VALID
+    for counter_id, counter_cfg in COUNTERS.items():
+        cam_cfg = CAMERA_MAP.get(counter_cfg["source_camera"])
+        if counter_cfg["type"] != "zones" or not cam_cfg:
+            continue
+        for label in (counter_cfg["objects"] or all_labels):
+            routes.setdefault((cam_cfg["frigate_camera"], label), []).append(counter_id)
+    zones: dict[tuple, str] = {}
+    for cam_cfg in CAMERA_MAP.values():
+        for direction, key in (("IN", "zone_in"), ("OUT", "zone_out")):
+            for zone in cam_cfg[key].split(","):
+                if zone.strip():
+                    zones.setdefault((cam_cfg["frigate_camera"], zone.strip()), direction)
+    return {k: tuple(v) for k, v in routes.items()}, zones
+
+COUNTER_ROUTES, ZONE_DIRECTIONS = _compile_routes()
+
 engine: Engine = create_engine(DB_URL, pool_pre_ping=True, future=True)
 
+if DB_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: API readers don't block the writer; NORMAL is durable across app crashes in WAL mode
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.close()
+
+# Rollups: crossings per (camera, zone, direction, label) and minute/hour/day bucket.
+# Buckets are "YYYY-MM-DD HH:MM:SS" strings (bucket start), comparable with datetimes.
+ROLLUP_TABLES = {
+    "counts_minute": "%Y-%m-%d %H:%M:00",
+    "counts_hour": "%Y-%m-%d %H:00:00",
+    "counts_day": "%Y-%m-%d 00:00:00",
+}
+
+class ResultCache:
+    """Bounded LRU of per-day query results; keys end with the day they cover.
+
+    Only closed days are stored. Every invalidation bumps `generation`: a reader
+    takes it before querying and passes it to put(), so a result read before an
+    invalidation is never stored after it.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(0, max_entries)
+        self._lock = threading.Lock()
+        self._data: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = self.misses = self.live = self.evictions = self.invalidations = 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value, generation: int):
+        with self._lock:
+            if generation != self.generation or not self.max_entries:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def count_live(self):
+        """Count a day computed live because it is not closed yet."""
+        with self._lock:
+            self.live += 1
+
+    def invalidate(self, day_matches=None):
+        """Drop entries whose day satisfies day_matches(day), or all of them."""
+        with self._lock:
+            self.generation += 1
+            keys = [k for k in self._data if day_matches is None or day_matches(k[-1])]
+            for k in keys:
+                del self._data[k]
+            self.invalidations += len(keys)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._data), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                    "live_days": self.live, "evictions": self.evictions, "invalidations": self.invalidations}
+
+# Past days of /api/summary and counter history; a day is closed CACHE_CLOSE_GRACE after it ends
+RESULT_CACHE = ResultCache(cfg_getint("app", "cache_max_entries", 5000))
+CACHE_CLOSE_GRACE = timedelta(minutes=5)
+
+def _cached_days(prefix: tuple, segments: list[tuple], load) -> dict:
+    """Per-day results for segments [(day, utc_start, utc_end, full_day)].
+
+    Closed full days come from RESULT_CACHE; the rest are computed with a single
+    load(utc_start, utc_end) -> {day: result} over the span they cover.
+    """
+    now = datetime.utcnow()
+    out, missing = {}, []
+    for day, seg_start, seg_end, full_day in segments:
+        closed = full_day and seg_end + CACHE_CLOSE_GRACE <= now
+        hit = RESULT_CACHE.get(prefix + (day,)) if closed else None
+        if hit is None:
+            missing.append((day, seg_start, seg_end, closed))
+        else:
+            out[day] = hit
+    if missing:
+        generation = RESULT_CACHE.generation
+        loaded = load(min(m[1] for m in missing), max(m[2] for m in missing))
+        for day, _, _, closed in missing:
+            out[day] = loaded.get(day, {})
+            if closed:
+                RESULT_CACHE.put(prefix + (day,), out[day], generation)
+            else:
+                RESULT_CACHE.count_live()
+    return out
+
 def db_init():
     with engine.begin() as conn:
         conn.exec_driver_sql(
@@ -247,6 +452,48 @@ def db_init():
         """
         )
         conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_events_cam_time ON events(camera, end_time);")
+        for table in ROLLUP_TABLES:
+            conn.exec_driver_sql(
+                f"""
+            CREATE TABLE IF NOT EXISTS {table}(
+              camera TEXT NOT NULL,
+              bucket TEXT NOT NULL,
+              zone TEXT NOT NULL,
+              direction TEXT NOT NULL,
+              label TEXT NOT NULL,
+              count INTEGER NOT NULL,
+              PRIMARY KEY (camera, bucket, zone, direction, label)
+            ) WITHOUT ROWID;
+            """
+            )
+            # Range scans over every camera (summary without camera filter)
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table}(bucket);")
+        conn.exec_driver_sql(
+            """
+        CREATE TABLE IF NOT EXISTS counter_resets(
+          counter_id TEXT NOT NULL,
+          period_start TIMESTAMP,
+          reset_at TIMESTAMP NOT NULL,
+          in_count INTEGER NOT NULL,
+          out_count INTEGER NOT NULL,
+          occupancy INTEGER NOT NULL
+        );
+        """
+        )
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_counter_resets ON counter_resets(counter_id, reset_at);")
+        conn.exec_driver_sql(
+            """
+        CREATE TABLE IF NOT EXISTS counter_state(
+          counter_id TEXT PRIMARY KEY,
+          in_count INTEGER NOT NULL,
+          out_count INTEGER NOT NULL,
+          occupancy INTEGER NOT NULL,
+          period_start TIMESTAMP,
+          saved_at TIMESTAMP,
+          last_event_rowid INTEGER NOT NULL
+        );
+        """
+        )
         conn.exec_driver_sql(
             """
         CREATE TABLE IF NOT EXISTS settings(
@@ -264,15 +511,414 @@ db_init()
 
 def get_key(): return "ALL" if MODE=="multi" else CAMERA
 
-def get_active_labels():
+# Labels a camera may count at all: [camera:*] labels= (Frigate names), else every label
+CAMERA_LABELS: dict[str, frozenset] = {
+    c["frigate_camera"]: frozenset(EN_TO_ES.get(l, l) for l in c["labels"])
+    for c in CAMERA_MAP.values() if c["labels"]
+}
+
+# Active labels per Frigate camera, held in memory and rebuilt on every write to
+# settings. A camera's own settings row wins over the global key (get_key());
+# the result is limited to CAMERA_LABELS. on_message only does a dict lookup.
+_ACTIVE_LOCK = threading.Lock()
+_ACTIVE_ROWS: dict[str, frozenset] = {}
+_ACTIVE_LABELS: dict[str, frozenset] = {}
+_ACTIVE_DEFAULT: frozenset = frozenset(ES_VALID)
+
+def _rebuild_active_labels(rows: dict[str, frozenset]):
+    global _ACTIVE_ROWS, _ACTIVE_LABELS, _ACTIVE_DEFAULT
+    default = rows.get(get_key(), frozenset(ES_VALID))
+    active = {}
+    for cam in set(CONFIGURED_CAMERAS) | set(rows):
+        labels = rows.get(cam, default)
+        allowed = CAMERA_LABELS.get(cam)
+        active[cam] = labels & allowed if allowed else labels
+    _ACTIVE_LABELS = active
+    _ACTIVE_DEFAULT = default
+    _ACTIVE_ROWS = rows
+
+def load_active_labels():
     with engine.begin() as conn:
-        row = conn.execute(text("SELECT active_labels FROM settings WHERE camera=:c"), {"c": get_key()}).first()
-        return set(json.loads(row[0])) if row and row[0] else set(ES_VALID)
+        rows = conn.execute(text("SELECT camera, active_labels FROM settings")).all()
+    with _ACTIVE_LOCK:
+        _rebuild_active_labels({r[0]: frozenset(json.loads(r[1])) for r in rows if r[1]})
+
+def active_labels_for(cam):
+    """Active labels for a Frigate camera (no DB access)."""
+    return _ACTIVE_LABELS.get(cam, _ACTIVE_DEFAULT)
 
-def set_active_labels(labels):
+def get_active_labels(camera=None):
+    if camera and camera != get_key():
+        return set(active_labels_for(camera))
+    return set(_ACTIVE_DEFAULT)
+
+def set_active_labels(labels, camera=None):
+    key = camera or get_key()
+    labels = frozenset(labels)
+    with _ACTIVE_LOCK:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT OR REPLACE INTO settings(camera, active_labels) VALUES (:c, :a)"),
+                         {"a": json.dumps(sorted(labels)), "c": key})
+        _rebuild_active_labels({**_ACTIVE_ROWS, key: labels})
+
+load_active_labels()
+
+# --- Event writer ---
+# Crossings are queued by counting_loop and written by one thread in group commits:
+# a batch closes at WRITER_BATCH_SIZE rows or WRITER_MAX_DELAY_MS after its first row.
+# A failed batch is retried until it commits (its crossings are already in COUNTER_TOTALS);
+# meanwhile the bounded queue fills and slows counting_loop down instead of losing rows.
+WRITER_BATCH_SIZE = max(1, cfg_getint("app", "writer_batch_size", 500))
+WRITER_MAX_DELAY = max(0, cfg_getint("app", "writer_max_delay_ms", 200)) / 1000.0
+WRITER_WARN_ATTEMPTS = 3  # log as error from this attempt on
+WRITER_MAX_BACKOFF = 30.0
+EVENT_QUEUE: queue.Queue = queue.Queue(maxsize=50000)
+WRITER_STATS = {"batches": 0, "rows": 0, "errors": 0, "failing_since": None,
+                "last_commit_ms": 0.0, "max_commit_ms": 0.0, "avg_commit_ms": 0.0, "last_batch_size": 0}
+
+INSERT_EVENT_SQL = text("""
+    INSERT OR IGNORE INTO events(id,camera,label,start_time,end_time,zone)
+    VALUES (:id,:cam,:label,:start,:end,:zone)
+""")
+
+def queue_event(row: dict):
+    """Hand a crossing to the writer (blocks only if the backlog is full)."""
+    EVENT_QUEUE.put(row)
+
+def _write_batch(rows: list[dict]):
+    attempt = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            late_days, rebuilt = set(), False
+            with engine.begin() as conn:
+                # Counter state saves and rollup rebuilds run in queue order, between the crossings
+                pending = []
+                for row in rows:
+                    if "id" in row:
+                        pending.append(row)
+                        continue
+                    if pending:
+                        late_days |= _insert_events(conn, pending)
+                        pending = []
+                    if "state" in row:
+                        _save_state_rows(conn, row["state"])
+                    elif "archive" in row:
+                        conn.execute(ARCHIVE_RESET_SQL, row["archive"])
+                    elif "rebuild" in row:
+                        row["result"] = rebuild_rollups(conn)
+                        rebuilt = True
+                if pending:
+                    late_days |= _insert_events(conn, pending)
+            # Cached days changed by late crossings or a rebuild (after commit, see ResultCache)
+            if rebuilt:
+                RESULT_CACHE.invalidate()
+            elif late_days:
+                RESULT_CACHE.invalidate(late_days.__contains__)
+        except Exception as e:
+            attempt += 1
+            delay = min(WRITER_MAX_BACKOFF, 0.5 * 2 ** (attempt - 1))
+            WRITER_STATS["errors"] += 1
+            if WRITER_STATS["failing_since"] is None:
+                WRITER_STATS["failing_since"] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            log = app_log.error if attempt >= WRITER_WARN_ATTEMPTS else app_log.warning
+            log(f"writer: batch of {len(rows)} failed ({e}), attempt {attempt}, retrying in {delay:.1f}s "
+                f"(backlog {EVENT_QUEUE.qsize()})")
+            time.sleep(delay)
+            continue
+        _release_waiters(rows)
+        ms = (time.perf_counter() - t0) * 1000
+        st = WRITER_STATS
+        st["failing_since"] = None
+        st["batches"] += 1
+        st["rows"] += sum(1 for r in rows if "id" in r)
+        st["last_commit_ms"] = round(ms, 2)
+        st["max_commit_ms"] = round(max(st["max_commit_ms"], ms), 2)
+        st["avg_commit_ms"] = round(ms if st["batches"] == 1 else st["avg_commit_ms"] * 0.9 + ms * 0.1, 2)
+        st["last_batch_size"] = len(rows)
+        return
+
+def _release_waiters(rows: list[dict]):
+    for row in rows:
+        if "done" in row:
+            row["done"].set()
+
+def _insert_events(conn, rows: list[dict]) -> set:
+    """INSERT OR IGNORE the crossings and add the ones actually stored to the rollups.
+
+    Returns the days (UTC and local) of stored rows old enough to be in a cached closed day.
+    """
+    ids = list({r["id"] for r in rows})
+    stored = set()
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        marks = ",".join(f":i{j}" for j in range(len(chunk)))
+        stored.update(r[0] for r in conn.execute(text(f"SELECT id FROM events WHERE id IN ({marks})"),
+                                                 {f"i{j}": v for j, v in enumerate(chunk)}))
+    new = []
+    for r in rows:
+        if r["id"] not in stored:
+            stored.add(r["id"])
+            new.append(r)
+    if not new:
+        return set()
+    conn.execute(INSERT_EVENT_SQL, new)
+    acc = {table: {} for table in ROLLUP_TABLES}
+    for r in new:
+        direction = r.get("direction") or ZONE_DIRECTIONS.get((r["cam"], r["zone"]), "")
+        for table, fmt in ROLLUP_TABLES.items():
+            key = (r["cam"], r["end"].strftime(fmt), r["zone"], direction, r["label"])
+            acc[table][key] = acc[table].get(key, 0) + 1
+    _add_rollups(conn, acc)
+    late = datetime.utcnow() - CACHE_CLOSE_GRACE
+    return {d for r in new if r["end"] < late
+            for d in (r["end"].date(), r["end"].replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ).date())}
+
+def _add_rollups(conn, acc: dict[str, dict]):
+    for table, counts in acc.items():
+        if counts:
+            conn.execute(text(f"""
+                INSERT INTO {table}(camera,bucket,zone,direction,label,count) VALUES (:c,:b,:z,:d,:l,:n)
+                ON CONFLICT(camera,bucket,zone,direction,label) DO UPDATE SET count = count + excluded.count
+            """), [{"c": k[0], "b": k[1], "z": k[2], "d": k[3], "l": k[4], "n": n} for k, n in counts.items()])
+
+def rebuild_rollups(conn) -> dict:
+    """Regenerate every rollup table from raw events (runs on the writer thread)."""
+    t0 = time.perf_counter()
+    minutes = conn.execute(text("""
+        SELECT camera, strftime('%Y-%m-%d %H:%M:00', end_time) AS m, zone, label, COUNT(*)
+        FROM events
+        WHERE camera IS NOT NULL AND label IS NOT NULL AND end_time IS NOT NULL
+        GROUP BY camera, m, zone, label
+    """)).all()
+    acc = {table: {} for table in ROLLUP_TABLES}
+    for cam, minute, zone, label, n in minutes:
+        zone = zone or ""
+        direction = ZONE_DIRECTIONS.get((cam, zone), "")
+        for table, bucket in (("counts_minute", minute), ("counts_hour", minute[:13] + ":00:00"),
+                              ("counts_day", minute[:10] + " 00:00:00")):
+            key = (cam, bucket, zone, direction, label)
+            acc[table][key] = acc[table].get(key, 0) + n
+    for table in ROLLUP_TABLES:
+        conn.execute(text(f"DELETE FROM {table}"))
+    _add_rollups(conn, acc)
+    result = {"events": sum(r[4] for r in minutes), **{table: len(acc[table]) for table in ROLLUP_TABLES},
+              "ms": round((time.perf_counter() - t0) * 1000, 2)}
+    app_log.info(f"🔁 Rollups rebuilt: {result}")
+    return result
+
+def request_rollup_rebuild(timeout: float | None = None) -> dict | None:
+    """Queue a rebuild on the writer (ordered with pending crossings) and wait for it."""
+    marker = {"rebuild": True, "done": threading.Event()}
+    queue_event(marker)
+    marker["done"].wait(timeout)
+    return marker.get("result")
+
+def _ensure_rollups():
+    # Databases from before the rollups: build them once from the stored events
     with engine.begin() as conn:
-        conn.execute(text("UPDATE settings SET active_labels=:a WHERE camera=:c"),
-                     {"a": json.dumps(sorted(set(labels))), "c": get_key()})
+        if conn.execute(text("SELECT 1 FROM counts_day LIMIT 1")).first():
+            return
+        if not conn.execute(text("SELECT 1 FROM events LIMIT 1")).first():
+            return
+        rebuild_rollups(conn)
+
+def event_writer_loop():
+    while True:
+        row = EVENT_QUEUE.get()
+        if row is None:
+            break
+        batch = [row]
+        deadline = time.monotonic() + WRITER_MAX_DELAY
+        stop = False
+        while len(batch) < WRITER_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                nxt = EVENT_QUEUE.get(timeout=remaining) if remaining > 0 else EVENT_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                stop = True
+                break
+            batch.append(nxt)
+        _write_batch(batch)
+        if stop:
+            break
+
+def writer_metrics():
+    return {**WRITER_STATS, "backlog": EVENT_QUEUE.qsize()}
+
+# --- Counter state ---
+# COUNTER_TOTALS is saved to counter_state every STATE_SAVE_INTERVAL and on shutdown.
+# Saves go through the event writer queue, so a save is written after every crossing
+# counted before it, and last_event_rowid marks the newest of those rows. On start the
+# totals are the last save plus one aggregate over the events after that rowid: the
+# cost depends on the time since the last save, not on the size of the history.
+STATE_SAVE_INTERVAL = max(5, cfg_getint("app", "state_save_seconds", 60))
+COUNTER_PERIOD_START: dict[str, datetime] = {}  # counter_id -> start of the current totals
+COUNTER_STATE_INFO = {"restored_from": None, "replayed_events": 0, "restore_ms": 0.0, "saves": 0}
+_state_saved_at = 0.0
+
+SAVE_STATE_SQL = text("""
+    INSERT OR REPLACE INTO counter_state(counter_id,in_count,out_count,occupancy,period_start,saved_at,last_event_rowid)
+    VALUES (:id,:in,:out,:occupancy,:period_start,:saved_at,:last_rowid)
+""")
+
+def _save_state_rows(conn, rows: list[dict]):
+    if not rows:
+        return  # no counters configured
+    last_rowid = conn.execute(text("SELECT COALESCE(MAX(rowid), 0) FROM events")).scalar()
+    conn.execute(SAVE_STATE_SQL, [{**r, "last_rowid": last_rowid} for r in rows])
+    COUNTER_STATE_INFO["saves"] += 1
+
+def save_counter_state():
+    """Queue the current totals for the writer. Call on the counting thread (or before it starts)."""
+    global _state_saved_at
+    now = datetime.utcnow()
+    queue_event({"state": [
+        {"id": cid, "in": t["in"], "out": t["out"], "occupancy": t["occupancy"],
+         "period_start": COUNTER_PERIOD_START.setdefault(cid, now), "saved_at": now}
+        for cid, t in COUNTER_TOTALS.items()
+    ]})
+    _state_saved_at = time.monotonic()
+
+def restore_counter_state():
+    t0 = time.perf_counter()
+    with engine.begin() as conn:
+        saved = conn.execute(text(
+            "SELECT counter_id, in_count, out_count, occupancy, period_start, saved_at, last_event_rowid FROM counter_state"
+        )).all()
+        if not saved:
+            return  # first start: initial_occupancy, counting from now on
+        last_rowid = max(r[6] for r in saved)
+        restored_from = max(r[5] for r in saved if r[6] == last_rowid)
+        replay = conn.execute(text(
+            "SELECT camera, label, zone, strftime('%Y-%m-%d %H:%M:00', end_time) AS m, COUNT(*) FROM events "
+            "WHERE rowid > :r GROUP BY camera, label, zone, m"
+        ), {"r": last_rowid}).all()
+    for cid, in_count, out_count, occupancy, period_start, _, rowid in saved:
+        # Rows left by an older save belong to counters removed from the config at the time
+        if cid in COUNTER_TOTALS and rowid == last_rowid:
+            COUNTER_TOTALS[cid] = {"in": in_count, "out": out_count, "occupancy": occupancy}
+            if period_start:
+                COUNTER_PERIOD_START[cid] = period_start if isinstance(period_start, datetime) else datetime.fromisoformat(str(period_start))
+    # Resets due while the service was down: crossings from the reset minute on go to the new period
+    now_local = datetime.now(LOCAL_TZ)
+    cuts = {}
+    for cid, period_start in COUNTER_PERIOD_START.items():
+        cut = _last_reset_at(cid, now_local)
+        if cut is not None and period_start < cut:
+            cuts[cid] = cut
+    after = {cid: {"in": 0, "out": 0, "occupancy": 0} for cid in cuts}
+    replayed = 0
+    for cam, label, zone, minute, n in replay:
+        direction = ZONE_DIRECTIONS.get((cam, zone))
+        if direction is None:
+            continue
+        replayed += n
+        for cid in COUNTER_ROUTES.get((cam, label), ()):
+            cut = cuts.get(cid)
+            totals = after[cid] if cut is not None and minute >= cut.strftime('%Y-%m-%d %H:%M:%S') else COUNTER_TOTALS[cid]
+            totals["in" if direction == "IN" else "out"] += n
+            totals["occupancy"] += n if direction == "IN" else -n
+    for cid, cut in cuts.items():
+        # Several missed resets are archived as one period
+        period_start, previous = COUNTER_PERIOD_START[cid], _archive_and_reset(cid, cut)
+        totals = COUNTER_TOTALS[cid]
+        for k in totals:
+            totals[k] += after[cid][k]
+        app_log.info(f"🔄 Counter {cid}: missed reset at {cut} applied on restore (previous {previous})")
+        publish_counter_reset(cid, previous, dict(totals), period_start, cut)
+    ms = round((time.perf_counter() - t0) * 1000, 2)
+    COUNTER_STATE_INFO.update({"restored_from": str(restored_from), "replayed_events": replayed, "restore_ms": ms})
+    app_log.info(f"♻️ Counter totals restored from {restored_from} + {replayed} later events in {ms} ms")
+
+def counter_state_metrics():
+    return {**COUNTER_STATE_INFO, "save_interval_s": STATE_SAVE_INTERVAL}
+
+# --- Counter resets ---
+# [counter:*] reset_schedule=HH:MM (local time of [app] timezone; several separated by
+# commas). One scheduler thread keeps a heap of (next run, counter) and hands each reset
+# to the counting thread; the totals before the reset are archived in counter_resets.
+ARCHIVE_RESET_SQL = text("""
+    INSERT INTO counter_resets(counter_id,period_start,reset_at,in_count,out_count,occupancy)
+    VALUES (:id,:period_start,:reset_at,:in,:out,:occupancy)
+""")
+RESET_STATS: dict[str, dict] = {}  # counter_id -> {"last_reset", "next_reset"}
+
+def _parse_reset_times(raw: str, counter_id: str) -> list[tuple[int, int]]:
+    times = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            hh, mm = (int(x) for x in part.split(":"))
+            if not (0 <= hh < 24 and 0 <= mm < 60):
+                raise ValueError(part)
+            times.append((hh, mm))
+        except ValueError:
+            app_log.warning(f"[counter:{counter_id}] invalid reset_schedule '{part}' (expected HH:MM), ignored")
+    return times
+
+RESET_TIMES = {cid: t for cid, c in COUNTERS.items() if (t := _parse_reset_times(c["reset_schedule"], cid))}
+
+def _next_local(hm: tuple[int, int], after: datetime) -> datetime:
+    """First local time hm strictly after `after` (aware, LOCAL_TZ)."""
+    candidate = after.replace(hour=hm[0], minute=hm[1], second=0, microsecond=0)
+    return candidate if candidate > after else candidate + timedelta(days=1)
+
+def _last_reset_at(counter_id: str, now_local: datetime) -> datetime | None:
+    """Latest scheduled reset at or before now_local, as naive UTC."""
+    last = None
+    for hm in RESET_TIMES.get(counter_id, ()):
+        candidate = _next_local(hm, now_local) - timedelta(days=1)
+        last = candidate if last is None or candidate > last else last
+    return last.astimezone(timezone.utc).replace(tzinfo=None) if last else None
+
+def _archive_and_reset(counter_id: str, reset_at: datetime) -> dict:
+    """Archive the current totals and start a new period at reset_at; returns the old totals."""
+    previous = dict(COUNTER_TOTALS[counter_id])
+    queue_event({"archive": [{"id": counter_id, "period_start": COUNTER_PERIOD_START.get(counter_id),
+                              "reset_at": reset_at, **previous}]})
+    COUNTER_TOTALS[counter_id] = {"in": 0, "out": 0, "occupancy": COUNTERS[counter_id]["initial_occupancy"]}
+    COUNTER_PERIOD_START[counter_id] = reset_at
+    RESET_STATS.setdefault(counter_id, {})["last_reset"] = reset_at.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return previous
+
+def reset_counter(counter_id: str, reset_at: datetime):
+    """Run on the counting thread (run_on_counter)."""
+    period_start = COUNTER_PERIOD_START.get(counter_id)
+    previous = _archive_and_reset(counter_id, reset_at)
+    save_counter_state()
+    app_log.info(f"🔄 Counter {counter_id} reset (previous IN={previous['in']} OUT={previous['out']} occupancy={previous['occupancy']})")
+    publish_counter_reset(counter_id, previous, dict(COUNTER_TOTALS[counter_id]), period_start, reset_at)
+
+def reset_scheduler_loop():
+    heap = []
+    now = datetime.now(LOCAL_TZ)
+    for cid, times in RESET_TIMES.items():
+        for hm in times:
+            heapq.heappush(heap, (_next_local(hm, now).timestamp(), cid, hm))
+    for cid in RESET_TIMES:
+        _set_next_reset(cid, heap)
+    while heap:
+        fire_ts, cid, hm = heap[0]
+        delay = fire_ts - time.time()
+        if delay > 0:
+            time.sleep(min(delay, 30))  # re-check: wall clock may be adjusted
+            continue
+        heapq.heappop(heap)
+        reset_at = datetime.utcfromtimestamp(fire_ts)
+        run_on_counter(lambda cid=cid, reset_at=reset_at: reset_counter(cid, reset_at))
+        fire_local = datetime.fromtimestamp(fire_ts, LOCAL_TZ)
+        heapq.heappush(heap, (_next_local(hm, fire_local).timestamp(), cid, hm))
+        _set_next_reset(cid, heap)
+
+def _set_next_reset(cid: str, heap: list):
+    next_ts = min((t for t, c, _ in heap if c == cid), default=None)
+    if next_ts is not None:
+        RESET_STATS.setdefault(cid, {})["next_reset"] = datetime.utcfromtimestamp(next_ts).strftime('%Y-%m-%dT%H:%M:%SZ')
 
 def keep_retention():
     if RETENTION_DAYS<=0: return
@@ -280,6 +926,10 @@ def keep_retention():
         limit = datetime.utcnow() - timedelta(days=RETENTION_DAYS)
         with engine.begin() as conn:
             conn.execute(text("DELETE FROM events WHERE end_time < :limit"), {"limit": limit})
+            for table, fmt in ROLLUP_TABLES.items():
+                conn.execute(text(f"DELETE FROM {table} WHERE bucket < :b"), {"b": limit.strftime(fmt)})
+        # Cached days overlapping the purged range (a local day can start the previous UTC day)
+        RESULT_CACHE.invalidate(lambda day: day <= limit.date() + timedelta(days=1))
         time.sleep(3600)
 
 def stats_loop():
@@ -290,6 +940,7 @@ def stats_loop():
             mem_mb = proc.memory_info().rss / (1024*1024)
             ts_iso = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
             uptime = int(time.time() - START_TIME)
+            snap = counting_snapshot()
             payload = {
                 "timestamp": ts_iso,
                 "uptime_seconds": uptime,
@@ -298,8 +949,12 @@ def stats_loop():
                 "memory_mb": round(mem_mb, 1),
                 "running": True,
                 "status": "running",
-                "events_processed": int(EVENTS_PROCESSED),
-                "last_event": datetime.utcfromtimestamp(LAST_EVENT_TS).strftime('%Y-%m-%dT%H:%M:%SZ') if LAST_EVENT_TS else None,
+                "events_processed": int(snap.get("events_processed", 0)),
+                "last_event": datetime.utcfromtimestamp(snap["last_event_ts"]).strftime('%Y-%m-%dT%H:%M:%SZ') if snap.get("last_event_ts") else None,
+                "counting": counting_metrics(),
+                "writer": writer_metrics(),
+                "crossings": ZONE_CROSSINGS.metrics(),
+                "result_cache": RESULT_CACHE.metrics(),
             }
             stats_logger.info(json.dumps(payload))
         except Exception as e:
@@ -361,9 +1016,80 @@ def _make_client(srv:dict):
     client.on_message=on_message
     return client
 
+# --- Counting consumer ---
+# MQTT callbacks (one thread per [server:*]) only enqueue the raw payload. A single
+# thread, counting_loop, parses it and owns all counting state: COUNTER_TOTALS,
+# LABEL_COUNTS, CAMERA_ZONE_COUNTS, EVENTS_PROCESSED/LAST_EVENT_TS and ZONE_CROSSINGS.
+# Readers (API, status/stats loops) use counting_snapshot(), an immutable copy the
+# consumer swaps in after each batch, so in/out/occupancy always match each other.
+COUNT_QUEUE: queue.SimpleQueue = queue.SimpleQueue()  # bytes payloads, or callables run on the consumer
+COUNT_BATCH_SIZE = 1000
+COUNT_STATS = {"messages": 0, "batches": 0, "errors": 0, "snapshot_ts": None}
+_COUNT_SNAPSHOT: dict = {}
+
 def on_message(client, userdata, msg):
+    COUNT_QUEUE.put(msg.payload)
+
+def run_on_counter(fn):
+    """Run fn() on the consumer thread, ordered with the messages queued before it."""
+    COUNT_QUEUE.put(fn)
+
+def _publish_snapshot():
+    global _COUNT_SNAPSHOT
+    _COUNT_SNAPSHOT = {
+        "events_processed": EVENTS_PROCESSED,
+        "last_event_ts": LAST_EVENT_TS,
+        "counters": {cid: dict(t) for cid, t in COUNTER_TOTALS.items()},
+        "cameras": {cam: dict(c) for cam, c in CAMERA_ZONE_COUNTS.items()},
+        "labels": dict(LABEL_COUNTS),
+    }
+    COUNT_STATS["snapshot_ts"] = time.time()
+
+def counting_snapshot() -> dict:
+    """Consistent, read-only view of the counting state (do not mutate)."""
+    return _COUNT_SNAPSHOT
+
+def flush_counting(timeout: float | None = None) -> bool:
+    """Wait until everything queued so far is counted and visible in the snapshot."""
+    done = threading.Event()
+    def _mark():
+        _publish_snapshot()
+        done.set()
+    COUNT_QUEUE.put(_mark)
+    return done.wait(timeout)
+
+def counting_loop():
+    while True:
+        item = COUNT_QUEUE.get()
+        n = 0
+        while True:
+            try:
+                if callable(item):
+                    item()
+                else:
+                    _count_message(item)
+                    COUNT_STATS["messages"] += 1
+            except Exception as e:
+                COUNT_STATS["errors"] += 1
+                app_log.error(f"counting error: {e}")
+            n += 1
+            if n >= COUNT_BATCH_SIZE:
+                break
+            try:
+                item = COUNT_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+        COUNT_STATS["batches"] += 1
+        if time.monotonic() - _state_saved_at >= STATE_SAVE_INTERVAL:
+            save_counter_state()
+        _publish_snapshot()
+
+def counting_metrics():
+    return {**COUNT_STATS, "backlog": COUNT_QUEUE.qsize()}
+
+def _count_message(raw: bytes):
     try:
-        payload=json.loads(msg.payload.decode("utf-8","ignore"))
+        payload=json.loads(raw.decode("utf-8","ignore"))
         ev_type=payload.get("type")
         after=payload.get("after") or {}
         cam=after.get("camera") or payload.get("camera")
@@ -378,7 +1104,7 @@ def on_message(client, userdata, msg):
         if MODE=="multi" and CAMERA_LIST and cam not in CAMERA_LIST: return
         label=EN_TO_ES.get(label_en)
         if not label: return
-        if label not in get_active_labels(): return
+        if label not in active_labels_for(cam): return
         
         # Get object tracking ID (Frigate assigns unique IDs to tracked objects)
         object_id = after.get("id") or payload.get("id")
@@ -398,51 +1124,23 @@ def on_message(client, userdata, msg):
         if not entered_zones or not isinstance(entered_zones, list):
             return  # No zone crossing, skip
         
-        # Find applicable counters for this camera
-        applicable_counters = []
-        for counter_id, counter_cfg in COUNTERS.items():
-            if counter_cfg["type"] == "zones":
-                # Check if this camera matches the counter's source_camera
-                source_alias = counter_cfg["source_camera"]
-                if source_alias in CAMERA_MAP:
-                    if CAMERA_MAP[source_alias]["frigate_camera"] == cam:
-                        # Check if object type is allowed
-                        if not counter_cfg["objects"] or label in counter_cfg["objects"]:
-                            applicable_counters.append(counter_id)
-        
+        # Counters for this camera/label (precompiled by _compile_routes)
+        applicable_counters = COUNTER_ROUTES.get((cam, label))
         if not applicable_counters:
             return  # No counters configured for this camera/object, skip
         
-        # Process each zone crossing
-        global ZONE_CROSSINGS, EVENTS_PROCESSED, LAST_EVENT_TS, LABEL_COUNTS, CAMERA_ZONE_COUNTS, COUNTER_TOTALS
+        # Process each zone crossing (only counting_loop gets here)
+        global EVENTS_PROCESSED, LAST_EVENT_TS
         
         for zone in entered_zones:
-            zone_upper = zone.upper()
-            
-            # Determine direction based on zone name
-            if "IN" in zone_upper:
-                direction = "IN"
-            elif "OUT" in zone_upper:
-                direction = "OUT"
-            else:
-                continue  # Skip zones that aren't IN or OUT
+            direction = ZONE_DIRECTIONS.get((cam, zone))
+            if direction is None:
+                continue  # Not this camera's zone_in/zone_out
             
-            # Create unique key for this crossing
-            crossing_key = f"{object_id}_{cam}_{zone}_{direction}"
-            
-            # Check if we already counted this crossing recently (anti-repeat)
-            last_crossing_ts = ZONE_CROSSINGS.get(crossing_key, 0)
-            if end_ts - last_crossing_ts < ANTI_REPEAT_SECONDS:
+            # Check if we already counted this crossing recently (anti-repeat); records it otherwise
+            if ZONE_CROSSINGS.seen_recently((object_id, cam, zone, direction), end_ts):
                 continue  # Too soon, skip (duplicate)
             
-            # Record this crossing
-            ZONE_CROSSINGS[crossing_key] = end_ts
-            
-            # Clean up old crossings (keep only last 1 hour)
-            if len(ZONE_CROSSINGS) > 10000:
-                cutoff = end_ts - 3600
-                ZONE_CROSSINGS = {k: v for k, v in ZONE_CROSSINGS.items() if v > cutoff}
-            
             # Generate event ID for database
             eid = f"{object_id}_{cam}_{zone}_{int(end_ts*1000)}"
             
@@ -450,18 +1148,11 @@ def on_message(client, userdata, msg):
             counter_names = ",".join(applicable_counters)
             app_log.info(f"✅ COUNT [{cam}] {label} ({label_en}) {direction} zone={zone} counters=[{counter_names}] id={object_id[:8]}...")
             
-            # Store in database
-            with engine.begin() as conn:
-                conn.execute(
-                    text("""
-                        INSERT OR IGNORE INTO events(id,camera,label,start_time,end_time,zone)
-                        VALUES (:id,:cam,:label,:start,:end,:zone)
-                    """),
-                    {"id": eid, "cam": cam, "label": label,
-                     "start": datetime.utcfromtimestamp(start_ts),
-                     "end": datetime.utcfromtimestamp(end_ts),
-                     "zone": zone}
-                )
+            # Store in database (group-committed by event_writer_loop)
+            queue_event({"id": eid, "cam": cam, "label": label,
+                         "start": datetime.utcfromtimestamp(start_ts),
+                         "end": datetime.utcfromtimestamp(end_ts),
+                         "zone": zone, "direction": direction})
             
             # Update stats counters
             try:
@@ -515,15 +1206,10 @@ def _setup_publish_client(srv: dict) -> mqtt.Client:
     
     return client
 
-def publish_count_event(counter_id: str, direction: str, totals: dict):
-    """Publish count event to MQTT"""
+def _publish_client() -> mqtt.Client | None:
+    """Client for [publish:mqtt] (created on first use), or None if publishing is off."""
     if not PUBLISH_CONFIG["mqtt"]["enabled"]:
-        return
-    
-    # Validate counter_id
-    if not counter_id or not isinstance(counter_id, str) or counter_id.strip() == "":
-        app_log.error(f"📤 Invalid counter_id for publishing: {counter_id}")
-        return
+        return None
     
     # Find the server to publish to
     target_server = PUBLISH_CONFIG["mqtt"]["server"]
@@ -532,7 +1218,7 @@ def publish_count_event(counter_id: str, direction: str, totals: dict):
         if SERVERS:
             target_server = SERVERS[0]["id"]
         else:
-            return
+            return None
     
     # Get or create publish client
     if target_server not in PUBLISH_CLIENTS:
@@ -543,10 +1229,24 @@ def publish_count_event(counter_id: str, direction: str, totals: dict):
                 srv_cfg = srv
                 break
         if not srv_cfg:
-            return
+            return None
         PUBLISH_CLIENTS[target_server] = _setup_publish_client(srv_cfg)
     
-    client = PUBLISH_CLIENTS[target_server]
+    return PUBLISH_CLIENTS[target_server]
+
+def publish_count_event(counter_id: str, direction: str, totals: dict):
+    """Publish count event to MQTT"""
+    if not PUBLISH_CONFIG["mqtt"]["enabled"]:
+        return
+    
+    # Validate counter_id
+    if not counter_id or not isinstance(counter_id, str) or counter_id.strip() == "":
+        app_log.error(f"📤 Invalid counter_id for publishing: {counter_id}")
+        return
+    
+    client = _publish_client()
+    if client is None:
+        return
     topic_prefix = PUBLISH_CONFIG["mqtt"]["topic_prefix"]
     qos = PUBLISH_CONFIG["mqtt"]["qos"]
     retain = PUBLISH_CONFIG["mqtt"]["retain"]
@@ -585,6 +1285,28 @@ def publish_count_event(counter_id: str, direction: str, totals: dict):
     except Exception as e:
         app_log.error(f"📤 Error publishing to MQTT: {e}. Topic_prefix={topic_prefix}, counter_id={counter_id}")
 
+def publish_counter_reset(counter_id: str, previous: dict, totals: dict, period_start, reset_at: datetime):
+    """Publish a counter reset: <prefix>/<id>/reset with the archived totals, then the new totals"""
+    client = _publish_client()
+    if client is None:
+        return
+    topic_prefix = PUBLISH_CONFIG["mqtt"]["topic_prefix"]
+    qos = PUBLISH_CONFIG["mqtt"]["qos"]
+    retain = PUBLISH_CONFIG["mqtt"]["retain"]
+    ts = lambda dt: dt.strftime('%Y-%m-%dT%H:%M:%SZ') if dt else None
+    try:
+        reset_payload = {
+            "previous": {"in": previous["in"], "out": previous["out"], "occupancy": previous["occupancy"]},
+            "period_start": ts(period_start),
+            "reset_at": ts(reset_at),
+        }
+        client.publish(f"{topic_prefix}/{counter_id}/reset", json.dumps(reset_payload), qos=qos, retain=False)
+        totals_payload = {"in": totals["in"], "out": totals["out"], "occupancy": totals["occupancy"], "ts": ts(reset_at)}
+        client.publish(f"{topic_prefix}/{counter_id}/totals", json.dumps(totals_payload), qos=qos, retain=retain)
+        app_log.debug(f"📤 Published reset of {counter_id}: {reset_payload}")
+    except Exception as e:
+        app_log.error(f"📤 Error publishing reset to MQTT: {e}. Topic_prefix={topic_prefix}, counter_id={counter_id}")
+
 def mqtt_loop(srv:dict):
     client=_make_client(srv)
     while True:
@@ -602,6 +1324,8 @@ def mqtt_loop(srv:dict):
 def status_loop():
     while True:
         try:
+            snap = counting_snapshot()
+            camera_counts, counter_totals, label_counts = snap["cameras"], snap["counters"], snap["labels"]
             lines=[
                 "\n" + "="*50,
                 "📊 APP STATUS",
@@ -626,9 +1350,9 @@ def status_loop():
             lines.append("")
             lines.append("📹 CAMERAS (IN/OUT)")
             lines.append("-"*50)
-            if CAMERA_ZONE_COUNTS:
-                for cam in sorted(CAMERA_ZONE_COUNTS.keys()):
-                    counts = CAMERA_ZONE_COUNTS[cam]
+            if camera_counts:
+                for cam in sorted(camera_counts.keys()):
+                    counts = camera_counts[cam]
                     in_count = counts.get("IN", 0)
                     out_count = counts.get("OUT", 0)
                     balance = in_count - out_count
@@ -638,15 +1362,15 @@ def status_loop():
             else:
                 lines.append("  (no data yet)")
             
-            total = int(EVENTS_PROCESSED)
-            last_ev = datetime.utcfromtimestamp(LAST_EVENT_TS).strftime('%Y-%m-%dT%H:%M:%SZ') if LAST_EVENT_TS else "-"
+            total = int(snap["events_processed"])
+            last_ev = datetime.utcfromtimestamp(snap["last_event_ts"]).strftime('%Y-%m-%dT%H:%M:%SZ') if snap["last_event_ts"] else "-"
             # Add counters section
             lines.append("")
             lines.append("🎯 COUNTERS")
             lines.append("-"*50)
-            if COUNTER_TOTALS:
-                for counter_id in sorted(COUNTER_TOTALS.keys()):
-                    totals = COUNTER_TOTALS[counter_id]
+            if counter_totals:
+                for counter_id in sorted(counter_totals.keys()):
+                    totals = counter_totals[counter_id]
                     in_count = totals.get("in", 0)
                     out_count = totals.get("out", 0)
                     occupancy = totals.get("occupancy", 0)
@@ -658,7 +1382,7 @@ def status_loop():
             lines.append("")
             lines.append("📈 OBJECTS DETECTED")
             lines.append("-"*50)
-            if LABEL_COUNTS:
+            if label_counts:
                 # Map labels to emojis
                 emoji_map = {
                     "auto": "🚗",
@@ -668,9 +1392,9 @@ def status_loop():
                     "autobús": "🚌",
                     "bus": "🚌",
                 }
-                for lbl in sorted(LABEL_COUNTS.keys()):
+                for lbl in sorted(label_counts.keys()):
                     emoji = emoji_map.get(lbl, "📦")
-                    lines.append(f"  {emoji} {lbl}: {LABEL_COUNTS[lbl]}")
+                    lines.append(f"  {emoji} {lbl}: {label_counts[lbl]}")
             else:
                 lines.append("  (no objects detected yet)")
             
@@ -682,6 +1406,22 @@ def status_loop():
             app_log.error(f"status_loop error: {e}")
         time.sleep(60)
 
+try:
+    _ensure_rollups()
+except Exception as e:
+    app_log.error(f"rollup build failed (POST /api/rollups/rebuild to retry): {e}")
+_writer_thread = threading.Thread(target=event_writer_loop, name="event-writer", daemon=True)
+_writer_thread.start()
+try:
+    restore_counter_state()
+    save_counter_state()
+except Exception as e:
+    # Keep the saved state as it is; the next periodic save replaces it
+    app_log.error(f"counter state restore failed, starting from initial_occupancy: {e}")
+_publish_snapshot()
+threading.Thread(target=counting_loop, name="counting", daemon=True).start()
+if RESET_TIMES:
+    threading.Thread(target=reset_scheduler_loop, name="reset-scheduler", daemon=True).start()
 for _srv in SERVERS:
     if _srv.get("enabled", True):
         threading.Thread(target=mqtt_loop, args=(_srv,), daemon=True).start()
@@ -691,6 +1431,17 @@ threading.Thread(target=status_loop, daemon=True).start()
 
 app=FastAPI(title=f"Contador - {TITLE}")
 
+@app.on_event("shutdown")
+def _flush_writer():
+    # Count, save the totals and write what is still queued before exiting
+    run_on_counter(save_counter_state)
+    flush_counting(timeout=5)
+    try:
+        EVENT_QUEUE.put(None, timeout=10)
+    except queue.Full:
+        app_log.error(f"writer: still failing at shutdown, {EVENT_QUEUE.qsize()} queued rows not written")
+    _writer_thread.join(timeout=10)
+
 @app.get("/health")
 def health_check():
     """
@@ -702,8 +1453,14 @@ def health_check():
         "service": "conteo-backend",
         "mode": MODE,
         "uptime_seconds": int(time.time() - START_TIME),
-        "events_processed": EVENTS_PROCESSED,
-        "counters": len(COUNTER_TOTALS),
+        "events_processed": counting_snapshot()["events_processed"],
+        "counting": counting_metrics(),
+        "writer": writer_metrics(),
+        "crossings": ZONE_CROSSINGS.metrics(),
+        "counter_state": counter_state_metrics(),
+        "counter_resets": RESET_STATS,
+        "result_cache": RESULT_CACHE.metrics(),
+        "counters": len(COUNTERS),
         "cameras": len(CAMERA_MAP)
     }
 
@@ -712,18 +1469,30 @@ def api_info():
     return {"mode": ("multi" if MODE=="multi" else "single"), "title": TITLE, "cameras": CAMERA_LIST}
 
 @app.get("/api/state")
-def api_state():
-    return {"camera": TITLE, "activos": sorted(get_active_labels()), "objetos": sorted(ES_VALID)}
+def api_state(camera: str|None = Query(default=None)):
+    return {"camera": camera or TITLE, "activos": sorted(get_active_labels(camera)), "objetos": sorted(ES_VALID)}
 
 @app.post("/api/toggle")
 def api_toggle(payload=Body(...)):
     label=(payload or {}).get("label")
+    camera=(payload or {}).get("camera")
     if not label: return JSONResponse({"error":"label requerido"},status_code=400)
-    act=get_active_labels()
+    act=get_active_labels(camera)
     if label in act: act.remove(label)
     else: act.add(label)
-    set_active_labels(act)
-    return {"activos": sorted(act)}
+    set_active_labels(act, camera)
+    return {"activos": sorted(get_active_labels(camera))}
+
+@app.post("/api/rollups/rebuild")
+def api_rollups_rebuild():
+    """
+    Regenerate the minute/hour/day rollups from raw events
+    Example: curl -X POST /api/rollups/rebuild
+    """
+    result = request_rollup_rebuild(timeout=600)
+    if result is None:
+        return JSONResponse({"error": "rebuild failed or timed out, see conteo.log"}, status_code=500)
+    return result
 
 def _range(view:str, day:date):
     if view=="day":
@@ -741,6 +1510,9 @@ def _range(view:str, day:date):
         return start,end,labels
     return _range("day",day)
 
+def _bucket_str(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
 def _camera_clause(camera_param:str|None):
     if MODE=="single":
         return "camera=:cam", {"cam": CAMERA}
@@ -753,45 +1525,88 @@ def _camera_clause(camera_param:str|None):
         params = {f"cam{i}": c for i,c in enumerate(CAMERA_LIST)}
         return f"camera IN ({placeholders})", params
 
+def _utc_naive(local: datetime) -> datetime:
+    """Naive local wall time -> naive UTC (how end_time and the rollup buckets are stored)."""
+    return local.replace(tzinfo=LOCAL_TZ).astimezone(timezone.utc).replace(tzinfo=None)
+
+def _rollup_spans(start: datetime, end: datetime, tables: list[str]) -> list[tuple]:
+    """Split [start, end) into (source, lo, hi) pieces read from the coarsest source that fits.
+
+    tables go finest first; source is None for the sub-minute edges, read from raw events.
+    """
+    steps = {"counts_minute": timedelta(minutes=1), "counts_hour": timedelta(hours=1),
+             "counts_day": timedelta(days=1)}
+    spans, source, lo, hi = [], None, start, end
+    for table in tables:
+        floor = lambda dt: datetime.strptime(dt.strftime(ROLLUP_TABLES[table]), "%Y-%m-%d %H:%M:%S")
+        a, b = floor(lo), floor(hi)
+        if a < lo:
+            a += steps[table]
+        if a >= b:
+            break
+        spans += [(source, x, y) for x, y in ((lo, a), (b, hi)) if x < y]
+        source, lo, hi = table, a, b
+    if lo < hi:
+        spans.append((source, lo, hi))
+    return spans
+
 @app.get("/api/summary")
-def api_summary(view:str="day", date:str=datetime.utcnow().date().isoformat(), camera: str|None = Query(default=None)):
+def api_summary(view:str="day", date:str|None=None, camera: str|None = Query(default=None)):
     try: day=datetime.strptime(date,"%Y-%m-%d").date()
-    except Exception: day=datetime.utcnow().date()
+    except Exception: day=datetime.now(LOCAL_TZ).date()
     start,end,labels=_range(view, day)
-    act=set(get_active_labels())
+    act=get_active_labels(camera if camera!="ALL" else None)
     cam_sql, cam_params = _camera_clause(camera)
+    utc_start, utc_end = _utc_naive(start), _utc_naive(end)
+    # Hour buckets map onto local hours unless the zone has a fractional offset
+    whole_hours = all(LOCAL_TZ.utcoffset(d).total_seconds() % 3600 == 0 for d in (utc_start, utc_end))
+    table = "counts_hour" if whole_hours else "counts_minute"
 
-    with engine.begin() as conn:
-        rows = conn.execute(text(f"""
-            SELECT label, COUNT(*) cnt
-            FROM events
-            WHERE {cam_sql} AND end_time>=:start AND end_time<:end
-            GROUP BY label ORDER BY label;
-        """), {**cam_params, "start": start, "end": end}).mappings().all()
-        totals=[r for r in rows if r["label"] in act]
-
-        rows_h = conn.execute(text(f"""
-            SELECT CAST(strftime('%H', end_time) AS INTEGER) AS h, label, COUNT(*) cnt
-            FROM events
-            WHERE {cam_sql} AND end_time>=:start AND end_time<:end
-            GROUP BY h,label ORDER BY h,label;
-        """), {**cam_params, "start": start, "end": end}).mappings().all()
-        rows_h=[{"h":int(r["h"]), "label":r["label"], "cnt":int(r["cnt"])} for r in rows_h if r["label"] in act]
-        by_hour={"labels":[f"{h:02d}" for h in range(24)],
-                 "rows":[{"idx":r["h"], "label":r["label"], "cnt":r["cnt"]} for r in rows_h]}
-
-        rows_b = conn.execute(text(f"""
-            SELECT DATE(end_time) AS d, label, COUNT(*) cnt
-            FROM events
-            WHERE {cam_sql} AND end_time>=:start AND end_time<:end
-            GROUP BY d,label ORDER BY d,label;
-        """), {**cam_params, "start": start, "end": end}).mappings().all()
-        lbls = [start.date().isoformat()] if view=="day" else labels
-        map_idx = {v:i for i,v in enumerate(lbls)}
-        rows_bucket=[{"idx":map_idx.get(r["d"],0),"label":r["label"],"cnt":int(r["cnt"])}
-                     for r in rows_b if r["label"] in act and r["d"] in map_idx]
-
-    return {"totals": totals, "by_hour": by_hour, "by_bucket": {"labels": lbls, "rows": rows_bucket}}
+    def load(span_start, span_end):
+        # One range scan, folded per local day into {(hour, label): count}
+        with engine.begin() as conn:
+            rows = conn.execute(text(f"""
+                SELECT bucket, label, SUM(count) cnt
+                FROM {table}
+                WHERE {cam_sql} AND bucket>=:start AND bucket<:end
+                GROUP BY bucket, label;
+            """), {**cam_params, "start": _bucket_str(span_start), "end": _bucket_str(span_end)}).all()
+        per_day = {}
+        local_of = {}
+        for bucket, label, cnt in rows:
+            local = local_of.get(bucket)
+            if local is None:
+                local = local_of[bucket] = datetime.fromisoformat(bucket).replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
+            counts = per_day.setdefault(local.date(), {})
+            counts[(local.hour, label)] = counts.get((local.hour, label), 0) + int(cnt)
+        return per_day
+
+    # Closed days come from RESULT_CACHE, only the rest is scanned
+    segments = []
+    d = start
+    while d < end:
+        segments.append((d.date(), _utc_naive(d), _utc_naive(d + timedelta(days=1)), True))
+        d += timedelta(days=1)
+    per_day = _cached_days(("summary", table, cam_sql, tuple(sorted(cam_params.values()))), segments, load)
+
+    lbls = [start.date().isoformat()] if view=="day" else labels
+    map_idx = {v:i for i,v in enumerate(lbls)}
+    totals, by_h, by_b = {}, {}, {}
+    for local_day, counts in per_day.items():
+        idx = map_idx.get(local_day.isoformat())
+        for (hour, label), cnt in counts.items():
+            if label not in act:
+                continue
+            totals[label] = totals.get(label, 0) + cnt
+            by_h[(hour, label)] = by_h.get((hour, label), 0) + cnt
+            if idx is not None:
+                by_b[(idx, label)] = by_b.get((idx, label), 0) + cnt
+
+    by_hour={"labels":[f"{h:02d}" for h in range(24)],
+             "rows":[{"idx":h, "label":l, "cnt":c} for (h,l),c in sorted(by_h.items())]}
+    rows_bucket=[{"idx":i, "label":l, "cnt":c} for (i,l),c in sorted(by_b.items())]
+    return {"totals": [{"label":l, "cnt":c} for l,c in sorted(totals.items())],
+            "by_hour": by_hour, "by_bucket": {"labels": lbls, "rows": rows_bucket}}
 
 # ============================
 #  NEW API ENDPOINTS (Technical Document)
@@ -876,7 +1691,7 @@ def api_counters():
     """
     try:
         counters_data = []
-        for counter_id, totals in COUNTER_TOTALS.items():
+        for counter_id, totals in counting_snapshot()["counters"].items():
             counter_cfg = COUNTERS.get(counter_id, {})
             counters_data.append({
                 "id": counter_id,
@@ -907,10 +1722,10 @@ def api_counter_detail(counter_id: str):
     Example: /api/counters/escuela
     """
     try:
-        if counter_id not in COUNTER_TOTALS:
+        totals = counting_snapshot()["counters"].get(counter_id)
+        if totals is None:
             return JSONResponse({"error": "Counter not found"}, status_code=404)
         
-        totals = COUNTER_TOTALS[counter_id]
         counter_cfg = COUNTERS.get(counter_id, {})
         
         return {
@@ -929,7 +1744,9 @@ def api_counter_detail(counter_id: str):
                 "initial_occupancy": counter_cfg.get("initial_occupancy", 0),
                 "reset_schedule": counter_cfg.get("reset_schedule", ""),
                 "publish_delta_only": counter_cfg.get("publish_delta_only", False)
-            }
+            },
+            "period_start": COUNTER_PERIOD_START[counter_id].strftime('%Y-%m-%dT%H:%M:%SZ') if counter_id in COUNTER_PERIOD_START else None,
+            "resets": RESET_STATS.get(counter_id, {})
         }
     
     except Exception as e:
@@ -975,54 +1792,82 @@ def api_counter_history(
         else:
             end_dt = datetime.utcnow()
         
-        # Group by clause
+        # Whole buckets come from the rollups, the partial ones at either end from
+        # counts_minute and, below a minute, raw events: end_time >= start_dt AND < end_dt
         if group_by == "hour":
-            time_format = "%Y-%m-%d %H:00:00"
-            group_clause = "strftime('%Y-%m-%d %H:00:00', end_time)"
+            tables = ["counts_minute", "counts_hour"]
+            rollup_bucket, event_bucket = "substr(bucket, 1, 13) || ':00:00'", "strftime('%Y-%m-%d %H:00:00', end_time)"
         else:  # day
-            time_format = "%Y-%m-%d"
-            group_clause = "DATE(end_time)"
+            tables = ["counts_minute", "counts_hour", "counts_day"]
+            rollup_bucket, event_bucket = "substr(bucket, 1, 10)", "DATE(end_time)"
+        table = tables[-1]
         
-        with engine.begin() as conn:
-            rows = conn.execute(text(f"""
-                SELECT 
-                    {group_clause} AS time_bucket,
-                    zone,
-                    COUNT(*) as count
-                FROM events
-                WHERE camera = :camera
-                  AND end_time >= :start
-                  AND end_time < :end
-                  AND zone IS NOT NULL
-                GROUP BY time_bucket, zone
-                ORDER BY time_bucket
-            """), {"camera": frigate_camera, "start": start_dt, "end": end_dt}).mappings().all()
-            
-            # Organize data
-            history = {}
+        def load(span_start, span_end):
+            # {UTC day: {time_bucket: {"in", "out"}}}
+            rows = []
+            with engine.begin() as conn:
+                for source, lo, hi in _rollup_spans(span_start, span_end, tables):
+                    if source is None:
+                        rows += [{"time_bucket": r["time_bucket"], "count": r["count"],
+                                  "direction": ZONE_DIRECTIONS.get((frigate_camera, r["zone"]), "")}
+                                 for r in conn.execute(text(f"""
+                            SELECT {event_bucket} AS time_bucket, zone, COUNT(*) as count
+                            FROM events
+                            WHERE camera = :camera
+                              AND end_time >= :start
+                              AND end_time < :end
+                              AND zone IS NOT NULL
+                            GROUP BY time_bucket, zone
+                        """), {"camera": frigate_camera, "start": lo, "end": hi}).mappings()]
+                        continue
+                    rows += conn.execute(text(f"""
+                        SELECT 
+                            {rollup_bucket} AS time_bucket,
+                            direction,
+                            SUM(count) as count
+                        FROM {source}
+                        WHERE camera = :camera
+                          AND bucket >= :start
+                          AND bucket < :end
+                          AND direction IN ('IN', 'OUT')
+                        GROUP BY time_bucket, direction
+                    """), {"camera": frigate_camera, "start": _bucket_str(lo),
+                           "end": _bucket_str(hi)}).mappings().all()
+            per_day = {}
             for r in rows:
+                if r["direction"] not in ("IN", "OUT"):
+                    continue
                 time_bucket = r["time_bucket"]
-                zone = r["zone"] or ""
-                count = r["count"]
-                
-                if time_bucket not in history:
-                    history[time_bucket] = {"in": 0, "out": 0}
-                
-                if "IN" in zone.upper():
-                    history[time_bucket]["in"] += count
-                elif "OUT" in zone.upper():
-                    history[time_bucket]["out"] += count
-            
-            # Convert to list
-            history_list = [
-                {
-                    "timestamp": ts,
-                    "in": data["in"],
-                    "out": data["out"],
-                    "occupancy_change": data["in"] - data["out"]
-                }
-                for ts, data in sorted(history.items())
-            ]
+                day_hist = per_day.setdefault(date.fromisoformat(time_bucket[:10]), {})
+                if time_bucket not in day_hist:
+                    day_hist[time_bucket] = {"in": 0, "out": 0}
+                day_hist[time_bucket][r["direction"].lower()] += r["count"]
+            return per_day
+        
+        # Whole closed days come from RESULT_CACHE; partial first/last days are read live
+        segments = []
+        day_start = datetime.combine(start_dt.date(), datetime.min.time())
+        while day_start < end_dt:
+            day_end = day_start + timedelta(days=1)
+            seg_start, seg_end = max(start_dt, day_start), min(end_dt, day_end)
+            segments.append((day_start.date(), seg_start, seg_end, (seg_start, seg_end) == (day_start, day_end)))
+            day_start = day_end
+        per_day = _cached_days(("history", table, frigate_camera), segments, load)
+        
+        history = {}
+        for day, _, _, _ in segments:
+            history.update(per_day[day])
+        
+        # Convert to list
+        history_list = [
+            {
+                "timestamp": ts,
+                "in": data["in"],
+                "out": data["out"],
+                "occupancy_change": data["in"] - data["out"]
+            }
+            for ts, data in sorted(history.items())
+        ]
         
         return {
             "counter_id": counter_id,
@@ -1044,10 +1889,11 @@ def api_cameras():
     """
     try:
         cameras_data = []
+        camera_counts = counting_snapshot()["cameras"]
         for alias, cam_cfg in CAMERA_MAP.items():
             # Get stats for this camera
             frigate_camera = cam_cfg["frigate_camera"]
-            zone_counts = CAMERA_ZONE_COUNTS.get(frigate_camera, {"IN": 0, "OUT": 0})
+            zone_counts = camera_counts.get(frigate_camera, {"IN": 0, "OUT": 0})
             
             cameras_data.append({
                 "alias": alias,
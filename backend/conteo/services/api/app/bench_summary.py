@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Benchmark of /api/summary over a seeded synthetic history.
+
+Generates a config with C cameras and a temporary DB, inserts N crossings
+(seeded, spread over the last D days), builds the rollups and times
+`api_summary` for day/week/month views, all cameras and one camera. For
+reference it also times the previous implementation: three GROUP BY queries
+over raw `events` with UTC `strftime`/`DATE()` buckets. "cold" drops the
+result cache before every call; "cached" reuses closed days. Month totals are
+checked against a count over raw events in the same local-time range.
+
+Usage:
+    python bench_summary.py --rows 1000000 --days 90 --cameras 6 --repeat 20
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+LABELS = ["auto", "moto", "personas", "bicicleta", "autobús"]
+
+LEGACY_QUERIES = [
+    "SELECT label, COUNT(*) cnt FROM events WHERE {cam} AND end_time>=:start AND end_time<:end GROUP BY label",
+    "SELECT CAST(strftime('%H', end_time) AS INTEGER) AS h, label, COUNT(*) cnt FROM events "
+    "WHERE {cam} AND end_time>=:start AND end_time<:end GROUP BY h,label",
+    "SELECT DATE(end_time) AS d, label, COUNT(*) cnt FROM events "
+    "WHERE {cam} AND end_time>=:start AND end_time<:end GROUP BY d,label",
+]
+
+
+def _write_conf(path: str, work: str, cameras: int, tz: str) -> None:
+    lines = [
+        "[app]", "mode=multi", f"timezone={tz}", "retention_days=0", f"storage=sqlite:///{work}/Conteo.db", "",
+        "[server:bench]", "mqtt_broker=127.0.0.1", "enabled=false", "",
+        "[publish:mqtt]", "enabled=false", "",
+    ]
+    for c in range(cameras):
+        lines += [f"[camera:Cam{c}]", "server=bench", f"frigate_camera=cam{c}", "zone_in=IN", "zone_out=OUT", ""]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def _pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _time(fn, repeat: int) -> tuple[float, float]:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return _pct(samples, 50), _pct(samples, 95)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--days", type=int, default=90)
+    ap.add_argument("--cameras", type=int, default=6)
+    ap.add_argument("--timezone", default="America/Argentina/Cordoba")
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="conteo-bench-")
+    os.environ.update({"CONF_PATH": os.path.join(work, "conteo.conf"), "LOG_DIR": os.path.join(work, "LOG")})
+    _write_conf(os.environ["CONF_PATH"], work, args.cameras, args.timezone)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import app as conteo
+    from sqlalchemy import text
+
+    conteo.app_log.setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rnd = random.Random(args.seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    span = args.days * 86400
+    t0 = time.perf_counter()
+    with conteo.engine.begin() as conn:
+        chunk = []
+        for i in range(args.rows):
+            end = now - timedelta(seconds=rnd.randrange(span))
+            chunk.append({"id": f"b{i}", "cam": f"cam{rnd.randrange(args.cameras)}", "label": rnd.choice(LABELS),
+                          "start": end - timedelta(seconds=3), "end": end, "zone": rnd.choice(("IN", "OUT"))})
+            if len(chunk) == 50000:
+                conn.execute(conteo.INSERT_EVENT_SQL, chunk)
+                chunk = []
+        if chunk:
+            conn.execute(conteo.INSERT_EVENT_SQL, chunk)
+    t_insert = time.perf_counter() - t0
+    with conteo.engine.begin() as conn:
+        rebuilt = conteo.rebuild_rollups(conn)
+        conn.exec_driver_sql("ANALYZE")
+    print(f"rows={args.rows:,} days={args.days} cameras={args.cameras} tz={args.timezone} seed={args.seed}")
+    print(f"insert: {t_insert:.1f}s | rollup rebuild: {rebuilt['ms'] / 1000:.1f}s "
+          f"(hour buckets: {rebuilt['counts_hour']:,}, minute buckets: {rebuilt['counts_minute']:,})")
+
+    today = datetime.now(conteo.LOCAL_TZ).date()
+    ref = (today - timedelta(days=1)).isoformat()
+    with conteo.engine.connect() as conn:
+        plan = conn.execute(text(
+            "EXPLAIN QUERY PLAN SELECT bucket, label, SUM(count) FROM counts_hour "
+            "WHERE camera=:cam AND bucket>=:start AND bucket<:end GROUP BY bucket, label"
+        ), {"cam": "cam0", "start": "", "end": ""}).all()
+    print("plan (one camera): " + " | ".join(r[-1] for r in plan))
+
+    print(f"{'view':<6} {'camera':<6} {'cold p50/p95 ms':>18} {'cached p50/p95 ms':>20} {'legacy p50/p95 ms':>20}")
+    for view in ("day", "week", "month"):
+        start, end, _ = conteo._range(view, today - timedelta(days=1))
+        for camera in ("ALL", "cam0"):
+            cam_sql, cam_params = conteo._camera_clause(camera)
+            params = {**cam_params, "start": start, "end": end}
+
+            def legacy():
+                with conteo.engine.begin() as conn:
+                    for q in LEGACY_QUERIES:
+                        conn.execute(text(q.format(cam=cam_sql)), params).all()
+
+            def cold():
+                conteo.RESULT_CACHE.invalidate()
+                conteo.api_summary(view=view, date=ref, camera=camera)
+
+            uncached = _time(cold, args.repeat)
+            cached = _time(lambda: conteo.api_summary(view=view, date=ref, camera=camera), args.repeat)
+            old = _time(legacy, max(3, args.repeat // 4))
+            print(f"{view:<6} {camera:<6} {uncached[0]:>8.2f} / {uncached[1]:<7.2f} "
+                  f"{cached[0]:>9.2f} / {cached[1]:<8.2f} {old[0]:>9.2f} / {old[1]:<8.2f}")
+
+    start, end, _ = conteo._range("month", today - timedelta(days=1))
+    got = sum(r["cnt"] for r in conteo.api_summary(view="month", date=ref, camera="ALL")["totals"])
+    with conteo.engine.connect() as conn:
+        expected = conn.execute(text("SELECT COUNT(*) FROM events WHERE end_time>=:s AND end_time<:e"),
+                                {"s": conteo._utc_naive(start), "e": conteo._utc_naive(end)}).scalar()
+    print(f"month total check: summary={got:,} raw={expected:,} {'OK' if got == expected else 'MISMATCH'}")
+    print(f"result cache: {conteo.RESULT_CACHE.metrics()}")
+    print(f"work dir: {work}")
+    if got != expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Stress check for the counting consumer: exact totals under concurrent MQTT threads.
+
+Generates a config with C cameras (one zones counter each) and no live MQTT
+servers, imports the app and calls its `on_message` from T threads at once,
+as the per-server `mqtt_loop` threads would. Every tracked object sends
+new/update/update/end with the same zone, so exactly one crossing must be
+counted per object. Meanwhile a reader thread checks that every snapshot is
+consistent (occupancy == initial + in - out, events_processed == sum of the
+camera IN/OUT counts).
+
+Usage:
+    python stress_counting.py --threads 8 --objects 20000 --cameras 6
+
+Exits with status 1 if totals, snapshots or stored rows do not match.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+LABELS = [("car", "auto"), ("motorcycle", "moto"), ("person", "personas")]
+
+
+class _Msg:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic: str, payload: bytes) -> None:
+        self.topic, self.payload = topic, payload
+
+
+def _write_conf(path: str, work: str, cameras: int, initial: int) -> None:
+    lines = [
+        "[app]", "mode=multi", "retention_days=0", f"storage=sqlite:///{work}/Conteo.db", "",
+        "[objects]", "labels=car,motorcycle,person",
+        "labels_map=person:personas,car:auto,motorcycle:moto", "",
+        "[server:stress]", "mqtt_broker=127.0.0.1", "enabled=false", "",
+        "[publish:mqtt]", "enabled=false", "",
+    ]
+    for c in range(cameras):
+        lines += [f"[camera:Cam{c}]", "server=stress", f"frigate_camera=cam{c}", "mode=zones",
+                  "zone_in=IN", "zone_out=OUT", "",
+                  f"[counter:c{c}]", "type=zones", f"source_camera=Cam{c}", "objects=auto,moto,personas",
+                  f"initial_occupancy={initial}", ""]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def _plan(worker: int, threads: int, objects: int, cameras: int):
+    """Objects sent by one worker: (object_id, camera, label_en, label_es, direction)."""
+    for k in range(worker, objects, threads):
+        cam = f"cam{k % cameras}"
+        label_en, label_es = LABELS[k % len(LABELS)]
+        direction = "OUT" if k % 3 == 0 else "IN"
+        yield f"obj-{k}", cam, label_en, label_es, direction
+
+
+def _messages(object_id: str, cam: str, label_en: str, zone: str, ts: float):
+    for ev_type, zones in (("new", []), ("update", [zone]), ("update", [zone]), ("end", [zone])):
+        after = {"id": object_id, "camera": cam, "label": label_en, "start_time": ts - 2,
+                 "end_time": ts, "entered_zones": zones}
+        yield json.dumps({"type": ev_type, "after": after}).encode()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--threads", type=int, default=8, help="hilos productores (servidores MQTT simulados)")
+    ap.add_argument("--objects", type=int, default=20000, help="objetos rastreados en total")
+    ap.add_argument("--cameras", type=int, default=6)
+    ap.add_argument("--initial-occupancy", type=int, default=100)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="conteo-stress-")
+    os.environ.update({"CONF_PATH": os.path.join(work, "conteo.conf"), "LOG_DIR": os.path.join(work, "LOG")})
+    _write_conf(os.environ["CONF_PATH"], work, args.cameras, args.initial_occupancy)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import app as conteo
+    from sqlalchemy import text
+
+    conteo.app_log.setLevel(logging.WARNING)
+
+    expected_counters = {f"c{c}": {"in": 0, "out": 0} for c in range(args.cameras)}
+    expected_labels: dict[str, int] = {}
+    for w in range(args.threads):
+        for _, cam, _, label_es, direction in _plan(w, args.threads, args.objects, args.cameras):
+            expected_counters["c" + cam[3:]][direction.lower()] += 1
+            expected_labels[label_es] = expected_labels.get(label_es, 0) + 1
+
+    start = threading.Barrier(args.threads + 1)
+    stop_reader = threading.Event()
+    check = {"snapshots": 0, "inconsistent": 0, "regressions": 0}
+
+    def produce(worker: int) -> None:
+        ts = time.time()
+        start.wait()
+        for object_id, cam, label_en, _, direction in _plan(worker, args.threads, args.objects, args.cameras):
+            for raw in _messages(object_id, cam, label_en, direction, ts):
+                conteo.on_message(None, None, _Msg("frigate/events", raw))
+
+    def read_snapshots() -> None:
+        last = 0
+        while not stop_reader.is_set():
+            snap = conteo.counting_snapshot()
+            check["snapshots"] += 1
+            ok = all(t["occupancy"] == args.initial_occupancy + t["in"] - t["out"] for t in snap["counters"].values())
+            ok = ok and snap["events_processed"] == sum(c["IN"] + c["OUT"] for c in snap["cameras"].values())
+            if not ok:
+                check["inconsistent"] += 1
+            if snap["events_processed"] < last:
+                check["regressions"] += 1
+            last = snap["events_processed"]
+
+    producers = [threading.Thread(target=produce, args=(w,)) for w in range(args.threads)]
+    reader = threading.Thread(target=read_snapshots)
+    for t in producers:
+        t.start()
+    reader.start()
+    t0 = time.perf_counter()
+    start.wait()
+    for t in producers:
+        t.join()
+    t_sent = time.perf_counter()
+    drained = conteo.flush_counting(timeout=args.timeout)
+    t_counted = time.perf_counter()
+    stop_reader.set()
+    reader.join()
+
+    conteo.EVENT_QUEUE.put(None)
+    conteo._writer_thread.join(timeout=args.timeout)
+    with conteo.engine.connect() as conn:
+        stored = conn.execute(text("SELECT COUNT(*) FROM events")).scalar()
+
+    snap = conteo.counting_snapshot()
+    errors = []
+    if not drained:
+        errors.append("consumer did not drain in time")
+    for cid, exp in expected_counters.items():
+        got = snap["counters"][cid]
+        exp_occ = args.initial_occupancy + exp["in"] - exp["out"]
+        if (got["in"], got["out"], got["occupancy"]) != (exp["in"], exp["out"], exp_occ):
+            errors.append(f"counter {cid}: got {got}, expected in={exp['in']} out={exp['out']} occupancy={exp_occ}")
+    if snap["labels"] != expected_labels:
+        errors.append(f"labels: got {snap['labels']}, expected {expected_labels}")
+    if snap["events_processed"] != args.objects:
+        errors.append(f"events_processed: got {snap['events_processed']}, expected {args.objects}")
+    if stored != args.objects:
+        errors.append(f"stored rows: got {stored}, expected {args.objects}")
+    if check["inconsistent"] or check["regressions"]:
+        errors.append(f"snapshots: {check['inconsistent']} inconsistent, {check['regressions']} went backwards")
+
+    messages = args.objects * 4
+    print(f"threads={args.threads} cameras={args.cameras} objects={args.objects} messages={messages}")
+    print(f"enqueue: {t_sent - t0:.2f}s | counted: {t_counted - t0:.2f}s ({messages / (t_counted - t0):,.0f} msg/s)")
+    print(f"snapshots read: {check['snapshots']} | consumer: {conteo.counting_metrics()}")
+    print(f"crossings: {conteo.ZONE_CROSSINGS.metrics()}")
+    print(f"stored rows: {stored} | work dir: {work}")
+    if errors:
+        print("FAIL")
+        for e in errors:
+            print(f"  {e}")
+        sys.exit(1)
+    print("OK: totals exact")
+
+
+if __name__ == "__main__":
+    main()